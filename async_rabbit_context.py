@@ -0,0 +1,246 @@
+import asyncio
+import collections
+import functools
+from typing import Awaitable, Callable, Iterable
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.spec import PERSISTENT_DELIVERY_MODE
+
+from rabbit_context import BaseRabbitContext, RabbitConnectionClosedError
+
+
+class AsyncRabbitContext(BaseRabbitContext):
+    """
+    asyncio counterpart to RabbitContext, to be used with `async with`.
+
+    Every channel is opened in publisher confirm mode and confirms are handled as they arrive, so publishes are
+    pipelined with up to `publish_window` unconfirmed messages in flight per channel. Extra channels can be opened
+    with `open_channel` to publish to or consume from several queues concurrently on the one connection. If a
+    channel or the connection closes, everything still waiting on it fails rather than waiting forever.
+    """
+
+    def __enter__(self):
+        raise TypeError('AsyncRabbitContext must be used with "async with"')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def __aenter__(self):
+        await self.open_connection()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close_connection()
+
+    async def open_connection(self):
+        loop = asyncio.get_running_loop()
+        connection_opened = loop.create_future()
+        self._connection_closed = loop.create_future()
+        self._confirm_trackers = {}
+        self._pending_callbacks = {}
+        self._consumer_tasks = set()
+        self._connection = AsyncioConnection(
+            self._connection_parameters(),
+            on_open_callback=functools.partial(_resolve, connection_opened),
+            on_open_error_callback=lambda _connection, error: _reject(connection_opened, error),
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=loop)
+        await connection_opened
+
+        self._channel = await self.open_channel()
+        if self.queue_name == 'localtest':
+            await self._await_callback(self._channel.queue_declare, channel=self._channel, queue=self.queue_name)
+
+        return self._connection
+
+    async def close_connection(self):
+        if self._consumer_tasks:
+            await asyncio.gather(*self._consumer_tasks, return_exceptions=True)
+        if self._connection.is_open:
+            self._connection.close()
+        await self._connection_closed
+        del self._channel
+        del self._connection
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+    async def open_channel(self):
+        channel = await self._await_callback(self._connection.channel, callback_name='on_open_callback')
+        self._confirm_trackers[channel.channel_number] = _ConfirmTracker()
+        channel.add_on_close_callback(self._on_channel_closed)
+        await self._await_callback(channel.confirm_delivery, channel=channel,
+                                   ack_nack_callback=functools.partial(self._on_delivery_confirmation,
+                                                                       channel.channel_number))
+        return channel
+
+    async def publish_message(self, message: str, content_type: str, channel=None, queue_name: str = None):
+        self._check_connection_open()
+        await self._publish(channel or self.channel, queue_name or self.queue_name, message,
+                            pika.BasicProperties(content_type=content_type, delivery_mode=PERSISTENT_DELIVERY_MODE))
+
+    async def publish_messages(self, messages: Iterable[str], content_type: str,
+                               on_window_confirmed: Callable[[int], None] = None,
+                               channel=None, queue_name: str = None) -> int:
+        """
+        Publish messages without waiting for each confirm, keeping at most `publish_window` unconfirmed messages in
+        flight and returning once every message has been confirmed. `on_window_confirmed` is called with the size of
+        each window of messages as they are confirmed.
+        """
+        self._check_connection_open()
+        channel = channel or self.channel
+        queue_name = queue_name or self.queue_name
+        properties = pika.BasicProperties(content_type=content_type, delivery_mode=PERSISTENT_DELIVERY_MODE)
+        in_flight = collections.deque()
+        published_count = 0
+        window_count = 0
+        for message in messages:
+            in_flight.append(self._publish(channel, queue_name, message, properties))
+            if len(in_flight) < self._publish_window:
+                continue
+            await in_flight.popleft()
+            published_count += 1
+            window_count += 1
+            if window_count == self._publish_window:
+                self._report_window(window_count, on_window_confirmed)
+                window_count = 0
+        for confirmation in in_flight:
+            await confirmation
+            published_count += 1
+            window_count += 1
+        if window_count:
+            self._report_window(window_count, on_window_confirmed)
+        return published_count
+
+    async def get_queue_depth(self, queue_name: str = None) -> int:
+        self._check_connection_open()
+        declare_ok = await self._await_callback(self.channel.queue_declare, channel=self.channel,
+                                                queue=queue_name or self.queue_name, passive=True)
+        return declare_ok.method.message_count
+
+    async def consume(self, on_message_callback: Callable[..., Awaitable], queue_name: str = None, channel=None,
+                      prefetch_count: int = None) -> str:
+        """
+        Start consuming, running the `on_message_callback` coroutine function with
+        (channel, method, properties, body) in its own task for each message. Returns the consumer tag.
+        """
+        self._check_connection_open()
+        channel = channel or self.channel
+        if prefetch_count:
+            await self._await_callback(channel.basic_qos, channel=channel, prefetch_count=prefetch_count)
+        consume_ok = self._create_callback_future(channel)
+        consumer_tag = channel.basic_consume(queue_name or self.queue_name,
+                                             on_message_callback=functools.partial(self._dispatch_message,
+                                                                                   on_message_callback),
+                                             callback=functools.partial(_resolve, consume_ok))
+        await consume_ok
+        return consumer_tag
+
+    async def cancel_consumer(self, consumer_tag: str, channel=None):
+        channel = channel or self.channel
+        await self._await_callback(channel.basic_cancel, channel=channel, consumer_tag=consumer_tag)
+
+    def _publish(self, channel, queue_name, message, properties) -> asyncio.Future:
+        channel.basic_publish(exchange=self._exchange, routing_key=queue_name, body=message, properties=properties)
+        return self._confirm_trackers[channel.channel_number].add()
+
+    def _dispatch_message(self, on_message_callback, channel, method, properties, body):
+        task = asyncio.ensure_future(on_message_callback(channel, method, properties, body))
+        self._consumer_tasks.add(task)
+        task.add_done_callback(self._consumer_tasks.discard)
+
+    def _on_delivery_confirmation(self, channel_number, method_frame):
+        confirmation = method_frame.method
+        self._confirm_trackers[channel_number].confirm(confirmation.delivery_tag, confirmation.multiple,
+                                                       acked=isinstance(confirmation, pika.spec.Basic.Ack))
+
+    def _on_channel_closed(self, channel, reason):
+        error = RabbitChannelClosedError(reason)
+        self._confirm_trackers[channel.channel_number].fail_pending(error)
+        for completed in list(self._pending_callbacks.pop(channel.channel_number, ())):
+            _reject(completed, error)
+
+    def _on_connection_closed(self, _connection, reason):
+        error = RabbitConnectionClosedError(reason)
+        for confirm_tracker in self._confirm_trackers.values():
+            confirm_tracker.fail_pending(error)
+        for pending_callbacks in list(self._pending_callbacks.values()):
+            for completed in list(pending_callbacks):
+                _reject(completed, error)
+        self._pending_callbacks = {}
+        _resolve(self._connection_closed, reason)
+
+    @staticmethod
+    def _report_window(window_count, on_window_confirmed):
+        if on_window_confirmed:
+            on_window_confirmed(window_count)
+
+    async def _await_callback(self, method, callback_name='callback', channel=None, **kwargs):
+        completed = self._create_callback_future(channel)
+        method(**kwargs, **{callback_name: functools.partial(_resolve, completed)})
+        return await completed
+
+    def _create_callback_future(self, channel=None) -> asyncio.Future:
+        """
+        A future for a pika callback, failed if `channel`, when given, or the connection closes before it is called
+        """
+        completed = asyncio.get_running_loop().create_future()
+        pending_callbacks = self._pending_callbacks.setdefault(channel.channel_number if channel else None, set())
+        pending_callbacks.add(completed)
+        completed.add_done_callback(pending_callbacks.discard)
+        return completed
+
+
+class _ConfirmTracker:
+    """
+    Futures for the unconfirmed publishes on a channel, keyed by delivery tag. The broker numbers the messages
+    published on a channel in confirm mode from 1, so the tags are tracked locally rather than read back.
+    """
+
+    def __init__(self):
+        self._last_delivery_tag = 0
+        self._pending = collections.OrderedDict()
+
+    def add(self) -> asyncio.Future:
+        self._last_delivery_tag += 1
+        confirmation = asyncio.get_running_loop().create_future()
+        self._pending[self._last_delivery_tag] = confirmation
+        return confirmation
+
+    def confirm(self, delivery_tag, multiple, acked):
+        if multiple:
+            delivery_tags = [pending_tag for pending_tag in self._pending if pending_tag <= delivery_tag]
+        else:
+            delivery_tags = [delivery_tag]
+        for confirmed_tag in delivery_tags:
+            confirmation = self._pending.pop(confirmed_tag, None)
+            if not confirmation:
+                continue
+            if acked:
+                _resolve(confirmation, None)
+            else:
+                _reject(confirmation, RabbitMessageNackedError(f'Broker nacked delivery tag {confirmed_tag}'))
+
+    def fail_pending(self, error):
+        while self._pending:
+            _, confirmation = self._pending.popitem(last=False)
+            _reject(confirmation, error)
+
+
+def _resolve(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _reject(future: asyncio.Future, error):
+    if not future.done():
+        future.set_exception(error if isinstance(error, BaseException) else RabbitConnectionClosedError(error))
+
+
+class RabbitMessageNackedError(Exception):
+    pass
+
+
+class RabbitChannelClosedError(RabbitConnectionClosedError):
+    pass
@@ -0,0 +1,159 @@
+import base64
+import json
+import os
+import struct
+import uuid
+import zlib
+from pathlib import Path
+from typing import Dict, Iterable
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from exceptions import BatchSnapshotInvalidException
+
+# Rows are packed, compressed and encrypted this many at a time, which bounds how much of a snapshot is in memory
+SNAPSHOT_CHUNK_ROWS = int(os.getenv('SNAPSHOT_CHUNK_ROWS', '65536'))
+
+# Every chunk is written as the length of its ciphertext and its nonce followed by the ciphertext
+CHUNK_HEADER = struct.Struct('>I12s')
+NONCE_SIZE = 12
+
+
+class BatchSnapshot:
+    """
+    A local copy of a batch's QID/UAC pairs, so print files can be regenerated without querying the database again.
+    Each questionnaire type's pairs are kept in their own file as chunks of a QID column and a UAC column, zlib
+    compressed then AES-GCM encrypted with SNAPSHOT_KEY. The index, holding the row count of every questionnaire
+    type, is written last, and the snapshot is only used while those counts still match the batch in the database.
+    """
+
+    def __init__(self, snapshot_directory: Path, batch_id: uuid.UUID, key: bytes = None):
+        self.batch_id = batch_id
+        self.batch_directory = snapshot_directory.joinpath(str(batch_id))
+        # Only the key is kept, not the cipher, so a snapshot can be passed to worker processes
+        self._key = key or load_snapshot_key()
+        AESGCM(self._key)
+
+    def matches(self, link_counts: Dict[str, int]) -> bool:
+        index_file_path = self.batch_directory.joinpath('index.json')
+        if not index_file_path.exists():
+            return False
+        index = json.loads(index_file_path.read_text())
+        return index['batchId'] == str(self.batch_id) and index['rowCounts'] == link_counts
+
+    def write(self, uac_qid_links: Iterable) -> Dict[str, int]:
+        self.batch_directory.mkdir(parents=True, exist_ok=True)
+        for stale_file_path in self.batch_directory.glob('*'):
+            stale_file_path.unlink()
+
+        aes_gcm = AESGCM(self._key)
+        snapshot_writers = {}
+        try:
+            for result_row in uac_qid_links:
+                questionnaire_type = result_row['qid'][:2]
+                snapshot_writer = snapshot_writers.get(questionnaire_type)
+                if not snapshot_writer:
+                    snapshot_writer = snapshot_writers[questionnaire_type] = _SnapshotFileWriter(
+                        self._snapshot_file_path(questionnaire_type), aes_gcm,
+                        self._associated_data_prefix(questionnaire_type))
+                snapshot_writer.write_row(result_row['qid'], result_row['uac'])
+        finally:
+            for snapshot_writer in snapshot_writers.values():
+                snapshot_writer.close()
+
+        row_counts = {questionnaire_type: snapshot_writer.row_count
+                      for questionnaire_type, snapshot_writer in snapshot_writers.items()}
+        index_file_path = self.batch_directory.joinpath('index.json')
+        partial_file_path = index_file_path.with_suffix('.partial')
+        partial_file_path.write_text(json.dumps({'batchId': str(self.batch_id), 'rowCounts': row_counts}))
+        partial_file_path.replace(index_file_path)
+        return row_counts
+
+    def uac_qid_links(self, questionnaire_type):
+        snapshot_file_path = self._snapshot_file_path(questionnaire_type)
+        if not snapshot_file_path.exists():
+            return
+        aes_gcm = AESGCM(self._key)
+        row_count = 0
+        with open(snapshot_file_path, 'rb') as snapshot_file:
+            for chunk_index, chunk in enumerate(iter(lambda: _read_chunk(snapshot_file), None)):
+                nonce, ciphertext = chunk
+                try:
+                    packed_rows = aes_gcm.decrypt(
+                        nonce, ciphertext, self._associated_data_prefix(questionnaire_type) + str(chunk_index).encode())
+                except InvalidTag:
+                    raise BatchSnapshotInvalidException(f'Chunk {chunk_index} of {snapshot_file_path} could not be'
+                                                        f' decrypted with SNAPSHOT_KEY')
+                qids, uacs = zlib.decompress(packed_rows).decode().split('\0')
+                for qid, uac in zip(qids.split('\n'), uacs.split('\n')):
+                    yield {'qid': qid, 'uac': uac}
+                    row_count += 1
+        expected_row_count = json.loads(self.batch_directory.joinpath('index.json').read_text())['rowCounts'].get(
+            questionnaire_type, 0)
+        if row_count != expected_row_count:
+            raise BatchSnapshotInvalidException(f'{snapshot_file_path} has {row_count} rows, the index expected'
+                                                f' {expected_row_count}')
+
+    def _snapshot_file_path(self, questionnaire_type) -> Path:
+        return self.batch_directory.joinpath(f'{questionnaire_type}.snapshot')
+
+    def _associated_data_prefix(self, questionnaire_type) -> bytes:
+        # Authenticating the batch, questionnaire type and position of every chunk stops chunks being swapped
+        # between files or reordered within one
+        return f'{self.batch_id}:{questionnaire_type}:'.encode()
+
+
+def load_snapshot_key() -> bytes:
+    snapshot_key = os.getenv('SNAPSHOT_KEY')
+    if not snapshot_key:
+        raise ValueError('SNAPSHOT_KEY must be set to a base64 encoded AES key to use a batch snapshot')
+    return base64.b64decode(snapshot_key)
+
+
+class _SnapshotFileWriter:
+
+    def __init__(self, snapshot_file_path: Path, aes_gcm: AESGCM, associated_data_prefix: bytes):
+        self._snapshot_file = open(snapshot_file_path, 'wb')
+        self._aes_gcm = aes_gcm
+        self._associated_data_prefix = associated_data_prefix
+        self._qids = []
+        self._uacs = []
+        self._chunk_index = 0
+        self.row_count = 0
+
+    def write_row(self, qid: str, uac: str):
+        self._qids.append(qid)
+        self._uacs.append(uac)
+        self.row_count += 1
+        if len(self._qids) >= SNAPSHOT_CHUNK_ROWS:
+            self._write_chunk()
+
+    def close(self):
+        if self._qids:
+            self._write_chunk()
+        self._snapshot_file.close()
+
+    def _write_chunk(self):
+        packed_rows = zlib.compress(('\n'.join(self._qids) + '\0' + '\n'.join(self._uacs)).encode())
+        nonce = os.urandom(NONCE_SIZE)
+        ciphertext = self._aes_gcm.encrypt(nonce, packed_rows,
+                                           self._associated_data_prefix + str(self._chunk_index).encode())
+        self._snapshot_file.write(CHUNK_HEADER.pack(len(ciphertext), nonce))
+        self._snapshot_file.write(ciphertext)
+        self._chunk_index += 1
+        self._qids = []
+        self._uacs = []
+
+
+def _read_chunk(snapshot_file):
+    header = snapshot_file.read(CHUNK_HEADER.size)
+    if not header:
+        return None
+    if len(header) < CHUNK_HEADER.size:
+        raise BatchSnapshotInvalidException(f'{snapshot_file.name} ends part way through a chunk header')
+    ciphertext_length, nonce = CHUNK_HEADER.unpack(header)
+    ciphertext = snapshot_file.read(ciphertext_length)
+    if len(ciphertext) < ciphertext_length:
+        raise BatchSnapshotInvalidException(f'{snapshot_file.name} ends part way through a chunk')
+    return nonce, ciphertext
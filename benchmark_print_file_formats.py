@@ -0,0 +1,76 @@
+import argparse
+import itertools
+import os
+import random
+import string
+import time
+from typing import List
+
+from constants import Compression, PrintFileFormat
+from encryption import create_encrypting_writer, get_recipient_keys, ENCRYPTION_BACKENDS, PGP_CHUNK_SIZE
+from print_file_writer import HashingFileWriter
+from print_row_formatter import compile_print_row_formatter
+
+UAC_CHARACTERS = string.ascii_lowercase + string.digits
+
+
+def generate_print_file_chunks(row_count, supplier, pack_code='D_FD_H1') -> List[bytes]:
+    """
+    Formatted print rows with random UACs and sequential QIDs, the way the real files look, in chunks of about
+    the size PrintFileWriter writes them
+    """
+    uac_random = random.Random(0)
+    print_row_formatter = compile_print_row_formatter(supplier, pack_code)
+    print_file = ''.join(print_row_formatter.format_row({'uac': ''.join(uac_random.choices(UAC_CHARACTERS, k=16)),
+                                                         'qid': f'01{row_number:014}'})
+                         for row_number in range(row_count)).encode()
+    return [print_file[chunk_start:chunk_start + PGP_CHUNK_SIZE]
+            for chunk_start in range(0, len(print_file), PGP_CHUNK_SIZE)]
+
+
+def benchmark_print_file_format(chunks: List[bytes], supplier, backend, print_file_format: PrintFileFormat):
+    with open(os.devnull, 'wb') as null_file:
+        hashing_writer = HashingFileWriter(null_file)
+        start_time = time.perf_counter()
+        with create_encrypting_writer(hashing_writer, supplier, backend, print_file_format) as encrypting_writer:
+            for chunk in chunks:
+                encrypting_writer.write(chunk)
+        return hashing_writer.size_bytes, time.perf_counter() - start_time
+
+
+def benchmark_print_file_formats(row_count, supplier, backend, compression_levels):
+    get_recipient_keys(supplier)
+    print(f'Generating {row_count} {supplier} print rows')
+    chunks = generate_print_file_chunks(row_count, supplier)
+    unencrypted_size = sum(len(chunk) for chunk in chunks)
+    print(f'Unencrypted size {unencrypted_size} bytes, encrypting with the {backend} backend')
+    print(f'{"armored":>8} {"compression":>11} {"level":>5} {"size bytes":>12} {"ratio":>6} {"seconds":>8} {"MB/s":>7}')
+    for armored, compression in itertools.product((True, False), Compression):
+        for compression_level in (compression_levels if compression is not Compression.NONE else (0,)):
+            size_bytes, seconds = benchmark_print_file_format(chunks, supplier, backend,
+                                                              PrintFileFormat(armored, compression, compression_level))
+            print(f'{str(armored):>8} {compression.name:>11} {compression_level:>5} {size_bytes:>12}'
+                  f' {size_bytes / unencrypted_size:>6.3f} {seconds:>8.2f} {unencrypted_size / seconds / 1e6:>7.1f}')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Report the size and time of encrypting a print file in each armor and compression format')
+    parser.add_argument('--rows', help='Number of print rows to encrypt, defaults to 1100000', type=int,
+                        default=1100000, required=False)
+    parser.add_argument('--supplier', help='The supplier whose keys and print template to use, defaults to QM',
+                        default='QM', required=False)
+    parser.add_argument('--encryption-backend', help='The encryption backend to benchmark, defaults to pgpy',
+                        choices=tuple(ENCRYPTION_BACKENDS), default='pgpy', required=False)
+    parser.add_argument('--compression-levels', help='Compression levels to try, defaults to 1 6 9', type=int,
+                        nargs='+', default=(1, 6, 9), required=False)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    benchmark_print_file_formats(args.rows, args.supplier, args.encryption_backend, args.compression_levels)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from enum import Enum
+from typing import NamedTuple
 
 
 class Dataset(Enum):
@@ -43,3 +44,17 @@ class PrintTemplate:
         'COORDINATOR_ID',
         'OFFICER_ID'
     )
+
+
+class Compression(Enum):
+    # The OpenPGP compression algorithm IDs
+    NONE = 0
+    ZIP = 1
+    ZLIB = 2
+    BZ2 = 3
+
+
+class PrintFileFormat(NamedTuple):
+    armored: bool = True
+    compression: Compression = Compression.ZIP
+    compression_level: int = 6
@@ -17,8 +17,8 @@ def publish_messages_from_json_file_path(queue_name: str, source_file_path: Path
 def publish_messages_from_dump_files(queue_name: str, source_file_path: Path, destination_file_path: Path):
     with RabbitContext(queue_name=queue_name) as rabbit:
         for file_path in source_file_path.rglob('*.dump'):
-            for json_message in file_path.open():
-                rabbit.publish_message(json_message, 'application/json')
+            with file_path.open() as dump_file:
+                rabbit.publish_messages(dump_file, 'application/json')
             file_path.replace(destination_file_path.joinpath(file_path.name))
 
 
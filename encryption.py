@@ -1,30 +1,456 @@
+import abc
+import base64
+import bz2
+import functools
+import hashlib
+import io
 import os
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import List, Tuple
 
 import pgpy
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
-from exceptions import EncryptionFailedException
-from mappings import SUPPLIER_TO_KEY_PATH
+from constants import Compression, PrintFileFormat
+from exceptions import EncryptionFailedException, EncryptionKeyInvalidException
+from mappings import SUPPLIER_TO_KEY_PATH, SUPPLIER_TO_KEY_FINGERPRINT, SUPPLIER_TO_PRINT_FILE_FORMAT
 
+# The backend used to encrypt print files when one isn't chosen for the run
+ENCRYPTION_BACKEND = os.getenv('ENCRYPTION_BACKEND', 'pgpy')
+GPG_BINARY = os.getenv('GPG_BINARY', 'gpg')
 
-def pgp_encrypt_message(message, supplier):
-    # A key can be loaded from a file, like so:
-    our_key, _ = pgpy.PGPKey.from_file(os.getenv('OUR_PUBLIC_KEY_PATH'))
-    supplier_key, _ = pgpy.PGPKey.from_file(SUPPLIER_TO_KEY_PATH[supplier])
+# Size of the partial body chunks the packets are streamed in, which bounds how much of the message is buffered.
+# OpenPGP requires partial body lengths to be a power of 2 and the first one to be at least 512 bytes
+PGP_CHUNK_SIZE = int(os.getenv('PGP_CHUNK_SIZE', str(2 ** 16)))
 
-    # this creates a standard message from text
-    # it will also be compressed, by default with ZIP DEFLATE, unless otherwise specified
-    text_message = pgpy.PGPMessage.new(message)
+LITERAL_DATA_TAG = 11
+COMPRESSED_DATA_TAG = 8
+SYM_ENCRYPTED_INTEGRITY_PROTECTED_DATA_TAG = 18
+AES_BLOCK_SIZE = 16
+ENCRYPTION_KEY_FLAGS = {pgpy.constants.KeyFlags.EncryptCommunications, pgpy.constants.KeyFlags.EncryptStorage}
 
-    cipher = pgpy.constants.SymmetricKeyAlgorithm.AES256
-    sessionkey = cipher.gen_key()
 
-    # encrypt the message to multiple recipients
-    encrypted_message_v1 = our_key.encrypt(text_message, cipher=cipher, sessionkey=sessionkey)
-    encrypted_message_v2 = supplier_key.encrypt(encrypted_message_v1, cipher=cipher, sessionkey=sessionkey)
+def pgp_encrypt_message(message, supplier, backend: str = None):
+    # The message is returned as a str so it is always armored, whatever the supplier's print file format
+    print_file_format = SUPPLIER_TO_PRINT_FILE_FORMAT[supplier]._replace(armored=True)
+    encrypted_message = io.BytesIO()
+    with create_encrypting_writer(encrypted_message, supplier, backend, print_file_format) as encrypting_writer:
+        encrypting_writer.write(message.encode())
+    return encrypted_message.getvalue().decode()
 
-    # do at least this as soon as possible after encrypting to the final recipient
-    del sessionkey
 
-    if encrypted_message_v2.is_encrypted:
-        return str(encrypted_message_v2)
-    raise EncryptionFailedException
+def create_encrypting_writer(output, supplier, backend: str = None,
+                             print_file_format: PrintFileFormat = None) -> 'EncryptingWriter':
+    backend = backend or ENCRYPTION_BACKEND
+    if backend not in ENCRYPTION_BACKENDS:
+        raise ValueError(f'Unknown encryption backend {backend}, must be one of {", ".join(ENCRYPTION_BACKENDS)}')
+    return ENCRYPTION_BACKENDS[backend](output, supplier, print_file_format or SUPPLIER_TO_PRINT_FILE_FORMAT[supplier])
+
+
+def get_recipient_keys(supplier) -> Tuple[pgpy.PGPKey, pgpy.PGPKey]:
+    """
+    Our public key and the supplier's, loaded and validated once per process then shared by every print file.
+    Call this before starting any work so a missing, expired or unexpected key fails the run straight away.
+    """
+    our_key = load_recipient_key(os.getenv('OUR_PUBLIC_KEY_PATH'), os.getenv('OUR_PUBLIC_KEY_FINGERPRINT'))
+    supplier_key = load_recipient_key(SUPPLIER_TO_KEY_PATH[supplier], SUPPLIER_TO_KEY_FINGERPRINT[supplier])
+    return our_key, supplier_key
+
+
+def get_encryption_settings(supplier, backend: str = None) -> dict:
+    """
+    The key fingerprints, backend and print file format a supplier's print files are encrypted with, recorded in
+    print file checkpoints so files encrypted any other way, such as to a rotated key, are not reused
+    """
+    print_file_format = SUPPLIER_TO_PRINT_FILE_FORMAT[supplier]
+    return {'keyFingerprints': [str(recipient_key.fingerprint) for recipient_key in get_recipient_keys(supplier)],
+            'backend': backend or ENCRYPTION_BACKEND,
+            'printFileFormat': {'armored': print_file_format.armored,
+                                'compression': print_file_format.compression.name,
+                                'compressionLevel': print_file_format.compression_level}}
+
+
+@functools.lru_cache()
+def load_recipient_key(key_path: str, expected_fingerprint: str = None) -> pgpy.PGPKey:
+    try:
+        key, _ = pgpy.PGPKey.from_file(key_path)
+    except (OSError, ValueError, TypeError, pgpy.errors.PGPError) as error:
+        raise EncryptionKeyInvalidException(f'Could not load PGP key from {key_path}: {error}') from error
+    if not key.is_public:
+        raise EncryptionKeyInvalidException(f'PGP key {key_path} is not a public key')
+    if expected_fingerprint and _normalise_fingerprint(key.fingerprint) != _normalise_fingerprint(expected_fingerprint):
+        raise EncryptionKeyInvalidException(f'PGP key {key_path} has fingerprint {key.fingerprint},'
+                                            f' expected {expected_fingerprint}')
+    expiries = _key_expiries(key)
+    if expiries and os.getenv('REJECT_EXPIRED_KEYS', '').lower() == 'true':
+        raise EncryptionKeyInvalidException(f'PGP key {key_path} has expired: {", ".join(expiries)}')
+    if expiries:
+        print(f'WARNING: PGP key {key_path} has expired: {", ".join(expiries)}')
+    return key
+
+
+def _key_expiries(key: pgpy.PGPKey) -> List[str]:
+    # pgpy only reads a key's expiry from its user ID self signatures, which subkeys don't have, so the encryption
+    # subkeys' expiries are read from their binding signatures
+    now = datetime.now(timezone.utc)
+    expiries = [f'primary key expired at {key.expires_at}'] if key.is_expired else []
+    for subkey in key.subkeys.values():
+        key_expirations = [binding_signature.key_expiration for binding_signature in subkey.self_signatures
+                           if binding_signature.key_flags & ENCRYPTION_KEY_FLAGS and binding_signature.key_expiration]
+        if key_expirations and subkey.created + key_expirations[-1] <= now:
+            expiries.append(f'encryption subkey {subkey.fingerprint.keyid} expired at'
+                            f' {subkey.created + key_expirations[-1]}')
+    return expiries
+
+
+def _normalise_fingerprint(fingerprint):
+    return str(fingerprint).replace(' ', '').upper()
+
+
+class EncryptingWriter(abc.ABC):
+    """
+    Interface for the encryption backends. Each one writes an OpenPGP message, encrypted to our key and the
+    supplier's key, to a binary output as the plaintext is written to it, finishing the message on close. The
+    PrintFileFormat sets whether the message is armored and how its contents are compressed.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    @abc.abstractmethod
+    def write(self, data: bytes):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def abort(self):
+        """
+        Stop encrypting without finishing the message, releasing anything the backend holds. Safe to call more
+        than once and after close.
+        """
+
+
+class PgpEncryptingWriter(EncryptingWriter):
+    """
+    Streams an OpenPGP message, encrypted to our key and the supplier's key, to a binary output as it is written.
+    The message is the same shape pgpy builds: a UTF-8 literal, compressed by default with ZIP DEFLATE, inside
+    an AES256 integrity protected packet, but each packet is written in partial body chunks so only about a
+    chunk of the message is held in memory whatever its size.
+    """
+
+    def __init__(self, output, supplier, print_file_format: PrintFileFormat = PrintFileFormat(),
+                 chunk_size=PGP_CHUNK_SIZE):
+        if chunk_size < 512 or chunk_size & (chunk_size - 1):
+            raise ValueError(f'PGP chunk size must be a power of 2 of at least 512, got {chunk_size}')
+        cipher = pgpy.constants.SymmetricKeyAlgorithm.AES256
+        sessionkey = cipher.gen_key()
+
+        output_writer = _ArmorWriter(output) if print_file_format.armored else _BinaryWriter(output)
+        output_writer.write(_create_session_key_packets(supplier, cipher, sessionkey))
+        encrypted_packet_writer = _PartialLengthPacketWriter(output_writer, SYM_ENCRYPTED_INTEGRITY_PROTECTED_DATA_TAG,
+                                                             chunk_size)
+        encrypting_writer = _EncryptingWriter(encrypted_packet_writer, bytes(sessionkey))
+
+        # do at least this as soon as possible after setting up the encryption
+        del sessionkey
+
+        if print_file_format.compression is Compression.NONE:
+            literal_sink = encrypting_writer
+        else:
+            compressed_packet_writer = _PartialLengthPacketWriter(encrypting_writer, COMPRESSED_DATA_TAG, chunk_size)
+            compressed_packet_writer.write(bytes([print_file_format.compression.value]))
+            literal_sink = _CompressingWriter(compressed_packet_writer, print_file_format.compression,
+                                              print_file_format.compression_level)
+        self._literal_packet_writer = _PartialLengthPacketWriter(literal_sink, LITERAL_DATA_TAG, chunk_size)
+        # UTF-8 text format, no filename, creation time
+        self._literal_packet_writer.write(b'u\x00' + struct.pack('>I', int(time.time())))
+
+    def write(self, data: bytes):
+        self._literal_packet_writer.write(data)
+
+    def close(self):
+        self._literal_packet_writer.close()
+
+    def abort(self):
+        # Everything is in memory, so an unfinished message only needs to be dropped
+        pass
+
+
+def _create_session_key_packets(supplier, cipher, sessionkey) -> bytes:
+    # Encrypting an empty message to each recipient with our session key gives us their public key encrypted
+    # session key packets, which are all a reader needs to decrypt the data packet we stream after them. pgpy has no
+    # public accessor for them, so pgpy is pinned in the Pipfile and a test checks the packets still come out
+    our_key, supplier_key = get_recipient_keys(supplier)
+    encrypted_message = our_key.encrypt(pgpy.PGPMessage.new(''), cipher=cipher, sessionkey=sessionkey)
+    encrypted_message = supplier_key.encrypt(encrypted_message, cipher=cipher, sessionkey=sessionkey)
+    return b''.join(bytes(session_key_packet) for session_key_packet in encrypted_message._sessionkeys)
+
+
+class GpgEncryptingWriter(EncryptingWriter):
+    """
+    Pipes the message through a local gpg binary, which compresses and encrypts it natively. gpg runs with a
+    throwaway home directory and is given the recipients' key files, so it needs no keyring set up. The literal
+    data is marked as text so readers decode it to a str just as they do the pgpy backend's output. Whether it
+    finishes or is aborted, gpg is waited for and its home directory and output copying thread are cleaned up.
+    """
+
+    GPG_COMPRESSION_ALGORITHMS = {
+        Compression.NONE: 'none',
+        Compression.ZIP: 'zip',
+        Compression.ZLIB: 'zlib',
+        Compression.BZ2: 'bzip2',
+    }
+
+    def __init__(self, output, supplier, print_file_format: PrintFileFormat = PrintFileFormat()):
+        get_recipient_keys(supplier)
+        self._output = output
+        self._gpg_home = tempfile.TemporaryDirectory()
+        self._gpg_errors = tempfile.TemporaryFile()
+        self._gpg = subprocess.Popen(
+            [GPG_BINARY, '--homedir', self._gpg_home.name, '--batch', '--no-tty', '--quiet', '--trust-model', 'always',
+             *(('--armor',) if print_file_format.armored else ()), '--textmode', '--cipher-algo', 'AES256',
+             '--compress-algo', self.GPG_COMPRESSION_ALGORITHMS[print_file_format.compression],
+             '--compress-level', str(print_file_format.compression_level),
+             '--bzip2-compress-level', str(print_file_format.compression_level),
+             '--recipient-file', os.getenv('OUR_PUBLIC_KEY_PATH'),
+             '--recipient-file', SUPPLIER_TO_KEY_PATH[supplier],
+             '--encrypt'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self._gpg_errors)
+        self._output_error = None
+        self._finished = False
+        self._output_copier = threading.Thread(target=self._copy_output, daemon=True)
+        self._output_copier.start()
+
+    def write(self, data: bytes):
+        try:
+            self._gpg.stdin.write(data)
+        except BrokenPipeError:
+            # gpg has given up, close to wait for it and raise its error
+            self.close()
+
+    def close(self):
+        if self._finished:
+            return
+        try:
+            self._close_input()
+            self._output_copier.join()
+            return_code = self._gpg.wait()
+        finally:
+            gpg_errors = self._clean_up()
+        if self._output_error:
+            raise self._output_error
+        if return_code:
+            raise EncryptionFailedException(f'gpg exited with {return_code}: {gpg_errors}')
+
+    def abort(self):
+        if self._finished:
+            return
+        try:
+            self._gpg.kill()
+            self._close_input()
+            self._output_copier.join()
+            self._gpg.wait()
+        finally:
+            self._clean_up()
+
+    def _close_input(self):
+        try:
+            self._gpg.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def _clean_up(self) -> str:
+        self._finished = True
+        self._gpg_home.cleanup()
+        self._gpg_errors.seek(0)
+        gpg_errors = self._gpg_errors.read().decode(errors='replace')
+        self._gpg_errors.close()
+        return gpg_errors
+
+    def _copy_output(self):
+        try:
+            for encrypted_chunk in iter(functools.partial(self._gpg.stdout.read, PGP_CHUNK_SIZE), b''):
+                self._output.write(encrypted_chunk)
+        except Exception as output_error:
+            # Stop gpg rather than leave it blocked on a full pipe, so the next write or close raises this error
+            self._output_error = output_error
+            self._gpg.kill()
+
+
+ENCRYPTION_BACKENDS = {
+    'pgpy': PgpEncryptingWriter,
+    'gpg': GpgEncryptingWriter,
+}
+
+
+class _PartialLengthPacketWriter:
+    """
+    Writes a packet of unknown length as a series of partial body chunks, ending with a chunk of whatever is
+    left over once the packet is closed (RFC 4880 section 4.2.2.4)
+    """
+
+    def __init__(self, sink, tag, chunk_size):
+        self._sink = sink
+        self._header = bytes([0xC0 | tag])
+        self._chunk_size = chunk_size
+        self._partial_length = bytes([0xE0 | (chunk_size.bit_length() - 1)])
+        self._buffer = bytearray()
+
+    def write(self, data: bytes):
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            self._sink.write(self._take_header() + self._partial_length + self._buffer[:self._chunk_size])
+            del self._buffer[:self._chunk_size]
+
+    def close(self):
+        self._sink.write(self._take_header() + _new_format_length(len(self._buffer)) + self._buffer)
+        self._buffer = bytearray()
+        self._sink.close()
+
+    def _take_header(self):
+        header, self._header = self._header, b''
+        return header
+
+
+def _new_format_length(length):
+    if length < 192:
+        return bytes([length])
+    if length < 8384:
+        return bytes([((length - 192) >> 8) + 192, (length - 192) & 0xFF])
+    return b'\xFF' + struct.pack('>I', length)
+
+
+class _CompressingWriter:
+
+    def __init__(self, sink, compression: Compression, compression_level: int):
+        self._sink = sink
+        if compression is Compression.BZ2:
+            self._compressor = bz2.BZ2Compressor(compression_level)
+        else:
+            # ZIP in OpenPGP is raw DEFLATE, without the zlib header and checksum that ZLIB has
+            window_bits = -zlib.MAX_WBITS if compression is Compression.ZIP else zlib.MAX_WBITS
+            self._compressor = zlib.compressobj(compression_level, zlib.DEFLATED, window_bits)
+
+    def write(self, data: bytes):
+        compressed_data = self._compressor.compress(data)
+        if compressed_data:
+            self._sink.write(compressed_data)
+
+    def close(self):
+        self._sink.write(self._compressor.flush())
+        self._sink.close()
+
+
+class _EncryptingWriter:
+    """
+    Encrypts the body of a symmetrically encrypted integrity protected data packet with AES CFB, starting with
+    the random prefix and ending with the SHA-1 modification detection code packet (RFC 4880 section 5.13)
+    """
+
+    def __init__(self, sink, sessionkey: bytes):
+        self._sink = sink
+        self._encryptor = Cipher(algorithms.AES(sessionkey), modes.CFB(bytes(AES_BLOCK_SIZE)),
+                                 backend=default_backend()).encryptor()
+        self._modification_detection_hash = hashlib.sha1()
+        # packet version
+        self._sink.write(b'\x01')
+        prefix = os.urandom(AES_BLOCK_SIZE)
+        self.write(prefix + prefix[-2:])
+
+    def write(self, data: bytes):
+        self._modification_detection_hash.update(data)
+        self._sink.write(self._encryptor.update(data))
+
+    def close(self):
+        modification_detection_code_header = b'\xD3\x14'
+        self._modification_detection_hash.update(modification_detection_code_header)
+        self._sink.write(self._encryptor.update(modification_detection_code_header
+                                                + self._modification_detection_hash.digest())
+                         + self._encryptor.finalize())
+        self._sink.close()
+
+
+class _BinaryWriter:
+
+    def __init__(self, output):
+        self._output = output
+
+    def write(self, data: bytes):
+        self._output.write(data)
+
+    def close(self):
+        pass
+
+
+class _ArmorWriter:
+    """
+    Writes the radix-64 ASCII armor as the binary message streams through, in the same layout as pgpy
+    """
+
+    LINE_BYTES = 48
+
+    def __init__(self, output):
+        self._output = output
+        self._buffer = bytearray()
+        self._crc = CRC24_INIT
+        self._output.write(b'-----BEGIN PGP MESSAGE-----\n\n')
+
+    def write(self, data: bytes):
+        self._crc = _crc24(self._crc, data)
+        self._buffer += data
+        whole_lines_length = len(self._buffer) - len(self._buffer) % self.LINE_BYTES
+        if whole_lines_length:
+            self._write_lines(self._buffer[:whole_lines_length])
+            del self._buffer[:whole_lines_length]
+
+    def close(self):
+        if self._buffer:
+            self._write_lines(self._buffer)
+        self._output.write(b'=' + base64.b64encode(self._crc.to_bytes(3, 'big')) + b'\n'
+                           + b'-----END PGP MESSAGE-----\n')
+
+    def _write_lines(self, data):
+        encoded_data = base64.b64encode(data)
+        self._output.write(b''.join(encoded_data[line_start:line_start + 64] + b'\n'
+                                    for line_start in range(0, len(encoded_data), 64)))
+
+
+CRC24_INIT = 0xB704CE
+CRC24_POLY = 0x1864CFB
+
+
+def _crc24_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= CRC24_POLY
+        table.append(crc & 0xFFFFFF)
+    return table
+
+
+CRC24_TABLE = _crc24_table()
+
+
+def _crc24(crc, data: bytes):
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFF) ^ CRC24_TABLE[(crc >> 16) ^ byte]
+    return crc
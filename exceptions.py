@@ -4,3 +4,31 @@ class QidQuantityMismatchException(Exception):
 
 class EncryptionFailedException(Exception):
     pass
+
+
+class QidRequestQuantityMismatchException(Exception):
+    pass
+
+
+class PublishJournalExistsException(Exception):
+    pass
+
+
+class EncryptionKeyInvalidException(Exception):
+    pass
+
+
+class PrintFileCheckpointExistsException(Exception):
+    pass
+
+
+class BatchSnapshotInvalidException(Exception):
+    pass
+
+
+class UploadChecksumMismatchException(Exception):
+    pass
+
+
+class BatchWaitTimeoutException(Exception):
+    pass
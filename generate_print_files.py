@@ -1,110 +1,542 @@
 import argparse
+import base64
+import collections
 import csv
+import functools
 import hashlib
-import io
+import itertools
 import json
+import multiprocessing
 import os
+import queue
+import threading
+import time
 import urllib
 import uuid
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Collection
+from typing import List, Callable, Collection, Dict, Tuple
 
 from google.cloud import storage
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 
 import sftp
-from encryption import pgp_encrypt_message
-from exceptions import QidQuantityMismatchException
+from batch_snapshot import BatchSnapshot
+from encryption import get_encryption_settings, get_recipient_keys, ENCRYPTION_BACKENDS
+from exceptions import QidQuantityMismatchException, PrintFileCheckpointExistsException, \
+    UploadChecksumMismatchException, BatchWaitTimeoutException
 from mappings import SUPPLIER_TO_SFTP_DIRECTORY, PRODUCTPACK_CODE_TO_DESCRIPTION, SUPPLIER_TO_PRINT_TEMPLATE, \
     PRODUCTPACK_CODE_TO_DATASET
+from print_file_checkpoint import PrintFileCheckpoint
+from print_file_writer import PrintFilePartsWriter, PrintFileStats
+from print_row_formatter import is_ccs_pack_code
+from rabbit_context import RabbitContext
 
 
-def _get_uac_qid_links(engine, questionnaire_type, batch_id: uuid.UUID):
-    uac_qid_links_query = text("SELECT * FROM casev2.uac_qid_link WHERE SUBSTRING(qid FROM 1 FOR 2)"
-                               " = :questionnaire_type AND caze_case_id IS NULL AND batch_id = :batch_id")
-
-    return engine.execute(uac_qid_links_query, questionnaire_type=questionnaire_type, batch_id=str(batch_id))
+DB_FETCH_SIZE = int(os.getenv('DB_FETCH_SIZE', '10000'))
+# How many fetches of each QID range partition can be read ahead of the range being written
+PARTITION_BUFFER_FETCHES = int(os.getenv('PARTITION_BUFFER_FETCHES', '4'))
+GCS_UPLOAD_WORKERS = int(os.getenv('GCS_UPLOAD_WORKERS', '8'))
+# Must be a multiple of 256 KiB
+GCS_UPLOAD_CHUNK_SIZE = int(os.getenv('GCS_UPLOAD_CHUNK_SIZE', str(16 * 1024 * 1024)))
 
 
-def create_db_engine():
+def _get_uac_qid_links(engine, questionnaire_type, batch_id: uuid.UUID):
+    # QIDs are numeric strings so a prefix LIKE selects the same rows as comparing the first two characters,
+    # but unlike SUBSTRING it can be answered by a range scan on a qid index
+    uac_qid_links_query = text("SELECT qid, uac FROM casev2.uac_qid_link WHERE qid LIKE :qid_prefix"
+                               " AND caze_case_id IS NULL AND batch_id = :batch_id")
+
+    # Stream the rows through a server side (named) cursor so they are fetched in batches of DB_FETCH_SIZE
+    # rather than the whole result set being loaded into memory before the first row is read
+    return engine.execution_options(stream_results=True, max_row_buffer=DB_FETCH_SIZE).execute(
+        uac_qid_links_query, qid_prefix=f'{questionnaire_type}%', batch_id=str(batch_id))
+
+
+def _get_uac_qid_links_in_partitions(engine, questionnaire_type, batch_id: uuid.UUID, partition_count: int):
+    """
+    Split the questionnaire type's QIDs into key ranges holding roughly equal numbers of rows and read the ranges
+    in parallel, each over its own pooled connection. Ranges are yielded in QID order, so the rows come out in the
+    same order however the reads interleave. At most DB_POOL_SIZE ranges are read at once, the next starting as
+    each finishes being yielded, and each is streamed into a buffer of at most PARTITION_BUFFER_FETCHES fetches,
+    so memory is bounded however many partitions there are.
+    """
+    boundaries = _get_qid_partition_boundaries(engine, questionnaire_type, batch_id, partition_count)
+    qid_ranges = iter(zip([None] + boundaries, boundaries + [None]))
+    max_ranges_in_flight = min(len(boundaries) + 1, int(os.getenv('DB_POOL_SIZE', '5')))
+    stop_reading = threading.Event()
+    with ThreadPoolExecutor(max_workers=max_ranges_in_flight) as executor:
+
+        def start_range_read(qid_range):
+            range_buffer = queue.Queue(maxsize=PARTITION_BUFFER_FETCHES)
+            executor.submit(_read_uac_qid_links_in_range, range_buffer, stop_reading, engine, questionnaire_type,
+                            batch_id, *qid_range)
+            return range_buffer
+
+        try:
+            range_buffers = collections.deque(start_range_read(qid_range)
+                                              for qid_range in itertools.islice(qid_ranges, max_ranges_in_flight))
+            while range_buffers:
+                for result_rows in iter(range_buffers.popleft().get, None):
+                    if isinstance(result_rows, BaseException):
+                        raise result_rows
+                    yield from result_rows
+                for qid_range in itertools.islice(qid_ranges, 1):
+                    range_buffers.append(start_range_read(qid_range))
+        finally:
+            # Let reads still in flight give up rather than wait on buffers nothing will empty
+            stop_reading.set()
+
+
+def _read_uac_qid_links_in_range(range_buffer: queue.Queue, stop_reading: threading.Event, engine,
+                                 questionnaire_type, batch_id: uuid.UUID, lower_qid=None, upper_qid=None):
+    # Puts a fetch of rows at a time on the buffer, then None once the range is finished or the error it failed with
+    try:
+        uac_qid_links = iter(_get_uac_qid_links_in_range(engine, questionnaire_type, batch_id, lower_qid, upper_qid))
+        for result_rows in iter(lambda: list(itertools.islice(uac_qid_links, DB_FETCH_SIZE)), []):
+            if not _put_unless_stopped(range_buffer, result_rows, stop_reading):
+                return
+        _put_unless_stopped(range_buffer, None, stop_reading)
+    except Exception as error:
+        _put_unless_stopped(range_buffer, error, stop_reading)
+
+
+def _put_unless_stopped(range_buffer: queue.Queue, item, stop_reading: threading.Event) -> bool:
+    while not stop_reading.is_set():
+        try:
+            range_buffer.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get_qid_partition_boundaries(engine, questionnaire_type, batch_id: uuid.UUID, partition_count: int):
+    qid_partition_boundaries_query = text(
+        "SELECT percentile_disc(CAST(:fractions AS double precision[])) WITHIN GROUP (ORDER BY qid)"
+        " FROM casev2.uac_qid_link WHERE qid LIKE :qid_prefix AND caze_case_id IS NULL AND batch_id = :batch_id")
+
+    boundaries = engine.execute(qid_partition_boundaries_query,
+                                fractions=[partition / partition_count for partition in range(1, partition_count)],
+                                qid_prefix=f'{questionnaire_type}%', batch_id=str(batch_id)).scalar()
+
+    # Small batches can give the same boundary more than once, which would only make empty ranges
+    return sorted(set(boundary for boundary in boundaries or () if boundary is not None))
+
+
+def _get_uac_qid_links_in_range(engine, questionnaire_type, batch_id: uuid.UUID, lower_qid=None, upper_qid=None):
+    range_conditions = ''.join((' AND qid >= :lower_qid' if lower_qid else '',
+                                ' AND qid < :upper_qid' if upper_qid else ''))
+    uac_qid_links_in_range_query = text("SELECT qid, uac FROM casev2.uac_qid_link WHERE qid LIKE :qid_prefix"
+                                        f" AND caze_case_id IS NULL AND batch_id = :batch_id{range_conditions}"
+                                        " ORDER BY qid")
+
+    return engine.execution_options(stream_results=True, max_row_buffer=DB_FETCH_SIZE).execute(
+        uac_qid_links_in_range_query, qid_prefix=f'{questionnaire_type}%', batch_id=str(batch_id),
+        lower_qid=lower_qid, upper_qid=upper_qid)
+
+
+def _get_batch_uac_qid_links(engine, batch_id: uuid.UUID):
+    batch_uac_qid_links_query = text("SELECT qid, uac FROM casev2.uac_qid_link"
+                                     " WHERE caze_case_id IS NULL AND batch_id = :batch_id")
+
+    return engine.execution_options(stream_results=True, max_row_buffer=DB_FETCH_SIZE).execute(
+        batch_uac_qid_links_query, batch_id=str(batch_id))
+
+
+def _copy_print_rows(engine, config_row, batch_id: uuid.UUID, supplier, output_stream):
+    """
+    Export the config row's print rows with COPY TO STDOUT, the SELECT returning every column of the supplier's
+    template in order so Postgres writes each row pipe delimited and `output_stream` receives the raw bytes
+    """
+    raw_connection = engine.raw_connection()
+    try:
+        with raw_connection.cursor() as cursor:
+            print_rows_query = cursor.mogrify(
+                f'SELECT {_print_row_columns(config_row, supplier)} FROM casev2.uac_qid_link'
+                ' WHERE qid LIKE %(qid_prefix)s AND caze_case_id IS NULL AND batch_id = %(batch_id)s',
+                {'pack_code': config_row['Pack code'], 'qid_prefix': f'{config_row["Questionnaire type"]}%',
+                 'batch_id': str(batch_id)}).decode()
+            cursor.copy_expert(f"COPY ({print_rows_query}) TO STDOUT WITH (FORMAT csv, DELIMITER '|')", output_stream)
+    finally:
+        raw_connection.close()
+
+
+def _print_row_columns(config_row, supplier):
+    # Unset columns are NULL rather than '' as COPY writes NULL as an empty unquoted field but quotes empty strings
+    column_expressions = {'UAC': 'NULL' if is_ccs_pack_code(config_row['Pack code']) else 'uac',
+                          'QUESTIONNAIRE_ID': 'qid',
+                          'PRODUCTPACK_CODE': '%(pack_code)s'}
+    return ', '.join(column_expressions.get(field_name, 'NULL') for field_name in SUPPLIER_TO_PRINT_TEMPLATE[supplier])
+
+
+def _get_uac_qid_link_counts(engine, batch_id: uuid.UUID) -> Dict[str, int]:
+    uac_qid_link_counts_query = text("SELECT SUBSTRING(qid FROM 1 FOR 2) AS questionnaire_type, COUNT(*) AS link_count"
+                                     " FROM casev2.uac_qid_link WHERE caze_case_id IS NULL AND batch_id = :batch_id"
+                                     " GROUP BY questionnaire_type")
+
+    return {row['questionnaire_type']: row['link_count']
+            for row in engine.execute(uac_qid_link_counts_query, batch_id=str(batch_id))}
+
+
+@functools.lru_cache()
+def create_db_engine(replica=False):
+    """
+    Engines are created once per process and reused, each with a connection pool sized by DB_POOL_SIZE and
+    DB_MAX_OVERFLOW. With `replica` the engine reads from DB_REPLICA_HOST when it is set.
+    """
     db_port = os.getenv('DB_PORT', '6432')
     db_name = os.getenv('DB_NAME', 'postgres')
-    db_host = os.getenv('DB_HOST', 'localhost')
+    db_host = (replica and os.getenv('DB_REPLICA_HOST')) or os.getenv('DB_HOST', 'localhost')
     db_username = os.getenv('DB_USERNAME', 'postgres')
     db_password = urllib.parse.quote_plus(os.getenv('DB_PASSWORD', 'postgres'))
     db_uri = f'postgresql://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}'
-    return create_engine(db_uri)
+    return create_engine(db_uri,
+                         pool_size=int(os.getenv('DB_POOL_SIZE', '5')),
+                         max_overflow=int(os.getenv('DB_MAX_OVERFLOW', '10')))
 
 
 def generate_print_files_from_config_file_path(config_file_path: Path,
                                                output_file_path: Path,
-                                               batch_id: uuid.UUID, supplier) -> List[Path]:
+                                               batch_id: uuid.UUID, supplier, single_scan=False,
+                                               export_engine='rows', partitions=1,
+                                               encryption_backend: str = None, workers=1,
+                                               max_rows_per_file: int = None,
+                                               checkpoint: PrintFileCheckpoint = None, resume=False,
+                                               preflight_check=False, snapshot_directory: Path = None,
+                                               on_files_generated: Callable[[List[Path]], None] = None) -> List[Path]:
     with open(config_file_path) as config_file:
-        return generate_print_files_from_config_file(config_file, output_file_path, batch_id, supplier)
+        return generate_print_files_from_config_file(
+            config_file, output_file_path, batch_id, supplier, single_scan=single_scan, export_engine=export_engine,
+            partitions=partitions, encryption_backend=encryption_backend, workers=workers,
+            max_rows_per_file=max_rows_per_file, checkpoint=checkpoint, resume=resume,
+            preflight_check=preflight_check, snapshot_directory=snapshot_directory,
+            on_files_generated=on_files_generated)
+
+
+def generate_print_files_from_config_file(config_file, output_file_path: Path, batch_id: uuid.UUID, supplier,
+                                          single_scan=False, export_engine='rows', partitions=1,
+                                          encryption_backend: str = None, workers=1,
+                                          max_rows_per_file: int = None,
+                                          checkpoint: PrintFileCheckpoint = None, resume=False,
+                                          preflight_check=False, snapshot_directory: Path = None,
+                                          on_files_generated: Callable[[List[Path]], None] = None) -> List[Path]:
+    """
+    Generate each config row's print files and manifests, returning their paths in config row order.
+    `on_files_generated` is called with each config row's paths as soon as all its files are written, so they can
+    be sent on while the next config row is generated.
+    """
+    _validate_extraction_options(single_scan, export_engine, partitions, workers, bool(snapshot_directory),
+                                 max_rows_per_file)
+    encryption_settings = get_encryption_settings(supplier, encryption_backend)
+    config_rows = list(csv.DictReader(config_file))
+    check_checkpoint_can_be_used(checkpoint, batch_id, resume)
+    row_file_paths = _get_completed_file_paths(config_rows, output_file_path, checkpoint, encryption_settings)
+    remaining_row_indexes = [row_index for row_index in range(len(config_rows)) if row_index not in row_file_paths]
+    if row_file_paths:
+        print(f'Skipping {len(row_file_paths)} config rows already completed in the checkpoint for batch {batch_id}')
+    if on_files_generated:
+        for completed_file_paths in row_file_paths.values():
+            on_files_generated(completed_file_paths)
+    remaining_config_rows = [config_rows[row_index] for row_index in remaining_row_indexes]
+    if preflight_check:
+        check_batch_quantities(create_db_engine(replica=True), remaining_config_rows, batch_id)
+    snapshot = load_batch_snapshot(snapshot_directory, batch_id) if snapshot_directory else None
+    print_files = _generate_print_files(remaining_config_rows, output_file_path, batch_id, supplier,
+                                        single_scan=single_scan, export_engine=export_engine, partitions=partitions,
+                                        encryption_backend=encryption_backend, workers=workers,
+                                        max_rows_per_file=max_rows_per_file, snapshot=snapshot)
+    for row_index, (config_row, print_file_parts) in zip(remaining_row_indexes, print_files):
+        row_file_paths[row_index] = _generate_manifest_files(output_file_path, config_row, print_file_parts)
+        if checkpoint:
+            checkpoint.record_completed(config_row, print_file_parts, encryption_settings)
+        if on_files_generated:
+            on_files_generated(row_file_paths[row_index])
+    file_paths = [file_path for row_index in range(len(config_rows)) for file_path in row_file_paths[row_index]]
+    print(f'Successfully generated {len(file_paths)} files in {output_file_path}')
+    return file_paths
 
 
-def generate_print_files_from_config_file(config_file, output_file_path: Path, batch_id: uuid.UUID, supplier) \
-        -> List[Path]:
-    config_file_reader = csv.DictReader(config_file)
-    db_engine = create_db_engine()
+def check_checkpoint_can_be_used(checkpoint: PrintFileCheckpoint, batch_id: uuid.UUID, resume=False):
+    if checkpoint and checkpoint.exists() and not resume:
+        raise PrintFileCheckpointExistsException(f'Print file checkpoint already exists for batch ID {batch_id} in '
+                                                 f'{checkpoint.batch_directory.parent}, run with --resume to generate'
+                                                 f' the remainder or --restart to discard it and start again')
+
+
+def _get_completed_file_paths(config_rows: List[dict], output_file_path: Path, checkpoint: PrintFileCheckpoint = None,
+                              encryption_settings: dict = None) -> Dict[int, List[Path]]:
+    if not checkpoint:
+        return {}
+    pack_codes = [config_row['Pack code'] for config_row in config_rows]
+    if len(set(pack_codes)) != len(pack_codes):
+        raise ValueError('Checkpointed print file generation needs a distinct pack code on every config row')
+    completed_file_paths = {row_index: checkpoint.completed_file_paths(config_row, output_file_path,
+                                                                       encryption_settings)
+                            for row_index, config_row in enumerate(config_rows)}
+    return {row_index: file_paths for row_index, file_paths in completed_file_paths.items() if file_paths}
+
+
+def _generate_print_files(config_rows: List[dict], output_file_path: Path, batch_id: uuid.UUID, supplier,
+                          single_scan=False, export_engine='rows', partitions=1, encryption_backend: str = None,
+                          workers=1, max_rows_per_file: int = None, snapshot: BatchSnapshot = None):
+    filenames = create_print_filenames(config_rows)
+    if single_scan:
+        return _generate_print_files_in_single_scan(create_db_engine(replica=True), config_rows, filenames,
+                                                    output_file_path, batch_id, supplier, encryption_backend,
+                                                    max_rows_per_file)
+    print_file_jobs = [(config_row, filename, output_file_path, batch_id, supplier, export_engine, partitions,
+                        encryption_backend, max_rows_per_file, snapshot)
+                       for config_row, filename in zip(config_rows, filenames)]
+    if workers > 1:
+        return _generate_print_files_in_workers(print_file_jobs, supplier, workers)
+    db_engine = create_db_engine(replica=True)
+    return (_generate_print_file_for_config_row(db_engine, *print_file_job) for print_file_job in print_file_jobs)
+
+
+def _generate_manifest_files(output_file_path: Path, config_row, print_file_parts) -> List[Path]:
     file_paths = []
-    for config_row in config_file_reader:
-        uac_qid_links = _get_uac_qid_links(db_engine, config_row['Questionnaire type'], batch_id)
-        filename = f'{config_row["Pack code"]}_{datetime.utcnow().strftime("%Y-%m-%dT%H-%M-%S")}'
+    for filename, print_file_stats in print_file_parts:
         print_file_path = output_file_path.joinpath(f'{filename}.csv.gpg')
-        row_count = generate_print_file(print_file_path, uac_qid_links, config_row, supplier)
-        file_paths.append(print_file_path)
         manifest_file_path = output_file_path.joinpath(f'{filename}.manifest')
-        generate_manifest_file(manifest_file_path, print_file_path, config_row['Pack code'], row_count)
-        file_paths.append(manifest_file_path)
-    print(f'Successfully generated {len(file_paths)} files in {output_file_path}')
+        generate_manifest_file(manifest_file_path, print_file_path, config_row['Pack code'],
+                               print_file_stats.row_count, print_file_stats.size_bytes, print_file_stats.md5sum)
+        file_paths.extend((print_file_path, manifest_file_path))
     return file_paths
 
 
-def generate_print_file(print_file_path: Path, uac_qid_links, config, supplier):
-    with io.StringIO() as print_file_stream:
-        csv_writer = csv.DictWriter(print_file_stream, fieldnames=SUPPLIER_TO_PRINT_TEMPLATE[supplier], delimiter='|')
-
-        row_builder = build_ccs_print_row if is_ccs_pack_code(config['Pack code']) else build_print_row
-
-        row_count = 0
-
-        for row_count, result_row in enumerate(uac_qid_links, start=1):
-            print_row = row_builder(result_row, config)
-            csv_writer.writerow(print_row)
-        if row_count != int(config["Quantity"]):
-            raise QidQuantityMismatchException(f'expected = {config["Quantity"]}, found = {row_count}, '
-                                               f'questionnaire type = {config["Questionnaire type"]}')
-        unencrypted_csv_contents = print_file_stream.getvalue()
-
-    encrypted_csv_message = pgp_encrypt_message(unencrypted_csv_contents, supplier)
-
-    with open(print_file_path, 'w') as print_file:
-        print_file.write(encrypted_csv_message)
-
-    return row_count
-
-
-def is_ccs_pack_code(pack_code):
-    return pack_code.startswith('D_CCS')
-
-
-def build_print_row(result_row, config):
-    return {'UAC': result_row['uac'], 'QUESTIONNAIRE_ID': result_row['qid'], 'PRODUCTPACK_CODE': config["Pack code"]}
-
-
-def build_ccs_print_row(result_row, config):
-    return {'QUESTIONNAIRE_ID': result_row['qid'], 'PRODUCTPACK_CODE': config["Pack code"]}
-
-
-def generate_manifest_file(manifest_file_path: Path, print_file_path: Path, productpack_code: str, row_count):
-    manifest = create_manifest(print_file_path, productpack_code, row_count)
+def _validate_extraction_options(single_scan, export_engine, partitions, workers, snapshot=False,
+                                 max_rows_per_file: int = None):
+    if (single_scan or partitions > 1) and export_engine != 'rows':
+        raise ValueError('Single scan and partitioned extraction route result rows so can only be used with the rows'
+                         ' export engine')
+    if single_scan and partitions > 1:
+        raise ValueError('Single scan extraction cannot be partitioned')
+    if single_scan and workers > 1:
+        raise ValueError('Single scan extraction reads every config row in one query so cannot use workers')
+    if snapshot and (single_scan or partitions > 1 or export_engine != 'rows'):
+        raise ValueError('A batch snapshot replaces the database reads so cannot be used with single scan, partitioned'
+                         ' or copy extraction')
+    if max_rows_per_file is not None and max_rows_per_file < 1:
+        raise ValueError(f'Max rows per file must be at least 1, got {max_rows_per_file}')
+
+
+def load_batch_snapshot(snapshot_directory: Path, batch_id: uuid.UUID) -> BatchSnapshot:
+    """
+    The batch's local snapshot, first written from one scan of the batch unless the row counts it was written with
+    still match the batch's counts in the database
+    """
+    snapshot = BatchSnapshot(snapshot_directory, batch_id)
+    db_engine = create_db_engine(replica=True)
+    if snapshot.matches(_get_uac_qid_link_counts(db_engine, batch_id)):
+        print(f'Reading batch {batch_id} from the snapshot in {snapshot.batch_directory}')
+    else:
+        print(f'Writing a snapshot of batch {batch_id} to {snapshot.batch_directory}')
+        snapshot.write(_get_batch_uac_qid_links(db_engine, batch_id))
+    return snapshot
+
+
+def _generate_print_file_for_config_row(db_engine, config_row, filename, output_file_path: Path,
+                                        batch_id: uuid.UUID, supplier, export_engine='rows', partitions=1,
+                                        encryption_backend: str = None, max_rows_per_file: int = None,
+                                        snapshot: BatchSnapshot = None):
+    print_file_writer = PrintFilePartsWriter(output_file_path, filename, config_row, supplier, encryption_backend,
+                                             max_rows_per_file)
+    if snapshot:
+        uac_qid_links = snapshot.uac_qid_links(config_row['Questionnaire type'])
+        print_file_parts = generate_print_file(print_file_writer, uac_qid_links)
+    elif export_engine == 'copy':
+        print_file_parts = generate_print_file_with_copy(print_file_writer, db_engine, config_row, batch_id, supplier)
+    elif partitions > 1:
+        uac_qid_links = _get_uac_qid_links_in_partitions(db_engine, config_row['Questionnaire type'], batch_id,
+                                                         partitions)
+        print_file_parts = generate_print_file(print_file_writer, uac_qid_links)
+    else:
+        uac_qid_links = _get_uac_qid_links(db_engine, config_row['Questionnaire type'], batch_id)
+        print_file_parts = generate_print_file(print_file_writer, uac_qid_links)
+    return config_row, print_file_parts
+
+
+def _generate_print_files_in_workers(print_file_jobs, supplier, workers):
+    """
+    Generate each config row's print file in a pool of worker processes, yielding the results in config row order.
+    Worker processes must not share the parent's database connections, so the parent's engines are dropped before
+    the pool is forked and each worker creates its own. Forking while other threads run, such as pipelined uploads,
+    can copy a lock one of them holds into the workers and deadlock them, so the workers are started from a fork
+    server instead whenever the parent has other threads.
+    """
+    print(f'Generating {len(print_file_jobs)} print files across {workers} workers')
+    create_db_engine.cache_clear()
+    start_method = 'fork' if threading.active_count() == 1 else 'forkserver'
+    with multiprocessing.get_context(start_method).Pool(workers, initializer=_init_print_file_worker,
+                                                        initargs=(supplier,)) as pool:
+        yield from pool.imap(_generate_print_file_in_worker, print_file_jobs)
+
+
+def _init_print_file_worker(supplier):
+    create_db_engine.cache_clear()
+    get_recipient_keys(supplier)
+
+
+def _generate_print_file_in_worker(print_file_job):
+    return _generate_print_file_for_config_row(create_db_engine(replica=True), *print_file_job)
+
+
+def _generate_print_files_in_single_scan(db_engine, config_rows: List[dict], filenames: List[str],
+                                         output_file_path: Path, batch_id: uuid.UUID, supplier,
+                                         encryption_backend: str = None, max_rows_per_file: int = None):
+    """
+    Read the whole batch in one query and route each row to the print file for its questionnaire type, so the
+    batch is scanned once rather than once per config row
+    """
+    questionnaire_types = [config_row['Questionnaire type'] for config_row in config_rows]
+    if len(set(questionnaire_types)) != len(questionnaire_types):
+        raise ValueError('Single scan extraction needs a distinct questionnaire type on every config row')
+
+    print_file_writers = {
+        config_row['Questionnaire type']: PrintFilePartsWriter(output_file_path, filename, config_row, supplier,
+                                                               encryption_backend, max_rows_per_file)
+        for filename, config_row in zip(filenames, config_rows)}
+
+    try:
+        for result_row in _get_batch_uac_qid_links(db_engine, batch_id):
+            print_file_writer = print_file_writers.get(result_row['qid'][:2])
+            if print_file_writer:
+                print_file_writer.write_row(result_row)
+
+        return [(config_row, print_file_writers[config_row['Questionnaire type']].close())
+                for config_row in config_rows]
+    except BaseException:
+        for print_file_writer in print_file_writers.values():
+            print_file_writer.discard()
+        raise
+
+
+def check_batch_quantities(db_engine, config_rows: List[dict], batch_id: uuid.UUID):
+    """
+    Check every config row's Quantity against one grouped count of the batch's QIDs before any print file work
+    starts, so a mismatch fails the run straight away with every mismatched row reported together
+    """
+    link_counts = _get_uac_qid_link_counts(db_engine, batch_id)
+    found_quantities = [link_counts.get(config_row['Questionnaire type'], 0) for config_row in config_rows]
+    mismatches = [f'expected = {config_row["Quantity"]}, found = {found_quantity},'
+                  f' questionnaire type = {config_row["Questionnaire type"]}'
+                  for config_row, found_quantity in zip(config_rows, found_quantities)
+                  if found_quantity != int(config_row['Quantity'])]
+    if mismatches:
+        raise QidQuantityMismatchException(f'{len(mismatches)} of {len(config_rows)} config rows do not match batch'
+                                           f' {batch_id}: ' + '; '.join(mismatches))
+    print(f'Pre-flight check passed, all {len(config_rows)} config row quantities match batch {batch_id}')
+
+
+def create_print_filenames(config_rows: List[dict]) -> List[str]:
+    """
+    Name every config row's print file up front from the one timestamp. Rows with the same pack code would clash
+    on the second resolution timestamp, so each clash is moved on a second until it is unique.
+    """
+    created = datetime.utcnow()
+    filenames = []
+    for config_row in config_rows:
+        filename_created = created
+        filename = create_print_filename(config_row, filename_created)
+        while filename in filenames:
+            filename_created += timedelta(seconds=1)
+            filename = create_print_filename(config_row, filename_created)
+        filenames.append(filename)
+    return filenames
+
+
+def create_print_filename(config_row, created: datetime = None):
+    return f'{config_row["Pack code"]}_{(created or datetime.utcnow()).strftime("%Y-%m-%dT%H-%M-%S")}'
+
+
+def wait_for_batch_from_config_file_path(config_file_path: Path, batch_id: uuid.UUID,
+                                         initial_poll_interval=5, max_poll_interval=300, timeout: float = None):
+    with open(config_file_path) as config_file:
+        wait_for_batch(list(csv.DictReader(config_file)), batch_id, initial_poll_interval, max_poll_interval,
+                       timeout)
+
+
+def wait_for_batch(config_rows: List[dict], batch_id: uuid.UUID, initial_poll_interval=5, max_poll_interval=300,
+                   timeout: float = None):
+    """
+    Poll until the QID/UAC pairs for every config row's Quantity are in the database, backing off exponentially
+    between polls. The request queue depth is reported as an indication of how much is still to be ingested. The
+    counts are read from the replica that generation reads from, so generation cannot start before it has caught up.
+    With a `timeout` in seconds, gives up once it has passed with the counts still missing.
+    """
+    db_engine = create_db_engine(replica=True)
+    poll_interval = initial_poll_interval
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    with RabbitContext() as rabbit:
+        while True:
+            link_counts = _get_uac_qid_link_counts(db_engine, batch_id)
+            incomplete_rows = [config_row for config_row in config_rows
+                               if link_counts.get(config_row['Questionnaire type'], 0) < int(config_row['Quantity'])]
+            if not incomplete_rows:
+                print(f'All QID/UAC pairs for batch {batch_id} have been ingested')
+                return
+
+            missing_quantities = [f'questionnaire type {config_row["Questionnaire type"]}: '
+                                  f'{link_counts.get(config_row["Questionnaire type"], 0)} of {config_row["Quantity"]}'
+                                  for config_row in incomplete_rows]
+            if deadline is not None and time.monotonic() >= deadline:
+                raise BatchWaitTimeoutException(f'Timed out after {timeout}s waiting for batch {batch_id}, still'
+                                                f' missing ' + '; '.join(missing_quantities))
+            if deadline is not None:
+                poll_interval = min(poll_interval, max(deadline - time.monotonic(), 0))
+            print(f'Waiting for {len(incomplete_rows)} of {len(config_rows)} questionnaire types,'
+                  f' {rabbit.get_queue_depth()} messages on {rabbit.queue_name}, checking again in {poll_interval}s')
+            for missing_quantity in missing_quantities:
+                print(f'    {missing_quantity}')
+            rabbit.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, max_poll_interval)
+
+
+def generate_print_file(print_file_writer: PrintFilePartsWriter, uac_qid_links) -> List[Tuple[str, PrintFileStats]]:
+    # Format the rows a fetch at a time rather than one by one
+    with print_file_writer:
+        uac_qid_links = iter(uac_qid_links)
+        for result_rows in iter(lambda: list(itertools.islice(uac_qid_links, DB_FETCH_SIZE)), []):
+            print_file_writer.write_rows(result_rows)
+        return print_file_writer.close()
+
+
+def generate_print_file_with_copy(print_file_writer: PrintFilePartsWriter, db_engine, config, batch_id: uuid.UUID,
+                                  supplier) -> List[Tuple[str, PrintFileStats]]:
+    with print_file_writer:
+        _copy_print_rows(db_engine, config, batch_id, supplier, CopyOutputWriter(print_file_writer))
+        return print_file_writer.close()
+
+
+class CopyOutputWriter:
+    """
+    File-like target for COPY TO STDOUT that passes the already formatted rows on to a print file writer.
+    Postgres ends CSV rows with LF, so they are converted to the CRLF the csv module writes.
+    """
+
+    def __init__(self, print_file_writer):
+        self._print_file_writer = print_file_writer
+
+    def write(self, data: bytes):
+        self._print_file_writer.write_formatted_rows(data.replace(b'\n', b'\r\n').decode(), data.count(b'\n'))
+
+
+def generate_manifest_file(manifest_file_path: Path, print_file_path: Path, productpack_code: str, row_count,
+                           size_bytes: int = None, md5sum: str = None):
+    manifest = create_manifest(print_file_path, productpack_code, row_count, size_bytes, md5sum)
     manifest_file_path.write_text(json.dumps(manifest))
 
 
-def create_manifest(print_file_path: Path, productpack_code: str, row_count) -> dict:
+def create_manifest(print_file_path: Path, productpack_code: str, row_count, size_bytes: int = None,
+                    md5sum: str = None) -> dict:
+    # The size and md5 are only read back from the file if they weren't worked out as it was written
+    if size_bytes is None:
+        size_bytes = print_file_path.stat().st_size
+    if md5sum is None:
+        md5sum = hashlib.md5(print_file_path.read_bytes()).hexdigest()
     return {
         'schemaVersion': '1',
         'description': PRODUCTPACK_CODE_TO_DESCRIPTION[productpack_code],
@@ -116,32 +548,143 @@ def create_manifest(print_file_path: Path, productpack_code: str, row_count) ->
             {
                 'name': print_file_path.name,
                 'relativePath': './',
-                'sizeBytes': str(print_file_path.stat().st_size),
-                'md5sum': hashlib.md5(print_file_path.read_text().encode()).hexdigest(),
+                'sizeBytes': str(size_bytes),
+                'md5sum': md5sum,
                 'rows': row_count
             }
         ]
     }
 
 
-def copy_files_to_gcs(file_paths: Collection[Path]):
-    client = storage.Client()
+@functools.lru_cache()
+def get_storage_client():
+    """
+    The storage client is created once per process and shared by every upload thread. When STORAGE_EMULATOR_HOST
+    is set the client talks to that local fake GCS endpoint instead, without credentials.
+    """
+    return storage.Client()
+
+
+def copy_files_to_gcs(file_paths: Collection[Path], checkpoint: PrintFileCheckpoint = None):
+    """
+    Upload the files in parallel across GCS_UPLOAD_WORKERS threads, every print file before any manifest so no
+    manifest lands in the bucket before the file it describes
+    """
+    client = get_storage_client()
     bucket = client.get_bucket(f'{client.project}-print-files')
-    print(f'Copying files to GCS bucket {bucket.name}')
-    for file_path in file_paths:
-        bucket.blob(file_path.name).upload_from_filename(filename=str(file_path))
+    file_paths = _files_not_uploaded(file_paths, 'gcs', checkpoint)
+    print(f'Copying files to GCS bucket {bucket.name} across {GCS_UPLOAD_WORKERS} threads')
+    with ThreadPoolExecutor(max_workers=GCS_UPLOAD_WORKERS) as executor:
+        for manifests in (False, True):
+            uploads = [executor.submit(upload_file_to_gcs, bucket, file_path, checkpoint)
+                       for file_path in file_paths if (file_path.suffix == '.manifest') == manifests]
+            for upload in uploads:
+                upload.result()
     print(f'All {len(file_paths)} files successfully written to {bucket.name}')
 
 
-def copy_files_to_sftp(file_paths: Collection[Path], supplier):
+def upload_file_to_gcs(bucket, file_path: Path, checkpoint: PrintFileCheckpoint = None):
+    # Files over 8 MiB are sent in a resumable session a chunk at a time, so a failed request only resends its chunk
+    blob = bucket.blob(file_path.name, chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+    expected_md5_hash = base64.b64encode(bytes.fromhex(_expected_md5sum(file_path))).decode()
+    # Sending the md5 with the upload has GCS reject the object if what it received doesn't match
+    blob.md5_hash = expected_md5_hash
+    blob.upload_from_filename(filename=str(file_path))
+    if blob.md5_hash != expected_md5_hash:
+        raise UploadChecksumMismatchException(f'{file_path.name} was uploaded to {bucket.name} with md5 '
+                                              f'{blob.md5_hash}, expected {expected_md5_hash}')
+    if checkpoint:
+        checkpoint.record_uploaded(file_path, 'gcs')
+
+
+def _expected_md5sum(file_path: Path) -> str:
+    # A print file's md5 was worked out as it was written and recorded in its manifest, so only the small manifests
+    # and any print file without one are read to hash them
+    manifest_file_path = file_path.with_suffix('').with_suffix('.manifest')
+    if file_path.suffix == '.gpg' and manifest_file_path.exists():
+        return json.loads(manifest_file_path.read_text())['files'][0]['md5sum']
+    file_md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(GCS_UPLOAD_CHUNK_SIZE), b''):
+            file_md5.update(chunk)
+    return file_md5.hexdigest()
+
+
+def copy_files_to_sftp(file_paths: Collection[Path], supplier, checkpoint: PrintFileCheckpoint = None):
     sftp_directory = SUPPLIER_TO_SFTP_DIRECTORY[supplier]
+    file_paths = _files_not_uploaded(file_paths, 'sftp', checkpoint)
     with sftp.SftpUtility(sftp_directory) as sftp_client:
         print(f'Copying files to SFTP remote {sftp_client.sftp_directory}')
         for file_path in file_paths:
             sftp_client.put_file(local_path=str(file_path), filename=file_path.name)
+            if checkpoint:
+                checkpoint.record_uploaded(file_path, 'sftp')
         print(f'All {len(file_paths)} files successfully written to {sftp_client.sftp_directory}')
 
 
+def _files_not_uploaded(file_paths: Collection[Path], destination, checkpoint: PrintFileCheckpoint = None):
+    if not checkpoint:
+        return file_paths
+    remaining_file_paths = [file_path for file_path in file_paths if not checkpoint.is_uploaded(file_path, destination)]
+    if len(remaining_file_paths) < len(file_paths):
+        print(f'Skipping {len(file_paths) - len(remaining_file_paths)} files already uploaded to {destination}')
+    return remaining_file_paths
+
+
+class UploadPipeline:
+    """
+    Uploads each config row's print files and manifests while the next config row is generated. Every destination
+    has its own queue and thread, so a slow SFTP server doesn't hold up GCS, and each group of files is uploaded
+    with every print file before any manifest. Call the pipeline with a group of file paths to queue them.
+    Leaving the context waits for the queued uploads and raises the first upload failure.
+    """
+
+    def __init__(self, supplier, gcs=True, sftp=True, checkpoint: PrintFileCheckpoint = None):
+        self._upload_queues = []
+        self._upload_threads = []
+        self._upload_errors = []
+        if gcs:
+            self._add_uploader(functools.partial(copy_files_to_gcs, checkpoint=checkpoint))
+        if sftp:
+            # A group at a time, over a new connection each time, so the SFTP server never has to keep a
+            # connection open while a long config row is generated
+            self._add_uploader(functools.partial(copy_files_to_sftp, supplier=supplier, checkpoint=checkpoint))
+
+    def __enter__(self):
+        for upload_thread in self._upload_threads:
+            upload_thread.start()
+        return self
+
+    def __call__(self, file_paths: List[Path]):
+        for upload_queue in self._upload_queues:
+            upload_queue.put(file_paths)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for upload_queue in self._upload_queues:
+            upload_queue.put(None)
+        for upload_thread in self._upload_threads:
+            upload_thread.join()
+        if self._upload_errors and not exc_type:
+            raise self._upload_errors[0]
+        # Generation's own error is the one raised, but the uploads that failed alongside it are still reported
+        for upload_error in self._upload_errors:
+            print(f'Upload failed: {upload_error!r}')
+
+    def _add_uploader(self, upload_files: Callable[[List[Path]], None]):
+        upload_queue = queue.Queue()
+        self._upload_queues.append(upload_queue)
+        self._upload_threads.append(threading.Thread(target=self._upload_queued_files,
+                                                     args=(upload_files, upload_queue), daemon=True))
+
+    def _upload_queued_files(self, upload_files: Callable[[List[Path]], None], upload_queue: queue.Queue):
+        # After a failure the rest of the queue is dropped, the files left for a --resume rerun to upload
+        try:
+            for file_paths in iter(upload_queue.get, None):
+                upload_files(file_paths)
+        except Exception as upload_error:
+            self._upload_errors.append(upload_error)
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Generate a print file from a CSV config file specifying questionnaire types and respective '
@@ -153,18 +696,94 @@ def parse_arguments():
                         type=uuid.UUID)
     parser.add_argument('--no-gcs', help="Don't copy the files to a GCS bucket", required=False, action='store_true')
     parser.add_argument('--no-sftp', help="Don't copy the files over SFTP", required=False, action='store_true')
+    parser.add_argument('--single-scan', help='Read the whole batch in one query and route the rows to each print'
+                                              ' file, instead of querying once per config row',
+                        required=False, action='store_true')
+    parser.add_argument('--export-engine', help='How print rows are read from the database: "rows" builds them from'
+                                                ' result rows, "copy" has Postgres format them with COPY TO STDOUT.'
+                                                ' Defaults to rows',
+                        choices=('rows', 'copy'), default='rows', required=False)
+    parser.add_argument('--partitions', help='Split each config row into this many QID ranges and read them in'
+                                             ' parallel over separate database connections, defaults to 1',
+                        type=int, default=1, required=False)
+    parser.add_argument('--encryption-backend', help='How the print files are encrypted: "pgpy" streams them through'
+                                                     ' pgpy keys and the cryptography package, "gpg" pipes them to'
+                                                     ' a local gpg binary. Defaults to $ENCRYPTION_BACKEND or pgpy',
+                        choices=tuple(ENCRYPTION_BACKENDS), required=False)
+    parser.add_argument('--workers', help='Generate the config rows\' print files in parallel across this many'
+                                          ' processes, defaults to 1',
+                        type=int, default=1, required=False)
+    parser.add_argument('--max-rows-per-file', help='Split each config row into numbered part files of at most this'
+                                                    ' many rows, each with its own manifest',
+                        type=positive_int, required=False)
+    parser.add_argument('--checkpoint-dir', help='Directory to record completed print files and uploads in,'
+                                                 ' defaults to print_file_checkpoints',
+                        type=Path, default=Path('print_file_checkpoints'), required=False)
+    checkpoint_group = parser.add_mutually_exclusive_group()
+    checkpoint_group.add_argument('--resume', help='Skip the print files and uploads the checkpoint for this batch ID'
+                                                   ' shows are complete',
+                                  required=False, action='store_true')
+    checkpoint_group.add_argument('--restart', help='Discard the checkpoint for this batch ID and generate and upload'
+                                                    ' every file again',
+                                  required=False, action='store_true')
+    checkpoint_group.add_argument('--no-checkpoint', help="Don't read or record a checkpoint for this run",
+                                  required=False, action='store_true')
+    parser.add_argument('--no-preflight-check', help="Don't check every config row's quantity against a count of"
+                                                     ' the batch before generating the files',
+                        required=False, action='store_true')
+    parser.add_argument('--snapshot-dir', help='Keep an encrypted local snapshot of the batch\'s QID/UAC pairs in this'
+                                               ' directory and read from it instead of the database while its row'
+                                               ' counts still match the batch. Needs SNAPSHOT_KEY',
+                        type=Path, required=False)
+    parser.add_argument('--pipeline-uploads', help='Upload each config row\'s files to GCS and SFTP while the next'
+                                                   ' config row is generated, instead of once every file is generated',
+                        required=False, action='store_true')
+    parser.add_argument('--wait-for-batch', help='Wait until every QID/UAC pair in the config has been ingested'
+                                                 ' before generating the files',
+                        required=False, action='store_true')
+    parser.add_argument('--wait-timeout', help='With --wait-for-batch, give up after this many seconds if the batch'
+                                               ' still has not been fully ingested',
+                        type=float, required=False)
     return parser.parse_args()
 
 
+def positive_int(value) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {value}')
+    return number
+
+
 def main():
     args = parse_arguments()
     print(args.config_file_path)
-    file_paths = generate_print_files_from_config_file_path(args.config_file_path, args.output_file_path, args.batch_id,
-                                                            args.supplier)
+    checkpoint = None if args.no_checkpoint else PrintFileCheckpoint(args.checkpoint_dir, args.batch_id)
+    if args.restart:
+        checkpoint.clear()
+    # Fail on a bad key or an unexpected checkpoint now rather than after waiting for the batch
+    get_recipient_keys(args.supplier)
+    check_checkpoint_can_be_used(checkpoint, args.batch_id, args.resume)
+    if args.wait_for_batch:
+        wait_for_batch_from_config_file_path(args.config_file_path, args.batch_id, timeout=args.wait_timeout)
+    if args.pipeline_uploads:
+        with UploadPipeline(args.supplier, not args.no_gcs, not args.no_sftp, checkpoint) as upload_pipeline:
+            generate_print_files_from_arguments(args, checkpoint, on_files_generated=upload_pipeline)
+        return
+    file_paths = generate_print_files_from_arguments(args, checkpoint)
     if not args.no_gcs:
-        copy_files_to_gcs(file_paths)
+        copy_files_to_gcs(file_paths, checkpoint)
     if not args.no_sftp:
-        copy_files_to_sftp(file_paths, args.supplier)
+        copy_files_to_sftp(file_paths, args.supplier, checkpoint)
+
+
+def generate_print_files_from_arguments(args, checkpoint: PrintFileCheckpoint,
+                                        on_files_generated: Callable[[List[Path]], None] = None) -> List[Path]:
+    return generate_print_files_from_config_file_path(
+        args.config_file_path, args.output_file_path, args.batch_id, args.supplier, single_scan=args.single_scan,
+        export_engine=args.export_engine, partitions=args.partitions, encryption_backend=args.encryption_backend,
+        workers=args.workers, max_rows_per_file=args.max_rows_per_file, checkpoint=checkpoint, resume=args.resume,
+        preflight_check=not args.no_preflight_check, snapshot_directory=args.snapshot_dir,
+        on_files_generated=on_files_generated)
 
 
 if __name__ == '__main__':
@@ -1,30 +1,181 @@
 import argparse
 import csv
+import itertools
 import json
+import multiprocessing
+import time
 import uuid
+from collections import Counter
 from pathlib import Path
+from typing import Iterator, List
 
+from exceptions import QidRequestQuantityMismatchException, PublishJournalExistsException
+from publish_journal import PublishJournal
+from queue_depth_throttle import QueueDepthThrottle
 from rabbit_context import RabbitContext
 
 
-def generate_messages_from_config_file_path(config_file_path: Path, batch_id: uuid.UUID):
+def generate_messages_from_config_file_path(config_file_path: Path, batch_id: uuid.UUID, workers=1,
+                                            journal_directory: Path = None, resume=False,
+                                            high_water_mark: int = None, low_water_mark: int = None,
+                                            max_chunk_size: int = None):
     with open(config_file_path) as config_file:
-        generate_messages_from_config_file(config_file, batch_id)
+        generate_messages_from_config_file(config_file, batch_id, workers, journal_directory, resume,
+                                           high_water_mark, low_water_mark, max_chunk_size)
 
 
-def generate_messages_from_config_file(config_file, batch_id: uuid.UUID):
-    config_file_reader = csv.DictReader(config_file)
+def generate_messages_from_config_file(config_file, batch_id: uuid.UUID, workers=1,
+                                       journal_directory: Path = None, resume=False,
+                                       high_water_mark: int = None, low_water_mark: int = None,
+                                       max_chunk_size: int = None):
+    config_rows = list(csv.DictReader(config_file))
+    journal = PublishJournal(journal_directory, batch_id) if journal_directory else None
+    if journal and journal.exists() and not resume:
+        raise PublishJournalExistsException(f'Publish journal already exists for batch ID {batch_id} in '
+                                            f'{journal_directory}, run with --resume to publish the remainder')
+
+    remaining_quantities = [get_remaining_quantity(row_index, row, journal)
+                            for row_index, row in enumerate(config_rows)]
+    if workers > 1:
+        generate_messages_in_shards(config_rows, remaining_quantities, batch_id, workers, journal,
+                                    high_water_mark, low_water_mark, max_chunk_size)
+        return
     with RabbitContext() as rabbit:
-        for row in config_file_reader:
-            message_count = int(row['Quantity'])
-            message_json = create_message_json(row['Questionnaire type'], batch_id)
-            print(f'Queueing {message_count} questionnaire type {row["Questionnaire type"]}')
-            for _ in range(message_count):
-                rabbit.publish_message(message_json, 'application/json')
+        throttle = QueueDepthThrottle(rabbit, high_water_mark, low_water_mark) if high_water_mark else None
+        for row_index, row in enumerate(config_rows):
+            print(f'Queueing {remaining_quantities[row_index]} questionnaire type {row["Questionnaire type"]}')
+            journal_recorder = journal.new_recorder(row_index, row['Questionnaire type']) if journal else None
+            publish_requests(rabbit, row['Questionnaire type'], batch_id, remaining_quantities[row_index],
+                             max_chunk_size, journal_recorder, throttle)
+
+
+def get_remaining_quantity(row_index, row, journal: PublishJournal) -> int:
+    if not journal:
+        return int(row['Quantity'])
+    published_count = journal.published_count(row_index, row['Questionnaire type'])
+    if published_count:
+        print(f'Journal shows {published_count} of {row["Quantity"]} questionnaire type {row["Questionnaire type"]}'
+              f' already queued')
+    return int(row['Quantity']) - published_count
+
+
+def generate_messages_in_shards(config_rows: List[dict], remaining_quantities: List[int], batch_id: uuid.UUID,
+                                workers: int, journal: PublishJournal = None,
+                                high_water_mark: int = None, low_water_mark: int = None,
+                                max_chunk_size: int = None):
+    shards = [(row_index, row['Questionnaire type'], shard_quantity, batch_id, journal, high_water_mark,
+               low_water_mark, max_chunk_size)
+              for row_index, row in enumerate(config_rows)
+              for shard_quantity in split_quantity(remaining_quantities[row_index], workers)]
+    print(f'Queueing {len(config_rows)} config rows as {len(shards)} shards across {workers} workers')
+
+    published_counts = Counter()
+    with multiprocessing.Pool(workers) as pool:
+        for row_index, questionnaire_type, published_count, elapsed_seconds in pool.imap_unordered(
+                publish_shard, shards):
+            published_counts[row_index] += published_count
+            print(f'Shard queued {published_count} questionnaire type {questionnaire_type} in {elapsed_seconds:.1f}s'
+                  f' ({published_count / max(elapsed_seconds, 0.001):.0f} pairs/s)')
+
+    for row_index, row in enumerate(config_rows):
+        if published_counts[row_index] != remaining_quantities[row_index]:
+            raise QidRequestQuantityMismatchException(f'expected = {remaining_quantities[row_index]}, '
+                                                      f'published = {published_counts[row_index]}, '
+                                                      f'questionnaire type = {row["Questionnaire type"]}')
+
+
+def publish_shard(shard):
+    (row_index, questionnaire_type, quantity, batch_id, journal, high_water_mark, low_water_mark,
+     max_chunk_size) = shard
+    journal_recorder = journal.new_recorder(row_index, questionnaire_type) if journal else None
+    start_time = time.perf_counter()
+    with RabbitContext() as rabbit:
+        throttle = QueueDepthThrottle(rabbit, high_water_mark, low_water_mark) if high_water_mark else None
+        published_count = publish_requests(rabbit, questionnaire_type, batch_id, quantity, max_chunk_size,
+                                           journal_recorder, throttle)
+    return row_index, questionnaire_type, published_count, time.perf_counter() - start_time
+
+
+def publish_requests(rabbit: RabbitContext, questionnaire_type, batch_id: uuid.UUID, quantity: int,
+                     max_chunk_size: int = None, journal_recorder=None, throttle: QueueDepthThrottle = None) -> int:
+    """
+    Publish the request messages for `quantity` pairs, returning the number of pairs requested. By default there is
+    one message per pair, with `max_chunk_size` each message carries a quantity of up to that many pairs instead.
+    The journal records pairs while the throttle counts messages.
+    """
+    if max_chunk_size is not None and max_chunk_size < 1:
+        raise ValueError(f'Max chunk size must be at least 1, got {max_chunk_size}')
+    if not max_chunk_size:
+        message_json = create_message_json(questionnaire_type, batch_id)
+        return rabbit.publish_messages(itertools.repeat(message_json, quantity), 'application/json',
+                                       on_window_confirmed=_on_window_confirmed_callback(journal_recorder, throttle))
+
+    chunk_pair_counter = ChunkPairCounter(quantity, max_chunk_size)
+    messages = (create_message_json(questionnaire_type, batch_id, chunk_quantity)
+                for chunk_quantity in split_into_chunks(quantity, max_chunk_size))
+    published_message_count = rabbit.publish_messages(
+        messages, 'application/json',
+        on_window_confirmed=_on_window_confirmed_callback(chunk_pair_counter.wrap(journal_recorder), throttle))
+    return chunk_pair_counter.pair_count(published_message_count)
+
+
+class ChunkPairCounter:
+    """
+    Converts confirmed chunk message counts into pair counts. Every chunk is full except the last, so the pairs
+    confirmed so far follow from the number of messages confirmed so far.
+    """
 
+    def __init__(self, quantity: int, max_chunk_size: int):
+        self._quantity = quantity
+        self._max_chunk_size = max_chunk_size
+        self._confirmed_message_count = 0
 
-def create_message_json(questionnaire_type, batch_id: uuid.UUID):
-    return json.dumps({'questionnaireType': questionnaire_type, 'batchId': str(batch_id)})
+    def pair_count(self, message_count: int) -> int:
+        return min(message_count * self._max_chunk_size, self._quantity)
+
+    def wrap(self, pair_callback):
+        if not pair_callback:
+            return None
+
+        def on_window_confirmed(confirmed_message_count):
+            confirmed_pairs_before = self.pair_count(self._confirmed_message_count)
+            self._confirmed_message_count += confirmed_message_count
+            pair_callback(self.pair_count(self._confirmed_message_count) - confirmed_pairs_before)
+
+        return on_window_confirmed
+
+
+def _on_window_confirmed_callback(*callbacks):
+    callbacks = [callback for callback in callbacks if callback]
+    if not callbacks:
+        return None
+
+    def on_window_confirmed(confirmed_count):
+        for callback in callbacks:
+            callback(confirmed_count)
+
+    return on_window_confirmed
+
+
+def split_quantity(quantity: int, shard_count: int) -> List[int]:
+    shard_size, remainder = divmod(quantity, shard_count)
+    shard_quantities = [shard_size + 1 if shard_index < remainder else shard_size
+                        for shard_index in range(shard_count)]
+    return [shard_quantity for shard_quantity in shard_quantities if shard_quantity]
+
+
+def split_into_chunks(quantity: int, max_chunk_size: int) -> Iterator[int]:
+    full_chunk_count, remainder = divmod(quantity, max_chunk_size)
+    yield from itertools.repeat(max_chunk_size, full_chunk_count)
+    if remainder:
+        yield remainder
+
+
+def create_message_json(questionnaire_type, batch_id: uuid.UUID, quantity: int = None):
+    message = {'questionnaireType': questionnaire_type, 'batchId': str(batch_id)}
+    if quantity is not None:
+        message['quantity'] = quantity
+    return json.dumps(message)
 
 
 def parse_arguments():
@@ -34,13 +185,39 @@ def parse_arguments():
     parser.add_argument('config_file_path', help='Path to the CSV config file', type=Path)
     parser.add_argument('--batch-id', help='UUID for this qid/uac pair batch, defaults to randomly generated',
                         type=uuid.UUID, default=uuid.uuid4(), required=False)
+    parser.add_argument('--workers', help='Number of processes to publish each config row with, each with its own'
+                                          ' rabbit connection, defaults to 1',
+                        type=int, default=1, required=False)
+    parser.add_argument('--journal-dir', help='Directory to record confirmed publish progress in, defaults to'
+                                              ' publish_journals',
+                        type=Path, default=Path('publish_journals'), required=False)
+    parser.add_argument('--resume', help='Only publish the messages the journal for this batch ID shows are missing',
+                        required=False, action='store_true')
+    parser.add_argument('--high-water-mark', help='Queue depth at which publishing pauses, defaults to no throttling',
+                        type=int, required=False)
+    parser.add_argument('--low-water-mark', help='Queue depth above which publishing is slowed down and below which'
+                                                 ' paused publishing resumes, defaults to half the high water mark',
+                        type=int, required=False)
+    parser.add_argument('--max-chunk-size', help='Request pairs in messages carrying a quantity of up to this many'
+                                                 ' pairs each, instead of one message per pair. The consuming'
+                                                 ' case-processor must support the quantity field',
+                        type=positive_int, required=False)
     return parser.parse_args()
 
 
+def positive_int(value) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {value}')
+    return number
+
+
 def main():
     args = parse_arguments()
     print(f'Using batch ID: {args.batch_id}')
-    generate_messages_from_config_file_path(args.config_file_path, args.batch_id)
+    generate_messages_from_config_file_path(args.config_file_path, args.batch_id, args.workers,
+                                            args.journal_dir, args.resume, args.high_water_mark,
+                                            args.low_water_mark, args.max_chunk_size)
     print(f'QID batch requests queued with batch ID: {args.batch_id}')
 
 
@@ -1,7 +1,7 @@
 import os
 from pathlib import Path
 
-from constants import Dataset, PrintTemplate
+from constants import Dataset, PrintTemplate, Compression, PrintFileFormat
 
 SUPPLIER_TO_SFTP_DIRECTORY = {
     'QM': os.getenv('SFTP_QM_DIRECTORY'),
@@ -16,6 +16,20 @@ SUPPLIER_TO_KEY_PATH = {
         Path(__file__).parents[0].joinpath('dummy_keys', 'supplier_PPO_dummy_public_key.asc'))
 }
 
+SUPPLIER_TO_KEY_FINGERPRINT = {
+    'QM': os.getenv('QM_PUBLIC_KEY_FINGERPRINT'),
+    'PPO': os.getenv('PPO_PUBLIC_KEY_FINGERPRINT')
+}
+
+SUPPLIER_TO_PRINT_FILE_FORMAT = {
+    'QM': PrintFileFormat(armored=os.getenv('QM_PRINT_FILE_ARMORED', 'true').lower() == 'true',
+                          compression=Compression[os.getenv('QM_PRINT_FILE_COMPRESSION', 'ZIP').upper()],
+                          compression_level=int(os.getenv('QM_PRINT_FILE_COMPRESSION_LEVEL', '6'))),
+    'PPO': PrintFileFormat(armored=os.getenv('PPO_PRINT_FILE_ARMORED', 'true').lower() == 'true',
+                           compression=Compression[os.getenv('PPO_PRINT_FILE_COMPRESSION', 'ZIP').upper()],
+                           compression_level=int(os.getenv('PPO_PRINT_FILE_COMPRESSION_LEVEL', '6')))
+}
+
 SUPPLIER_TO_PRIVATE_KEY_PATH = {
     'QM': 'dummy_keys/supplier_QM_dummy_private_key.asc',
     'PPO': 'dummy_keys/supplier_PPO_dummy_private_key.asc'
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import shutil
+import uuid
+from pathlib import Path
+from typing import List, Optional
+
+MD5_READ_SIZE = 1024 * 1024
+
+
+class PrintFileCheckpoint:
+    """
+    Records the print files and manifests each config row of a batch has finished, keyed by pack code, so an
+    interrupted run can skip them when it is rerun. A row is only recorded once all its files and manifests are
+    written, and it is only skipped on a rerun if every recorded file is still there with the recorded size and md5
+    and was encrypted with the same keys, backend and print file format.
+    Uploads are recorded per file and destination so a rerun only uploads the files that are still missing.
+    """
+
+    def __init__(self, checkpoint_directory: Path, batch_id: uuid.UUID):
+        self.batch_id = batch_id
+        self.batch_directory = checkpoint_directory.joinpath(str(batch_id))
+
+    def exists(self):
+        return self.batch_directory.exists() and any(self.batch_directory.glob('*.json'))
+
+    def clear(self):
+        if self.batch_directory.exists():
+            shutil.rmtree(self.batch_directory)
+
+    def completed_file_paths(self, config_row, output_file_path: Path,
+                             encryption_settings: dict = None) -> Optional[List[Path]]:
+        """
+        The print file and manifest paths recorded for the config row, or None if the row has not been completed,
+        its files no longer match what was recorded or they were encrypted with other `encryption_settings`
+        """
+        checkpoint_file_path = self._checkpoint_file_path(config_row['Pack code'])
+        if not checkpoint_file_path.exists():
+            return None
+        entry = json.loads(checkpoint_file_path.read_text())
+        if (entry['questionnaireType'], entry['quantity']) != (config_row['Questionnaire type'],
+                                                               int(config_row['Quantity'])):
+            return None
+        if entry.get('encryption') != encryption_settings:
+            print(f'Regenerating pack code {config_row["Pack code"]}, its checkpointed files were encrypted with'
+                  f' other keys, backend or print file format')
+            return None
+        file_paths = []
+        for recorded_file in entry['files']:
+            print_file_path = output_file_path.joinpath(recorded_file['name'])
+            manifest_file_path = output_file_path.joinpath(recorded_file['manifest'])
+            if not (manifest_file_path.exists() and _file_matches(print_file_path, recorded_file['sizeBytes'],
+                                                                  recorded_file['md5sum'])):
+                return None
+            file_paths.extend((print_file_path, manifest_file_path))
+        return file_paths
+
+    def record_completed(self, config_row, print_file_parts, encryption_settings: dict = None):
+        entry = {'batchId': str(self.batch_id), 'packCode': config_row['Pack code'],
+                 'questionnaireType': config_row['Questionnaire type'], 'quantity': int(config_row['Quantity']),
+                 'encryption': encryption_settings,
+                 'files': [{'name': f'{filename}.csv.gpg', 'manifest': f'{filename}.manifest',
+                            'rows': print_file_stats.row_count, 'sizeBytes': print_file_stats.size_bytes,
+                            'md5sum': print_file_stats.md5sum}
+                           for filename, print_file_stats in print_file_parts]}
+        self.batch_directory.mkdir(parents=True, exist_ok=True)
+        checkpoint_file_path = self._checkpoint_file_path(config_row['Pack code'])
+        partial_file_path = checkpoint_file_path.with_suffix('.partial')
+        partial_file_path.write_text(json.dumps(entry))
+        partial_file_path.replace(checkpoint_file_path)
+
+    def is_uploaded(self, file_path: Path, destination: str) -> bool:
+        return self._upload_marker_path(file_path, destination).exists()
+
+    def record_uploaded(self, file_path: Path, destination: str):
+        upload_marker_path = self._upload_marker_path(file_path, destination)
+        upload_marker_path.parent.mkdir(parents=True, exist_ok=True)
+        upload_marker_path.touch()
+
+    def _checkpoint_file_path(self, pack_code) -> Path:
+        return self.batch_directory.joinpath(f'{pack_code}.json')
+
+    def _upload_marker_path(self, file_path: Path, destination: str) -> Path:
+        return self.batch_directory.joinpath(f'uploaded_{destination}', file_path.name)
+
+
+def _file_matches(file_path: Path, size_bytes: int, md5sum: str) -> bool:
+    if not file_path.exists() or file_path.stat().st_size != size_bytes:
+        return False
+    file_md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(MD5_READ_SIZE), b''):
+            file_md5.update(chunk)
+    return file_md5.hexdigest() == md5sum
@@ -0,0 +1,186 @@
+import hashlib
+import io
+from pathlib import Path
+from typing import List, NamedTuple, Tuple
+
+from encryption import create_encrypting_writer, PGP_CHUNK_SIZE
+from exceptions import QidQuantityMismatchException
+from print_row_formatter import compile_print_row_formatter
+
+
+class PrintFileStats(NamedTuple):
+    row_count: int
+    size_bytes: int
+    md5sum: str
+
+
+class HashingFileWriter:
+    """
+    Binary file wrapper that keeps the md5 and size of everything written, so the manifest values are known as
+    soon as the file is written without reading it back
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._md5 = hashlib.md5()
+        self.size_bytes = 0
+
+    def write(self, data: bytes):
+        self._md5.update(data)
+        self.size_bytes += len(data)
+        return self._file.write(data)
+
+    @property
+    def md5sum(self):
+        return self._md5.hexdigest()
+
+
+class PrintFilePartsWriter:
+    """
+    Writes a config row's print rows to its print file or, with max_rows_per_file, to numbered part files of at most
+    that many rows each. On close the total row count is checked against the config Quantity and the filename and
+    stats of each file are returned for their manifests. Used as a context manager, every part is discarded if
+    writing fails, so no truncated print file is left behind.
+    """
+
+    def __init__(self, output_file_path: Path, filename, config, supplier, encryption_backend: str = None,
+                 max_rows_per_file: int = None):
+        if max_rows_per_file is not None and max_rows_per_file < 1:
+            raise ValueError(f'Max rows per file must be at least 1, got {max_rows_per_file}')
+        self._output_file_path = output_file_path
+        self._filename = filename
+        self._config = config
+        self._supplier = supplier
+        self._encryption_backend = encryption_backend
+        self._max_rows_per_file = max_rows_per_file
+        self._print_row_formatter = compile_print_row_formatter(supplier, config['Pack code'])
+        self._part_filename = None
+        self._part_writer = None
+        self._finished_parts = []
+        self.row_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.discard()
+
+    def write_row(self, result_row):
+        self._current_part_writer().write_row(result_row)
+        self.row_count += 1
+
+    def write_rows(self, result_rows: List):
+        self.write_formatted_rows(self._print_row_formatter.format_rows(result_rows), len(result_rows))
+
+    def write_formatted_rows(self, formatted_rows: str, row_count: int):
+        self.row_count += row_count
+        part_writer = self._current_part_writer()
+        while self._max_rows_per_file and row_count >= self._max_rows_per_file - part_writer.row_count:
+            # Fill up the current part, anything after its last row belongs to the next one
+            part_row_count = self._max_rows_per_file - part_writer.row_count
+            part_end = _index_after_row(formatted_rows, part_row_count)
+            part_writer.write_formatted_rows(formatted_rows[:part_end], part_row_count)
+            formatted_rows, row_count = formatted_rows[part_end:], row_count - part_row_count
+            if not formatted_rows:
+                return
+            part_writer = self._current_part_writer()
+        part_writer.write_formatted_rows(formatted_rows, row_count)
+
+    def close(self) -> List[Tuple[str, PrintFileStats]]:
+        if self.row_count != int(self._config["Quantity"]):
+            self.discard()
+            raise QidQuantityMismatchException(f'expected = {self._config["Quantity"]}, found = {self.row_count}, '
+                                               f'questionnaire type = {self._config["Questionnaire type"]}')
+        if self._part_writer or not self._finished_parts:
+            self._finish_part()
+        return self._finished_parts
+
+    def discard(self):
+        if self._part_writer:
+            self._part_writer.discard()
+            self._part_writer = None
+        for part_filename, _ in self._finished_parts:
+            part_file_path = self._output_file_path.joinpath(f'{part_filename}.csv.gpg')
+            if part_file_path.exists():
+                part_file_path.unlink()
+        self._finished_parts = []
+
+    def _current_part_writer(self) -> 'PrintFileWriter':
+        if self._part_writer and self._max_rows_per_file and self._part_writer.row_count >= self._max_rows_per_file:
+            self._finish_part()
+        if not self._part_writer:
+            self._start_part()
+        return self._part_writer
+
+    def _start_part(self):
+        self._part_filename = (f'{self._filename}_part{len(self._finished_parts) + 1}' if self._max_rows_per_file
+                               else self._filename)
+        self._part_writer = PrintFileWriter(self._output_file_path.joinpath(f'{self._part_filename}.csv.gpg'),
+                                            self._config, self._supplier, self._encryption_backend)
+
+    def _finish_part(self):
+        if not self._part_writer:
+            self._start_part()
+        self._finished_parts.append((self._part_filename, self._part_writer.close()))
+        self._part_writer = None
+
+
+def _index_after_row(formatted_rows: str, row_count: int):
+    row_end = -1
+    for _ in range(row_count):
+        row_end = formatted_rows.index('\n', row_end + 1)
+    return row_end + 1
+
+
+class PrintFileWriter:
+    """
+    Streams a print file into an encrypted file one result row at a time, holding back at most PGP_CHUNK_SIZE
+    characters of formatted rows, and returns the stats for its manifest on close
+    """
+
+    def __init__(self, print_file_path: Path, config, supplier, encryption_backend: str = None):
+        self.print_file_path = print_file_path
+        self._print_file = open(print_file_path, 'wb')
+        self._hashing_writer = HashingFileWriter(self._print_file)
+        try:
+            self._encrypting_writer = create_encrypting_writer(self._hashing_writer, supplier, encryption_backend)
+        except BaseException:
+            self._print_file.close()
+            self.print_file_path.unlink()
+            raise
+        self._print_file_stream = io.StringIO()
+        self._print_row_formatter = compile_print_row_formatter(supplier, config['Pack code'])
+        self.row_count = 0
+
+    def write_row(self, result_row):
+        self._print_file_stream.write(self._print_row_formatter.format_row(result_row))
+        self.row_count += 1
+        self._flush_if_full()
+
+    def write_formatted_rows(self, formatted_rows: str, row_count: int):
+        self._print_file_stream.write(formatted_rows)
+        self.row_count += row_count
+        self._flush_if_full()
+
+    def close(self) -> PrintFileStats:
+        self._flush()
+        self._encrypting_writer.close()
+        self._print_file.close()
+        return PrintFileStats(self.row_count, self._hashing_writer.size_bytes, self._hashing_writer.md5sum)
+
+    def discard(self):
+        # Stop the encryption without finishing the message, then remove whatever of it was written
+        self._encrypting_writer.abort()
+        self._print_file.close()
+        if self.print_file_path.exists():
+            self.print_file_path.unlink()
+
+    def _flush_if_full(self):
+        if self._print_file_stream.tell() >= PGP_CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self._encrypting_writer.write(self._print_file_stream.getvalue().encode())
+        self._print_file_stream.seek(0)
+        self._print_file_stream.truncate()
@@ -0,0 +1,68 @@
+import functools
+import re
+from typing import NamedTuple
+
+from mappings import SUPPLIER_TO_PRINT_TEMPLATE
+
+
+def is_ccs_pack_code(pack_code):
+    return pack_code.startswith('D_CCS')
+
+
+@functools.lru_cache()
+def compile_print_row_formatter(supplier, pack_code) -> 'PrintRowFormatter':
+    return PrintRowFormatter(supplier, pack_code)
+
+
+class PrintRowFormatter:
+    """
+    Formats print rows exactly as csv.DictWriter writes the build_print_row or build_ccs_print_row dicts. The row
+    layout is worked out once from the row builder: the blank and pack code columns are joined into the text
+    around the result row's values, so formatting a row is one string format of its uac and qid.
+    """
+
+    def __init__(self, supplier, pack_code):
+        row_builder = build_ccs_print_row if is_ccs_pack_code(pack_code) else build_print_row
+        placeholder_row = row_builder({'uac': _ResultColumn('uac'), 'qid': _ResultColumn('qid')},
+                                      {'Pack code': pack_code})
+        self._result_columns = []
+        fields = []
+        for fieldname in SUPPLIER_TO_PRINT_TEMPLATE[supplier]:
+            value = placeholder_row.get(fieldname)
+            if isinstance(value, _ResultColumn):
+                self._result_columns.append(value.column)
+                fields.append('{}')
+            else:
+                fields.append(format_csv_field(value).replace('{', '{{').replace('}', '}}'))
+        self._row_format = '|'.join(fields) + '\r\n'
+
+    def format_row(self, result_row) -> str:
+        return self._row_format.format(*[format_csv_field(result_row[column]) for column in self._result_columns])
+
+    def format_rows(self, result_rows) -> str:
+        return ''.join(map(self.format_row, result_rows))
+
+
+class _ResultColumn(NamedTuple):
+    column: str
+
+
+CSV_QUOTED_CHARACTERS = re.compile('[|"\r\n]')
+
+
+def format_csv_field(value) -> str:
+    # The csv module's default minimal quoting, for the pipe delimited print files
+    if value is None:
+        return ''
+    value = str(value)
+    if CSV_QUOTED_CHARACTERS.search(value):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def build_print_row(result_row, config):
+    return {'UAC': result_row['uac'], 'QUESTIONNAIRE_ID': result_row['qid'], 'PRODUCTPACK_CODE': config["Pack code"]}
+
+
+def build_ccs_print_row(result_row, config):
+    return {'QUESTIONNAIRE_ID': result_row['qid'], 'PRODUCTPACK_CODE': config["Pack code"]}
@@ -0,0 +1,44 @@
+import json
+import uuid
+from pathlib import Path
+
+
+class PublishJournal:
+    """
+    Records how many QID request messages the broker has confirmed for each config row of a batch so an interrupted
+    run can be resumed. Every publisher gets its own journal file, so shards in separate processes never write to the
+    same file, and the published count for a row is the sum across its files.
+    """
+
+    def __init__(self, journal_directory: Path, batch_id: uuid.UUID):
+        self.batch_id = batch_id
+        self.batch_directory = journal_directory.joinpath(str(batch_id))
+
+    def exists(self):
+        return self.batch_directory.exists() and any(self.batch_directory.glob('*.json'))
+
+    def published_count(self, row_index: int, questionnaire_type: str) -> int:
+        if not self.batch_directory.exists():
+            return 0
+        return sum(json.loads(journal_file.read_text())['published']
+                   for journal_file in self.batch_directory.glob(f'{row_index}_{questionnaire_type}_*.json'))
+
+    def new_recorder(self, row_index: int, questionnaire_type: str):
+        self.batch_directory.mkdir(parents=True, exist_ok=True)
+        return PublishJournalRecorder(
+            self.batch_directory.joinpath(f'{row_index}_{questionnaire_type}_{uuid.uuid4().hex}.json'),
+            self.batch_id, row_index, questionnaire_type)
+
+
+class PublishJournalRecorder:
+
+    def __init__(self, journal_file_path: Path, batch_id: uuid.UUID, row_index: int, questionnaire_type: str):
+        self.journal_file_path = journal_file_path
+        self._entry = {'batchId': str(batch_id), 'rowIndex': row_index, 'questionnaireType': questionnaire_type,
+                       'published': 0}
+
+    def __call__(self, confirmed_count: int):
+        self._entry['published'] += confirmed_count
+        partial_file_path = self.journal_file_path.with_suffix('.partial')
+        partial_file_path.write_text(json.dumps(self._entry))
+        partial_file_path.replace(self.journal_file_path)
@@ -0,0 +1,40 @@
+from rabbit_context import RabbitContext
+
+
+class QueueDepthThrottle:
+    """
+    Slows a bulk publisher down to roughly the rate the queue is being consumed at. Every `check_interval` confirmed
+    messages the queue depth is checked; above the low water mark publishing is delayed in proportion to how close
+    the depth is to the high water mark, and at or above the high water mark publishing pauses until the consumers
+    have brought the depth back down to the low water mark.
+    """
+
+    def __init__(self, rabbit: RabbitContext, high_water_mark: int, low_water_mark: int = None,
+                 check_interval=10000, max_delay_seconds=1.0, pause_seconds=5.0):
+        self._rabbit = rabbit
+        self._high_water_mark = high_water_mark
+        self._low_water_mark = low_water_mark if low_water_mark is not None else high_water_mark // 2
+        self._check_interval = check_interval
+        self._max_delay_seconds = max_delay_seconds
+        self._pause_seconds = pause_seconds
+        self._unchecked_count = 0
+
+    def __call__(self, confirmed_count: int):
+        self._unchecked_count += confirmed_count
+        if self._unchecked_count < self._check_interval:
+            return
+        self._unchecked_count = 0
+
+        queue_depth = self._rabbit.get_queue_depth()
+        if queue_depth >= self._high_water_mark:
+            self._pause_until_drained(queue_depth)
+        elif queue_depth > self._low_water_mark:
+            self._rabbit.sleep(self._max_delay_seconds * (queue_depth - self._low_water_mark)
+                               / (self._high_water_mark - self._low_water_mark))
+
+    def _pause_until_drained(self, queue_depth):
+        print(f'Queue depth {queue_depth} is over the high water mark {self._high_water_mark}, pausing publishing')
+        while queue_depth > self._low_water_mark:
+            self._rabbit.sleep(self._pause_seconds)
+            queue_depth = self._rabbit.get_queue_depth()
+        print(f'Queue depth {queue_depth} is back under the low water mark {self._low_water_mark}, resuming')
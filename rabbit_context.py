@@ -1,10 +1,19 @@
 import os
+import time
+from typing import Callable, Iterable
 
 import pika
+from pika.exceptions import AMQPConnectionError, ChannelWrongStateError
 from pika.spec import PERSISTENT_DELIVERY_MODE
 
+RECONNECTABLE_ERRORS = (AMQPConnectionError, ChannelWrongStateError)
 
-class RabbitContext:
+
+class BaseRabbitContext:
+    """
+    The connection settings shared by RabbitContext and AsyncRabbitContext, read from keyword arguments or the
+    environment
+    """
 
     def __init__(self, **kwargs):
         self._host = kwargs.get('host') or os.getenv('RABBITMQ_SERVICE_HOST', 'localhost')
@@ -14,6 +23,35 @@ class RabbitContext:
         self._user = kwargs.get('user') or os.getenv('RABBITMQ_USER', 'guest')
         self._password = kwargs.get('password') or os.getenv('RABBITMQ_PASSWORD', 'guest')
         self.queue_name = kwargs.get('queue_name') or os.getenv('RABBITMQ_QUEUE', 'unaddressedRequestQueue')
+        self._publish_window = int(kwargs.get('publish_window') or os.getenv('RABBITMQ_PUBLISH_WINDOW', '1000'))
+        self._heartbeat = kwargs.get('heartbeat') or os.getenv('RABBITMQ_HEARTBEAT')
+        self._blocked_connection_timeout = (kwargs.get('blocked_connection_timeout')
+                                            or os.getenv('RABBITMQ_BLOCKED_CONNECTION_TIMEOUT'))
+        self._max_retries = int(kwargs.get('max_retries') or os.getenv('RABBITMQ_MAX_RETRIES', '5'))
+        self._retry_backoff = float(kwargs.get('retry_backoff') or os.getenv('RABBITMQ_RETRY_BACKOFF', '1'))
+
+    @property
+    def channel(self):
+        return self._channel
+
+    def _connection_parameters(self):
+        optional_parameters = {}
+        if self._heartbeat:
+            optional_parameters['heartbeat'] = int(self._heartbeat)
+        if self._blocked_connection_timeout:
+            optional_parameters['blocked_connection_timeout'] = float(self._blocked_connection_timeout)
+        return pika.ConnectionParameters(self._host,
+                                         self._port,
+                                         self._vhost,
+                                         pika.PlainCredentials(self._user, self._password),
+                                         **optional_parameters)
+
+    def _check_connection_open(self):
+        if not hasattr(self, '_connection') or not self._connection.is_open:
+            raise RabbitConnectionClosedError
+
+
+class RabbitContext(BaseRabbitContext):
 
     def __enter__(self):
         self.open_connection()
@@ -22,16 +60,8 @@ class RabbitContext:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close_connection()
 
-    @property
-    def channel(self):
-        return self._channel
-
     def open_connection(self):
-        self._connection = pika.BlockingConnection(
-            pika.ConnectionParameters(self._host,
-                                      self._port,
-                                      self._vhost,
-                                      pika.PlainCredentials(self._user, self._password)))
+        self._connection = pika.BlockingConnection(self._connection_parameters())
 
         self._channel = self._connection.channel()
         if self.queue_name == 'localtest':
@@ -39,19 +69,113 @@ class RabbitContext:
 
         return self._connection
 
+    def _check_connection_open(self):
+        # A connection the broker has dropped is reopened by _retry_on_connection_loss, only a closed context is an
+        # error
+        if not hasattr(self, '_connection'):
+            raise RabbitConnectionClosedError
+
     def close_connection(self):
-        self._connection.close()
+        if self._connection.is_open:
+            self._connection.close()
         del self._channel
         del self._connection
+        if hasattr(self, '_batch_channel'):
+            del self._batch_channel
+
+    def sleep(self, seconds: float):
+        """
+        Sleep without blocking the connection's I/O loop, so heartbeats keep being sent while a caller waits. If the
+        connection is lost part way through, the rest of the sleep is spent on a new connection.
+        """
+        self._check_connection_open()
+        wake_time = time.monotonic() + seconds
+        self._retry_on_connection_loss(lambda: self._connection.sleep(max(wake_time - time.monotonic(), 0)))
 
     def publish_message(self, message: str, content_type: str):
-        if not hasattr(self, '_connection') or not self._connection.is_open:
-            raise RabbitConnectionClosedError
-        self.channel.basic_publish(
+        self._check_connection_open()
+        properties = pika.BasicProperties(content_type=content_type, delivery_mode=PERSISTENT_DELIVERY_MODE)
+        self._retry_on_connection_loss(lambda: self.channel.basic_publish(
             exchange=self._exchange,
             routing_key=self.queue_name,
             body=message,
-            properties=pika.BasicProperties(content_type=content_type, delivery_mode=PERSISTENT_DELIVERY_MODE))
+            properties=properties))
+
+    def publish_messages(self, messages: Iterable[str], content_type: str,
+                         on_window_confirmed: Callable[[int], None] = None) -> int:
+        """
+        Publish messages in windows of up to `publish_window` messages, returning once the broker has confirmed
+        every window. The blocking adapter waits for a round trip per message when publisher confirms are on, so
+        each window is published on a transactional channel and confirmed by a single commit instead.
+        `on_window_confirmed` is called with the size of each window once it has been committed.
+
+        If the connection is lost the broker discards the uncommitted window, so it is replayed in full on a new
+        connection. Only a commit confirmation lost in transit can duplicate a window.
+        """
+        self._check_connection_open()
+        properties = pika.BasicProperties(content_type=content_type, delivery_mode=PERSISTENT_DELIVERY_MODE)
+        published_count = 0
+        window = []
+        for message in messages:
+            window.append(message)
+            if len(window) == self._publish_window:
+                self._retry_on_connection_loss(lambda: self._publish_window_transaction(window, properties))
+                published_count += self._confirm_window(window, on_window_confirmed)
+                window = []
+        if window:
+            self._retry_on_connection_loss(lambda: self._publish_window_transaction(window, properties))
+            published_count += self._confirm_window(window, on_window_confirmed)
+        return published_count
+
+    def _publish_window_transaction(self, window, properties):
+        batch_channel = self._get_batch_channel()
+        for message in window:
+            batch_channel.basic_publish(
+                exchange=self._exchange,
+                routing_key=self.queue_name,
+                body=message,
+                properties=properties)
+        batch_channel.tx_commit()
+
+    @staticmethod
+    def _confirm_window(window, on_window_confirmed):
+        if on_window_confirmed:
+            on_window_confirmed(len(window))
+        return len(window)
+
+    def _retry_on_connection_loss(self, operation: Callable):
+        for attempt in range(self._max_retries + 1):
+            try:
+                if attempt or not self._connection.is_open:
+                    self._reopen_connection()
+                return operation()
+            except RECONNECTABLE_ERRORS as error:
+                if attempt == self._max_retries:
+                    raise
+                retry_delay = self._retry_backoff * 2 ** attempt
+                print(f'Lost rabbit connection ({error!r}), reconnecting in {retry_delay}s')
+                time.sleep(retry_delay)
+
+    def _reopen_connection(self):
+        if hasattr(self, '_connection') and self._connection.is_open:
+            try:
+                self._connection.close()
+            except RECONNECTABLE_ERRORS:
+                pass
+        if hasattr(self, '_batch_channel'):
+            del self._batch_channel
+        self.open_connection()
+
+    def get_queue_depth(self) -> int:
+        self._check_connection_open()
+        return self._retry_on_connection_loss(
+            lambda: self.channel.queue_declare(queue=self.queue_name, passive=True).method.message_count)
+
+    def _get_batch_channel(self):
+        if not hasattr(self, '_batch_channel'):
+            self._batch_channel = self._connection.channel()
+            self._batch_channel.tx_select()
+        return self._batch_channel
 
 
 class RabbitConnectionClosedError(Exception):
@@ -0,0 +1,215 @@
+import asyncio
+from unittest.mock import Mock, patch
+
+import pika
+import pytest
+from pika.exceptions import ChannelClosedByBroker
+
+from async_rabbit_context import AsyncRabbitContext, RabbitMessageNackedError, RabbitChannelClosedError
+from rabbit_context import RabbitConnectionClosedError, RabbitContext
+
+
+class FakeChannel:
+
+    def __init__(self, channel_number, nack_delivery_tags=(), unconfirmed_delivery_tags=()):
+        self.channel_number = channel_number
+        self.published = []
+        self._nack_delivery_tags = nack_delivery_tags
+        self._unconfirmed_delivery_tags = unconfirmed_delivery_tags
+        self._on_close_callbacks = []
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def close_by_broker(self, reply_code, reply_text):
+        for on_close_callback in self._on_close_callbacks:
+            on_close_callback(self, ChannelClosedByBroker(reply_code, reply_text))
+
+    def confirm_delivery(self, ack_nack_callback, callback):
+        self._ack_nack_callback = ack_nack_callback
+        asyncio.get_running_loop().call_soon(callback, None)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((routing_key, body))
+        delivery_tag = len(self.published)
+        if delivery_tag in self._unconfirmed_delivery_tags:
+            return
+        confirmation_method = pika.spec.Basic.Nack if delivery_tag in self._nack_delivery_tags else pika.spec.Basic.Ack
+        asyncio.get_running_loop().call_soon(self._ack_nack_callback,
+                                             pika.frame.Method(self.channel_number,
+                                                               confirmation_method(delivery_tag=delivery_tag)))
+
+    def queue_declare(self, queue, callback, passive=False):
+        self.declared_queue = queue
+        if queue == 'missing_queue':
+            asyncio.get_running_loop().call_soon(self.close_by_broker, 404, f"NOT_FOUND - no queue '{queue}'")
+            return
+        asyncio.get_running_loop().call_soon(callback, Mock(method=Mock(message_count=7)))
+
+    def basic_consume(self, queue, on_message_callback, callback):
+        self.consumed_queue = queue
+        self.on_message_callback = on_message_callback
+        asyncio.get_running_loop().call_soon(callback, None)
+        return 'test_consumer_tag'
+
+
+class FakeAsyncioConnection:
+
+    def __init__(self, parameters, on_open_callback, on_open_error_callback, on_close_callback, custom_ioloop,
+                 nack_delivery_tags=(), unconfirmed_delivery_tags=()):
+        self.is_open = True
+        self.channels = []
+        self._loop = custom_ioloop
+        self._on_close_callback = on_close_callback
+        self._nack_delivery_tags = nack_delivery_tags
+        self._unconfirmed_delivery_tags = unconfirmed_delivery_tags
+        self._loop.call_soon(on_open_callback, self)
+
+    def channel(self, on_open_callback):
+        channel = FakeChannel(len(self.channels) + 1, self._nack_delivery_tags, self._unconfirmed_delivery_tags)
+        self.channels.append(channel)
+        self._loop.call_soon(on_open_callback, channel)
+
+    def close(self):
+        self.is_open = False
+        self._loop.call_soon(self._on_close_callback, self, None)
+
+
+@patch('async_rabbit_context.AsyncioConnection', FakeAsyncioConnection)
+def test_publish_messages_pipelines_and_reports_confirmed_windows():
+    confirmed_windows = []
+
+    async def publish():
+        async with AsyncRabbitContext(queue_name='test_queue', publish_window=2) as rabbit:
+            published_count = await rabbit.publish_messages(('one', 'two', 'three'), 'text',
+                                                            on_window_confirmed=confirmed_windows.append)
+            return published_count, rabbit.channel.published
+
+    published_count, published = asyncio.run(publish())
+
+    assert published_count == 3
+    assert published == [('test_queue', 'one'), ('test_queue', 'two'), ('test_queue', 'three')]
+    assert confirmed_windows == [2, 1]
+
+
+@patch('async_rabbit_context.AsyncioConnection', FakeAsyncioConnection)
+def test_publish_messages_to_several_queues_concurrently():
+    async def publish():
+        async with AsyncRabbitContext(queue_name='test_queue') as rabbit:
+            second_channel = await rabbit.open_channel()
+            published_counts = await asyncio.gather(
+                rabbit.publish_messages(('one', 'two'), 'text'),
+                rabbit.publish_messages(('three',), 'text', channel=second_channel, queue_name='other_queue'))
+            return published_counts, rabbit.channel.published, second_channel.published
+
+    published_counts, first_published, second_published = asyncio.run(publish())
+
+    assert published_counts == [2, 1]
+    assert first_published == [('test_queue', 'one'), ('test_queue', 'two')]
+    assert second_published == [('other_queue', 'three')]
+
+
+@patch('async_rabbit_context.AsyncioConnection',
+       lambda *args, **kwargs: FakeAsyncioConnection(*args, **kwargs, nack_delivery_tags=(1,)))
+def test_nacked_publish_raises_correct_exception():
+    async def publish():
+        async with AsyncRabbitContext() as rabbit:
+            await rabbit.publish_message('This should be nacked', 'text')
+
+    with pytest.raises(RabbitMessageNackedError):
+        asyncio.run(publish())
+
+
+@patch('async_rabbit_context.AsyncioConnection',
+       lambda *args, **kwargs: FakeAsyncioConnection(*args, **kwargs, unconfirmed_delivery_tags=(2, 3)))
+def test_unconfirmed_publishes_fail_when_their_channel_closes():
+    async def publish():
+        async with AsyncRabbitContext(publish_window=3) as rabbit:
+            publishing = asyncio.ensure_future(rabbit.publish_messages(('one', 'two', 'three'), 'text'))
+            await asyncio.sleep(0)
+            rabbit.channel.close_by_broker(406, 'PRECONDITION_FAILED')
+            await asyncio.wait_for(publishing, timeout=5)
+
+    with pytest.raises(RabbitChannelClosedError, match='PRECONDITION_FAILED'):
+        asyncio.run(publish())
+
+
+@patch('async_rabbit_context.AsyncioConnection',
+       lambda *args, **kwargs: FakeAsyncioConnection(*args, **kwargs, unconfirmed_delivery_tags=(1,)))
+def test_unconfirmed_publishes_fail_when_the_connection_closes():
+    async def publish():
+        async with AsyncRabbitContext() as rabbit:
+            publishing = asyncio.ensure_future(rabbit.publish_message('This is never confirmed', 'text'))
+            await asyncio.sleep(0)
+            rabbit._connection.close()
+            await asyncio.wait_for(publishing, timeout=5)
+
+    with pytest.raises(RabbitConnectionClosedError):
+        asyncio.run(publish())
+
+
+@patch('async_rabbit_context.AsyncioConnection', FakeAsyncioConnection)
+def test_waiting_on_a_channel_fails_when_the_broker_closes_it():
+    async def get_queue_depth():
+        async with AsyncRabbitContext() as rabbit:
+            await asyncio.wait_for(rabbit.get_queue_depth('missing_queue'), timeout=5)
+
+    with pytest.raises(RabbitChannelClosedError, match='NOT_FOUND'):
+        asyncio.run(get_queue_depth())
+
+
+@patch('async_rabbit_context.AsyncioConnection', FakeAsyncioConnection)
+def test_attempt_to_publish_message_with_closed_connection_raises_correct_exception():
+    async def publish():
+        async with AsyncRabbitContext() as rabbit:
+            pass
+        await rabbit.publish_message('This should raise an exception', 'text')
+
+    with pytest.raises(RabbitConnectionClosedError):
+        asyncio.run(publish())
+
+
+@patch('async_rabbit_context.AsyncioConnection', FakeAsyncioConnection)
+def test_get_queue_depth():
+    async def get_queue_depth():
+        async with AsyncRabbitContext(queue_name='test_queue') as rabbit:
+            return await rabbit.get_queue_depth(), rabbit.channel.declared_queue
+
+    assert asyncio.run(get_queue_depth()) == (7, 'test_queue')
+
+
+@patch('async_rabbit_context.AsyncioConnection', FakeAsyncioConnection)
+def test_consume_runs_callback_coroutine_for_each_message():
+    received_messages = []
+
+    async def on_message(_channel, _method, _properties, body):
+        received_messages.append(body)
+
+    async def consume():
+        async with AsyncRabbitContext() as rabbit:
+            consumer_tag = await rabbit.consume(on_message, queue_name='test_queue')
+            rabbit.channel.on_message_callback(rabbit.channel, Mock(), Mock(), b'first')
+            rabbit.channel.on_message_callback(rabbit.channel, Mock(), Mock(), b'second')
+            return consumer_tag, rabbit.channel.consumed_queue
+
+    consumer_tag, consumed_queue = asyncio.run(consume())
+
+    assert consumer_tag == 'test_consumer_tag'
+    assert consumed_queue == 'test_queue'
+    assert received_messages == [b'first', b'second']
+
+
+def test_async_context_cannot_be_used_synchronously():
+    with pytest.raises(TypeError):
+        with AsyncRabbitContext():
+            pass
+
+
+def test_async_context_shares_only_configuration_with_the_blocking_context():
+    # When
+    rabbit = AsyncRabbitContext(host='test_host', publish_window=5)
+
+    # Then
+    assert (rabbit._host, rabbit._publish_window) == ('test_host', 5)
+    assert not isinstance(rabbit, RabbitContext)
+    assert not hasattr(rabbit, '_retry_on_connection_loss')
@@ -0,0 +1,100 @@
+import base64
+import os
+import pickle
+import uuid
+from unittest.mock import patch
+
+import pytest
+
+from batch_snapshot import BatchSnapshot
+from exceptions import BatchSnapshotInvalidException
+
+SNAPSHOT_KEY = bytes(range(32))
+
+UAC_QID_LINKS = [{'qid': f'01{row_number:014}', 'uac': f'uac_{row_number}'} for row_number in range(10)] + [
+    {'qid': '0200000000000001', 'uac': 'uac_wales'}]
+
+
+def test_snapshot_reads_back_each_questionnaire_type_over_many_chunks(cleanup_test_files):
+    # Given
+    snapshot = BatchSnapshot(cleanup_test_files, uuid.uuid4(), SNAPSHOT_KEY)
+
+    # When
+    with patch('batch_snapshot.SNAPSHOT_CHUNK_ROWS', 3):
+        row_counts = snapshot.write(UAC_QID_LINKS)
+
+    # Then
+    assert row_counts == {'01': 10, '02': 1}
+    assert list(snapshot.uac_qid_links('01')) == UAC_QID_LINKS[:10]
+    assert list(snapshot.uac_qid_links('02')) == UAC_QID_LINKS[10:]
+    assert list(snapshot.uac_qid_links('03')) == []
+
+
+def test_snapshot_is_encrypted_at_rest(cleanup_test_files):
+    # Given
+    snapshot = BatchSnapshot(cleanup_test_files, uuid.uuid4(), SNAPSHOT_KEY)
+
+    # When
+    snapshot.write(UAC_QID_LINKS)
+
+    # Then
+    snapshot_bytes = snapshot.batch_directory.joinpath('01.snapshot').read_bytes()
+    assert b'uac_1' not in snapshot_bytes and b'0100000000000001' not in snapshot_bytes
+
+
+def test_snapshot_matches_only_the_row_counts_it_was_written_with(cleanup_test_files):
+    # Given
+    snapshot = BatchSnapshot(cleanup_test_files, uuid.uuid4(), SNAPSHOT_KEY)
+    assert not snapshot.matches({'01': 10, '02': 1})
+
+    # When
+    snapshot.write(UAC_QID_LINKS)
+
+    # Then
+    assert snapshot.matches({'01': 10, '02': 1})
+    assert not snapshot.matches({'01': 10, '02': 2})
+    assert not BatchSnapshot(cleanup_test_files, uuid.uuid4(), SNAPSHOT_KEY).matches({'01': 10, '02': 1})
+
+
+def test_snapshot_read_with_the_wrong_key_raises_correct_exception(cleanup_test_files):
+    # Given
+    batch_id = uuid.uuid4()
+    BatchSnapshot(cleanup_test_files, batch_id, SNAPSHOT_KEY).write(UAC_QID_LINKS)
+
+    # Then
+    with pytest.raises(BatchSnapshotInvalidException):
+        list(BatchSnapshot(cleanup_test_files, batch_id, bytes(32)).uac_qid_links('01'))
+
+
+def test_truncated_snapshot_raises_correct_exception(cleanup_test_files):
+    # Given
+    snapshot = BatchSnapshot(cleanup_test_files, uuid.uuid4(), SNAPSHOT_KEY)
+    with patch('batch_snapshot.SNAPSHOT_CHUNK_ROWS', 3):
+        snapshot.write(UAC_QID_LINKS)
+    snapshot_file_path = snapshot.batch_directory.joinpath('01.snapshot')
+
+    # When
+    snapshot_file_path.write_bytes(snapshot_file_path.read_bytes()[:-10])
+
+    # Then
+    with pytest.raises(BatchSnapshotInvalidException):
+        list(snapshot.uac_qid_links('01'))
+
+
+def test_snapshot_key_is_read_from_the_environment(cleanup_test_files):
+    # Given
+    with patch.dict(os.environ, {'SNAPSHOT_KEY': base64.b64encode(SNAPSHOT_KEY).decode()}):
+        snapshot = BatchSnapshot(cleanup_test_files, uuid.uuid4())
+    snapshot.write(UAC_QID_LINKS)
+
+    # When
+    unpickled_snapshot = pickle.loads(pickle.dumps(snapshot))
+
+    # Then
+    assert list(unpickled_snapshot.uac_qid_links('02')) == UAC_QID_LINKS[10:]
+
+
+def test_snapshot_without_key_raises_value_error(cleanup_test_files):
+    with patch.dict(os.environ, {'SNAPSHOT_KEY': ''}):
+        with pytest.raises(ValueError):
+            BatchSnapshot(cleanup_test_files, uuid.uuid4())
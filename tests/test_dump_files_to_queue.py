@@ -12,7 +12,10 @@ def test_publish_messages_from_config_file_path(cleanup_test_files):
     with test_message_path.open('w') as fh:
         fh.writelines(test_text)
 
+    published_messages = []
     with patch('dump_files_to_queue.RabbitContext') as patch_rabbit:
+        patch_rabbit.return_value.__enter__.return_value.publish_messages.side_effect = \
+            lambda messages, _content_type: published_messages.extend(messages)
         publish_messages_from_dump_files("dummy", resource_file_path, cleanup_test_files)
 
     for file_count, file_path in enumerate(cleanup_test_files.rglob('*.dump'), 1):
@@ -22,7 +25,6 @@ def test_publish_messages_from_config_file_path(cleanup_test_files):
 
     assert file_count == 1, "should be a single *.dump file"
 
-    call_list = patch_rabbit.return_value.__enter__.return_value.publish_message.call_args_list
-    assert len(call_list) == 2
-    assert json.loads(call_list[0][0][0])['first_item'] == '1'
-    assert json.loads(call_list[1][0][0])['second_item'] == '2'
+    assert len(published_messages) == 2
+    assert json.loads(published_messages[0])['first_item'] == '1'
+    assert json.loads(published_messages[1])['second_item'] == '2'
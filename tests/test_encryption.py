@@ -0,0 +1,269 @@
+import io
+import os
+import shutil
+import struct
+from pathlib import Path
+from unittest.mock import patch, Mock
+
+import pgpy
+import pytest
+
+from constants import Compression, PrintFileFormat
+from encryption import pgp_encrypt_message, create_encrypting_writer, PgpEncryptingWriter, get_recipient_keys, \
+    load_recipient_key, _create_session_key_packets, EncryptingWriter, GpgEncryptingWriter, GPG_BINARY
+from exceptions import EncryptionFailedException, EncryptionKeyInvalidException
+
+DUMMY_KEYS_PATH = Path(__file__).parents[1].joinpath('dummy_keys')
+RESOURCE_FILE_PATH = Path(__file__).parent.joinpath('resources')
+PGP_TEST_WRITE_SIZE = 1024 * 1024
+
+
+@pytest.fixture
+def setup_gpg_test_keys():
+    # The dummy keys have expired, which gpg refuses to encrypt to, so these keys never expire
+    if not shutil.which(GPG_BINARY):
+        pytest.skip(f'{GPG_BINARY} is not installed')
+    load_recipient_key.cache_clear()
+    with patch.dict(os.environ, {'OUR_PUBLIC_KEY_PATH': str(RESOURCE_FILE_PATH.joinpath('gpg_test_our_public.asc'))}), \
+            patch.dict('encryption.SUPPLIER_TO_KEY_PATH',
+                       {'QM': str(RESOURCE_FILE_PATH.joinpath('gpg_test_supplier_public.asc'))}):
+        yield
+    load_recipient_key.cache_clear()
+
+
+@pytest.fixture
+def setup_keys():
+    load_recipient_key.cache_clear()
+    with patch.dict(os.environ, {'OUR_PUBLIC_KEY_PATH': str(DUMMY_KEYS_PATH.joinpath('our_dummy_public.asc'))}):
+        yield
+    load_recipient_key.cache_clear()
+
+
+def test_pgp_encrypt_message_can_be_decrypted_by_us_and_the_supplier(setup_keys):
+    # When
+    encrypted_message = pgpy.PGPMessage.from_blob(pgp_encrypt_message('test_uac|test_qid\r\n', 'QM', 'pgpy'))
+
+    # Then
+    assert decrypt(encrypted_message, 'our_dummy_private.asc', 'test') == 'test_uac|test_qid\r\n'
+    assert decrypt(encrypted_message, 'supplier_QM_dummy_private_key.asc', 'supplier') == 'test_uac|test_qid\r\n'
+
+
+def test_pgpy_backend_streams_a_message_over_many_chunks(setup_keys):
+    # Given
+    message = ''.join(f'uac_{row_number}|{row_number:016}\r\n' for row_number in range(5000))
+    output = io.BytesIO()
+
+    # When
+    with PgpEncryptingWriter(output, 'PPO', chunk_size=512) as encrypting_writer:
+        for row_start in range(0, len(message), 1000):
+            encrypting_writer.write(message[row_start:row_start + 1000].encode())
+
+    # Then
+    assert decrypt(pgpy.PGPMessage.from_blob(output.getvalue()), 'our_dummy_private.asc', 'test') == message
+
+
+@pytest.mark.parametrize('armored', (True, False))
+@pytest.mark.parametrize('compression', tuple(Compression))
+def test_pgpy_backend_print_file_formats_can_be_decrypted(setup_keys, armored, compression):
+    # Given
+    message = ''.join(f'uac_{row_number}|{row_number:016}\r\n' for row_number in range(1000))
+    output = io.BytesIO()
+
+    # When
+    with PgpEncryptingWriter(output, 'QM', PrintFileFormat(armored, compression, 9)) as encrypting_writer:
+        encrypting_writer.write(message.encode())
+
+    # Then
+    assert output.getvalue().startswith(b'-----BEGIN PGP MESSAGE-----') == armored
+    assert decrypt(pgpy.PGPMessage.from_blob(output.getvalue()), 'our_dummy_private.asc', 'test') == message
+
+
+def test_pgpy_backend_rejects_invalid_chunk_size(setup_keys):
+    with pytest.raises(ValueError):
+        PgpEncryptingWriter(io.BytesIO(), 'QM', chunk_size=1000)
+
+
+@patch('encryption.subprocess.Popen')
+def test_gpg_backend_pipes_message_through_gpg(patch_popen, setup_keys):
+    # Given
+    patch_popen.return_value = Mock(stdout=io.BytesIO(b'test encrypted message'))
+    patch_popen.return_value.wait.return_value = 0
+    output = io.BytesIO()
+
+    # When
+    with create_encrypting_writer(output, 'QM', 'gpg', PrintFileFormat(False, Compression.BZ2, 9)) as encrypting_writer:
+        encrypting_writer.write(b'test message')
+
+    # Then
+    gpg_arguments = patch_popen.call_args[0][0]
+    assert gpg_arguments[-1] == '--encrypt'
+    assert '--armor' not in gpg_arguments
+    assert gpg_arguments[gpg_arguments.index('--compress-algo') + 1] == 'bzip2'
+    assert os.environ['OUR_PUBLIC_KEY_PATH'] in gpg_arguments
+    patch_popen.return_value.stdin.write.assert_called_once_with(b'test message')
+    patch_popen.return_value.stdin.close.assert_called_once()
+    assert output.getvalue() == b'test encrypted message'
+
+
+@patch('encryption.subprocess.Popen')
+def test_gpg_backend_failure_raises_correct_exception(patch_popen, setup_keys):
+    # Given
+    patch_popen.return_value = Mock(stdout=io.BytesIO(b''))
+    patch_popen.return_value.wait.return_value = 2
+
+    # Then
+    with pytest.raises(EncryptionFailedException):
+        pgp_encrypt_message('test message', 'QM', 'gpg')
+
+
+@pytest.mark.parametrize('print_file_format', (PrintFileFormat(), PrintFileFormat(False, Compression.BZ2, 9),
+                                               PrintFileFormat(True, Compression.NONE)))
+def test_gpg_backend_output_can_be_decrypted_by_us_and_the_supplier(setup_gpg_test_keys, print_file_format):
+    # Given
+    message = ''.join(f'uac_{row_number}|{row_number:016}\r\n' for row_number in range(5000))
+    output = io.BytesIO()
+
+    # When
+    with GpgEncryptingWriter(output, 'QM', print_file_format) as encrypting_writer:
+        for row_start in range(0, len(message), 1000):
+            encrypting_writer.write(message[row_start:row_start + 1000].encode())
+
+    # Then
+    encrypted_message = pgpy.PGPMessage.from_blob(output.getvalue())
+    for private_key_file_name in ('gpg_test_our_private.asc', 'gpg_test_supplier_private.asc'):
+        private_key, _ = pgpy.PGPKey.from_file(RESOURCE_FILE_PATH.joinpath(private_key_file_name))
+        assert private_key.decrypt(encrypted_message).message == message
+
+
+def test_aborted_gpg_backend_stops_gpg_and_cleans_up(setup_gpg_test_keys):
+    # Given
+    encrypting_writer = GpgEncryptingWriter(io.BytesIO(), 'QM')
+    gpg_home = Path(encrypting_writer._gpg_home.name)
+
+    # When
+    with pytest.raises(ValueError):
+        with encrypting_writer:
+            encrypting_writer.write(b'test message')
+            raise ValueError('generation failed')
+
+    # Then
+    assert encrypting_writer._gpg.returncode is not None
+    assert not encrypting_writer._output_copier.is_alive()
+    assert not gpg_home.exists()
+    encrypting_writer.abort()
+    encrypting_writer.close()
+
+
+def test_gpg_backend_output_failure_is_raised_rather_than_hanging(setup_gpg_test_keys):
+    # Given
+    output = Mock(write=Mock(side_effect=OSError('No space left on device')))
+
+    # Then
+    with pytest.raises(OSError, match='No space left on device'):
+        with GpgEncryptingWriter(output, 'QM') as encrypting_writer:
+            for _ in range(100):
+                encrypting_writer.write(os.urandom(PGP_TEST_WRITE_SIZE))
+
+
+def test_encrypting_writer_backends_must_implement_every_method():
+    class IncompleteEncryptingWriter(EncryptingWriter):
+        def write(self, data: bytes):
+            pass
+
+    with pytest.raises(TypeError):
+        IncompleteEncryptingWriter()
+
+
+def test_session_key_packets_are_addressed_to_us_and_the_supplier(setup_keys):
+    # Given
+    cipher = pgpy.constants.SymmetricKeyAlgorithm.AES256
+
+    # When
+    session_key_packets = _create_session_key_packets('QM', cipher, cipher.gen_key())
+
+    # Then
+    # These are read from pgpy's private PGPMessage._sessionkeys, so this fails if a pgpy upgrade changes it
+    assert pgpy.PGPMessage.from_blob(session_key_packets).encrypters == {
+        recipient_key.subkeys[subkey_id].fingerprint.keyid
+        for recipient_key in get_recipient_keys('QM') for subkey_id in recipient_key.subkeys}
+
+
+def test_pgpy_backend_literal_packet_records_the_current_time(setup_keys):
+    # Given
+    output = io.BytesIO()
+
+    # When
+    with patch('encryption.time.time', return_value=1600000000.5):
+        with PgpEncryptingWriter(output, 'QM', PrintFileFormat(False, Compression.NONE)) as encrypting_writer:
+            encrypting_writer.write(b'test message')
+
+    # Then
+    private_key, _ = pgpy.PGPKey.from_file(DUMMY_KEYS_PATH.joinpath('our_dummy_private.asc'))
+    with private_key.unlock(passphrase='test'):
+        literal_packet = bytes(private_key.decrypt(pgpy.PGPMessage.from_blob(output.getvalue())))
+    # Packet header and length, then text format, no filename and the creation time
+    assert literal_packet[2:4] == b'u\x00'
+    assert struct.unpack('>I', literal_packet[4:8])[0] == 1600000000
+
+
+def test_recipient_keys_are_loaded_once_per_process(setup_keys):
+    # When
+    with patch('encryption.pgpy.PGPKey.from_file', wraps=pgpy.PGPKey.from_file) as patch_from_file:
+        first_keys = get_recipient_keys('PPO')
+        second_keys = get_recipient_keys('PPO')
+
+    # Then
+    assert patch_from_file.call_count == 2
+    assert first_keys[0] is second_keys[0] and first_keys[1] is second_keys[1]
+
+
+def test_recipient_key_with_expected_fingerprint_is_valid(setup_keys):
+    # When
+    key = load_recipient_key(str(DUMMY_KEYS_PATH.joinpath('supplier_PPO_dummy_public_key.asc')),
+                             '30AD 5FA2 5CF6 98F8 D2D4  2EBA 757E 56EB EED9 9098')
+
+    # Then
+    assert key.is_public
+
+
+def test_recipient_key_with_unexpected_fingerprint_raises_correct_exception(setup_keys):
+    with pytest.raises(EncryptionKeyInvalidException, match='fingerprint'):
+        load_recipient_key(str(DUMMY_KEYS_PATH.joinpath('supplier_PPO_dummy_public_key.asc')),
+                           '705E7CBB2149D70CB6202126FE04712564C3B65B')
+
+
+def test_expired_recipient_key_is_only_a_warning_by_default(setup_keys, capsys):
+    # When
+    get_recipient_keys('QM')
+
+    # Then
+    assert 'WARNING: PGP key' in capsys.readouterr().out
+
+
+def test_expired_recipient_key_raises_correct_exception_when_rejecting_expired_keys(setup_keys):
+    with patch.dict(os.environ, {'REJECT_EXPIRED_KEYS': 'true'}):
+        with pytest.raises(EncryptionKeyInvalidException, match='primary key expired'):
+            get_recipient_keys('QM')
+
+
+def test_expired_encryption_subkey_raises_correct_exception_when_rejecting_expired_keys(setup_keys):
+    with patch.dict(os.environ, {'REJECT_EXPIRED_KEYS': 'true'}):
+        with pytest.raises(EncryptionKeyInvalidException, match='encryption subkey AC4FC86F4D96F515 expired'):
+            load_recipient_key(str(Path(__file__).parent.joinpath('resources',
+                                                                  'expired_encryption_subkey_public.asc')))
+
+
+def test_missing_recipient_key_raises_correct_exception(setup_keys):
+    with pytest.raises(EncryptionKeyInvalidException):
+        load_recipient_key('not_a_real_key.asc')
+
+
+def test_unknown_encryption_backend_raises_value_error():
+    with pytest.raises(ValueError):
+        create_encrypting_writer(io.BytesIO(), 'QM', 'not_a_backend')
+
+
+def decrypt(encrypted_message, private_key_file_name, passphrase):
+    private_key, _ = pgpy.PGPKey.from_file(DUMMY_KEYS_PATH.joinpath(private_key_file_name))
+    with private_key.unlock(passphrase=passphrase):
+        return private_key.decrypt(encrypted_message).message
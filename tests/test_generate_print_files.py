@@ -1,17 +1,29 @@
+import argparse
+import base64
+import hashlib
+import io
 import json
 import os
+import threading
 import uuid
 from datetime import datetime
 from pathlib import Path
-from unittest.mock import patch, Mock, call
+from typing import List
+from unittest.mock import patch, Mock, MagicMock, call, ANY
 
 import paramiko
 import pgpy
 import pytest
 
-from exceptions import QidQuantityMismatchException
+from encryption import load_recipient_key
+from exceptions import QidQuantityMismatchException, EncryptionKeyInvalidException, \
+    PrintFileCheckpointExistsException, UploadChecksumMismatchException, BatchWaitTimeoutException
 from generate_print_files import generate_print_files_from_config_file_path, copy_files_to_gcs, copy_files_to_sftp, \
-    create_manifest
+    create_manifest, generate_print_files_from_config_file, wait_for_batch_from_config_file_path, DB_FETCH_SIZE, \
+    create_db_engine, create_print_filenames, get_storage_client, GCS_UPLOAD_CHUNK_SIZE, \
+    UploadPipeline, _generate_print_files_in_workers, positive_int, main
+from print_file_checkpoint import PrintFileCheckpoint
+from print_file_writer import PrintFileStats
 
 
 def test_generate_print_files_from_config_file_path_generates_correct_print_file_contents_for_qm(cleanup_test_files,
@@ -105,6 +117,135 @@ def test_generate_print_files_from_config_file_path_generates_correct_print_file
     assert cleanup_test_files.joinpath('D_FD_H2_2013-09-30T07-06-05.csv.gpg').exists()
 
 
+def test_generate_print_files_in_worker_processes(cleanup_test_files, mock_db_engine, setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    uac_qid_links = {
+        '01%': ({'qid': 'test_qid_1', 'uac': 'test_uac_1'}, {'qid': 'test_qid_2', 'uac': 'test_uac_2'}),
+        '02%': ({'qid': 'test_qid_3', 'uac': 'test_uac_3'},)
+    }
+    mock_db_engine.execute.side_effect = lambda _query, qid_prefix, batch_id: uac_qid_links[qid_prefix]
+
+    # When
+    file_paths = generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, uuid.uuid4(), 'QM',
+                                                            workers=2)
+
+    # Then
+    assert [(file_path.name[:len('D_FD_H1')], file_path.suffix) for file_path in file_paths] == [
+        ('D_FD_H1', '.gpg'), ('D_FD_H1', '.manifest'), ('D_FD_H2', '.gpg'), ('D_FD_H2', '.manifest')]
+    assert decrypt_print_file(cleanup_test_files, 'D_FD_H1') == ('test_uac_1|test_qid_1||||||||||||D_FD_H1||\r\n'
+                                                                 'test_uac_2|test_qid_2||||||||||||D_FD_H1||\r\n')
+    assert decrypt_print_file(cleanup_test_files, 'D_FD_H2') == 'test_uac_3|test_qid_3||||||||||||D_FD_H2||\r\n'
+    check_manifest_file_contents(cleanup_test_files, 'D_FD_H2', 'Household Questionnaire for Wales (English)',
+                                 row_count=1)
+
+
+def test_generate_print_files_splits_config_rows_into_parts_with_their_own_manifests(cleanup_test_files,
+                                                                                     mock_db_engine,
+                                                                                     setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    batch_id = uuid.uuid4()
+    mock_test_batch_results(mock_db_engine, batch_id)
+
+    # When
+    with patch('generate_print_files.datetime') as patched_datetime:
+        patched_datetime.utcnow.return_value = datetime(2013, 9, 30, 7, 6, 5)
+        file_paths = generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM',
+                                                                max_rows_per_file=1)
+
+    # Then
+    assert [file_path.name for file_path in file_paths] == [
+        'D_FD_H1_2013-09-30T07-06-05_part1.csv.gpg', 'D_FD_H1_2013-09-30T07-06-05_part1.manifest',
+        'D_FD_H1_2013-09-30T07-06-05_part2.csv.gpg', 'D_FD_H1_2013-09-30T07-06-05_part2.manifest',
+        'D_FD_H2_2013-09-30T07-06-05_part1.csv.gpg', 'D_FD_H2_2013-09-30T07-06-05_part1.manifest']
+    assert decrypt_file(file_paths[2]) == 'test_uac_2|test_qid_2||||||||||||D_FD_H1||\r\n'
+    part_2_manifest = json.loads(file_paths[3].read_text())
+    assert part_2_manifest['files'][0]['name'] == 'D_FD_H1_2013-09-30T07-06-05_part2.csv.gpg'
+    assert part_2_manifest['files'][0]['rows'] == 1
+
+
+def test_resumed_generation_skips_config_rows_completed_in_the_checkpoint(cleanup_test_files, mock_db_engine,
+                                                                          setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    batch_id = uuid.uuid4()
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), batch_id)
+    mock_test_batch_results(mock_db_engine, batch_id)
+    first_file_paths = generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM',
+                                                                  checkpoint=checkpoint)
+    for file_path in first_file_paths[2:]:
+        file_path.unlink()
+    mock_db_engine.execute.side_effect = (({'qid': 'test_qid_3', 'uac': 'test_uac_3'},),)
+
+    # When
+    resumed_file_paths = generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id,
+                                                                    'QM', checkpoint=checkpoint, resume=True)
+
+    # Then
+    assert mock_db_engine.execute.call_count == 3, 'Expected only the incomplete config row to be queried again'
+    assert resumed_file_paths[:2] == first_file_paths[:2]
+    assert [file_path.suffix for file_path in resumed_file_paths] == ['.gpg', '.manifest', '.gpg', '.manifest']
+    assert decrypt_print_file(cleanup_test_files, 'D_FD_H2') == 'test_uac_3|test_qid_3||||||||||||D_FD_H2||\r\n'
+    check_manifest_file_contents(cleanup_test_files, 'D_FD_H2', 'Household Questionnaire for Wales (English)',
+                                 row_count=1)
+
+
+def test_resumed_generation_regenerates_config_rows_encrypted_to_a_rotated_key(cleanup_test_files, mock_db_engine,
+                                                                               setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    batch_id = uuid.uuid4()
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), batch_id)
+    mock_test_batch_results(mock_db_engine, batch_id)
+    generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM',
+                                               checkpoint=checkpoint)
+    mock_db_engine.execute.reset_mock()
+    mock_test_batch_results(mock_db_engine, batch_id)
+    rotated_key_path = str(Path(__file__).parents[1].joinpath('dummy_keys', 'supplier_PPO_dummy_public_key.asc'))
+
+    # When
+    with patch.dict('mappings.SUPPLIER_TO_KEY_PATH', {'QM': rotated_key_path}):
+        load_recipient_key.cache_clear()
+        generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM',
+                                                   checkpoint=checkpoint, resume=True)
+    load_recipient_key.cache_clear()
+
+    # Then
+    assert mock_db_engine.execute.call_count == 2, 'Expected every config row to be generated again'
+    rotated_key, _ = pgpy.PGPKey.from_file(rotated_key_path)
+    recorded_settings = json.loads(checkpoint.batch_directory.joinpath('D_FD_H1.json').read_text())['encryption']
+    assert recorded_settings['keyFingerprints'][1] == str(rotated_key.fingerprint)
+
+
+def test_generation_with_existing_checkpoint_must_be_resumed(cleanup_test_files, mock_db_engine, setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    batch_id = uuid.uuid4()
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), batch_id)
+    mock_test_batch_results(mock_db_engine, batch_id)
+    generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM',
+                                               checkpoint=checkpoint)
+
+    # Then
+    with pytest.raises(PrintFileCheckpointExistsException):
+        generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM',
+                                                   checkpoint=checkpoint)
+
+
+def test_create_print_filenames_moves_clashing_filenames_on_a_second():
+    # Given
+    config_rows = [{'Pack code': 'D_FD_H1'}, {'Pack code': 'D_FD_H2'}, {'Pack code': 'D_FD_H1'}]
+
+    # When
+    with patch('generate_print_files.datetime') as patched_datetime:
+        patched_datetime.utcnow.return_value = datetime(2013, 9, 30, 7, 6, 59)
+        filenames = create_print_filenames(config_rows)
+
+    # Then
+    assert filenames == ['D_FD_H1_2013-09-30T07-06-59', 'D_FD_H2_2013-09-30T07-06-59', 'D_FD_H1_2013-09-30T07-07-00']
+
+
 def test_generate_print_files_from_config_file_path_errors_on_qid_quantity_mismatch(cleanup_test_files,
                                                                                     mock_db_engine,
                                                                                     setup_environment):
@@ -119,6 +260,175 @@ def test_generate_print_files_from_config_file_path_errors_on_qid_quantity_misma
     # Then
     with pytest.raises(QidQuantityMismatchException, match='expected = 10, found = 2, questionnaire type = 01'):
         generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM')
+    assert not list(cleanup_test_files.glob('D_FD_H1*.csv.gpg'))
+
+
+def test_preflight_check_reports_every_quantity_mismatch_before_generating(cleanup_test_files, mock_db_engine,
+                                                                           setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch_ce_ppo.csv')
+    mock_db_engine.execute.return_value = ({'questionnaire_type': '01', 'link_count': 3},)
+
+    # When
+    with pytest.raises(QidQuantityMismatchException) as mismatch:
+        generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, uuid.uuid4(), 'PPO',
+                                                   preflight_check=True)
+
+    # Then
+    assert 'expected = 2, found = 3, questionnaire type = 01' in str(mismatch.value)
+    assert 'expected = 1, found = 0, questionnaire type = 02' in str(mismatch.value)
+    assert mock_db_engine.execute.call_count == 1, 'Expected only the grouped count query'
+    assert not list(cleanup_test_files.iterdir())
+
+
+def test_preflight_check_passes_matching_quantities(cleanup_test_files, mock_db_engine, setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    batch_id = uuid.uuid4()
+    mock_db_engine.execute.side_effect = (
+        ({'questionnaire_type': '01', 'link_count': 2}, {'questionnaire_type': '02', 'link_count': 1}),
+        ({'qid': 'test_qid_1', 'uac': 'test_uac_1'}, {'qid': 'test_qid_2', 'uac': 'test_uac_2'}),
+        ({'qid': 'test_qid_3', 'uac': 'test_uac_3'},))
+
+    # When
+    file_paths = generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM',
+                                                            preflight_check=True)
+
+    # Then
+    assert len(file_paths) == 4
+    assert 'GROUP BY' in str(mock_db_engine.execute.call_args_list[0][0][0])
+    check_manifest_file_contents(cleanup_test_files, 'D_FD_H1', 'Household Questionnaire for England', row_count=2)
+
+
+def test_generate_print_files_reads_from_snapshot_while_row_counts_match(cleanup_test_files, mock_db_engine,
+                                                                         setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    snapshot_directory = cleanup_test_files.joinpath('snapshots')
+    batch_id = uuid.uuid4()
+    link_counts = ({'questionnaire_type': '01', 'link_count': 2}, {'questionnaire_type': '02', 'link_count': 1})
+    mock_db_engine.execute.side_effect = (
+        link_counts,
+        ({'qid': '0100000000000001', 'uac': 'test_uac_1'}, {'qid': '0100000000000002', 'uac': 'test_uac_2'},
+         {'qid': '0200000000000003', 'uac': 'test_uac_3'}),
+        link_counts)
+
+    output_file_paths = (cleanup_test_files.joinpath('first'), cleanup_test_files.joinpath('second'))
+
+    # When
+    with patch.dict(os.environ, {'SNAPSHOT_KEY': base64.b64encode(bytes(32)).decode()}):
+        for output_file_path in output_file_paths:
+            output_file_path.mkdir()
+            generate_print_files_from_config_file_path(config_file_path, output_file_path, batch_id, 'QM',
+                                                       snapshot_directory=snapshot_directory)
+
+    # Then
+    assert mock_db_engine.execute.call_count == 3, 'Expected the second run to only count the batch'
+    for output_file_path in output_file_paths:
+        assert decrypt_print_file(output_file_path, 'D_FD_H1') == (
+            'test_uac_1|0100000000000001||||||||||||D_FD_H1||\r\n'
+            'test_uac_2|0100000000000002||||||||||||D_FD_H1||\r\n')
+        assert decrypt_print_file(output_file_path, 'D_FD_H2') == (
+            'test_uac_3|0200000000000003||||||||||||D_FD_H2||\r\n')
+
+
+def test_generate_print_files_streams_print_files_over_many_chunks(cleanup_test_files, mock_db_engine,
+                                                                   setup_environment):
+    # Given
+    config_file = io.StringIO('Questionnaire type,Quantity,Pack code\n01,20000,D_FD_H1\n')
+    batch_id = uuid.uuid4()
+    mock_db_engine.execute.return_value = ({'qid': f'01{row_number:014}', 'uac': f'uac_{row_number}'}
+                                           for row_number in range(20000))
+
+    # When
+    generate_print_files_from_config_file(config_file, cleanup_test_files, batch_id, 'QM')
+
+    # Then
+    print_file_lines = decrypt_print_file(cleanup_test_files, 'D_FD_H1').splitlines()
+    assert len(print_file_lines) == 20000
+    assert print_file_lines[0] == 'uac_0|0100000000000000||||||||||||D_FD_H1||'
+    assert print_file_lines[-1] == 'uac_19999|0100000000019999||||||||||||D_FD_H1||'
+
+
+def test_generate_print_files_removes_partial_print_files_when_the_query_fails(cleanup_test_files, mock_db_engine,
+                                                                               setup_environment):
+    # Given
+    config_file = io.StringIO('Questionnaire type,Quantity,Pack code\n01,20000,D_FD_H1\n')
+
+    def uac_qid_links_then_connection_lost():
+        for row_number in range(DB_FETCH_SIZE + 1):
+            yield {'qid': f'01{row_number:014}', 'uac': f'uac_{row_number}'}
+        raise ConnectionError('server closed the connection unexpectedly')
+
+    mock_db_engine.execute.return_value = uac_qid_links_then_connection_lost()
+
+    # When
+    with pytest.raises(ConnectionError):
+        generate_print_files_from_config_file(config_file, cleanup_test_files, uuid.uuid4(), 'QM',
+                                              max_rows_per_file=DB_FETCH_SIZE // 2)
+
+    # Then
+    assert not list(cleanup_test_files.glob('*.csv.gpg'))
+
+
+def test_generate_print_files_encrypts_with_the_chosen_backend(cleanup_test_files, mock_db_engine, setup_environment):
+    # Given
+    config_file = io.StringIO('Questionnaire type,Quantity,Pack code\n01,1,D_FD_H1\n')
+    mock_db_engine.execute.return_value = ({'qid': 'test_qid_1', 'uac': 'test_uac_1'},)
+
+    # When
+    with patch('print_file_writer.create_encrypting_writer') as patch_create_encrypting_writer:
+        generate_print_files_from_config_file(config_file, cleanup_test_files, uuid.uuid4(), 'QM',
+                                              encryption_backend='gpg')
+
+    # Then
+    assert patch_create_encrypting_writer.call_args[0][1:] == ('QM', 'gpg')
+    patch_create_encrypting_writer.return_value.write.assert_called_once_with(
+        b'test_uac_1|test_qid_1||||||||||||D_FD_H1||\r\n')
+    patch_create_encrypting_writer.return_value.close.assert_called_once()
+
+
+def test_generate_print_files_fails_on_invalid_key_before_querying(cleanup_test_files, mock_db_engine,
+                                                                   setup_environment):
+    # Given
+    config_file = io.StringIO('Questionnaire type,Quantity,Pack code\n01,1,D_FD_H1\n')
+
+    # When
+    with patch.dict(os.environ, {'OUR_PUBLIC_KEY_FINGERPRINT': 'not the right fingerprint'}):
+        with pytest.raises(EncryptionKeyInvalidException):
+            generate_print_files_from_config_file(config_file, cleanup_test_files, uuid.uuid4(), 'QM')
+
+    # Then
+    mock_db_engine.execute.assert_not_called()
+    assert not list(cleanup_test_files.glob('*.csv.gpg'))
+
+
+@pytest.mark.parametrize('max_rows_per_file', (0, -1))
+def test_generate_print_files_rejects_max_rows_per_file_below_one_before_querying(cleanup_test_files, mock_db_engine,
+                                                                                  setup_environment,
+                                                                                  max_rows_per_file):
+    # Given
+    config_file = io.StringIO('Questionnaire type,Quantity,Pack code\n01,3,D_FD_H1\n')
+
+    # When
+    with pytest.raises(ValueError, match='Max rows per file must be at least 1'):
+        generate_print_files_from_config_file(config_file, cleanup_test_files, uuid.uuid4(), 'QM',
+                                              max_rows_per_file=max_rows_per_file)
+
+    # Then
+    mock_db_engine.execute.assert_not_called()
+    assert not list(cleanup_test_files.glob('*.csv.gpg'))
+
+
+@pytest.mark.parametrize('value', ('0', '-1', 'ten'))
+def test_positive_int_rejects_values_below_one(value):
+    with pytest.raises((argparse.ArgumentTypeError, ValueError)):
+        positive_int(value)
+
+
+def test_positive_int_accepts_values_of_one_or_more():
+    assert positive_int('1') == 1
+    assert positive_int('5000') == 5000
 
 
 def test_generate_print_files_from_config_file_path_generates_correct_manifests(cleanup_test_files,
@@ -145,26 +455,189 @@ def check_manifest_file_contents(cleanup_test_files, pack_code, description, row
     manifest = json.loads(manifest_file.read_text())
     assert manifest['description'] == description
     assert manifest['files'][0]['sizeBytes'] == str(print_file.stat().st_size)
+    assert manifest['files'][0]['md5sum'] == hashlib.md5(print_file.read_bytes()).hexdigest()
     assert manifest['files'][0]['name'] == f'{manifest_file.stem}.csv.gpg'
     assert manifest['files'][0]['relativePath'].startswith('./')
     assert manifest['sourceName'] == 'ONS_RM'
     assert manifest['files'][0]['rows'] == row_count
 
 
-def test_copy_files_to_gcs():
+def test_copy_files_to_gcs_uploads_every_print_file_before_any_manifest(cleanup_test_files, mock_storage_bucket):
     # Given
-    test_files = [Path('test1'), Path('test2'), Path('test3')]
-    mock_storage_client = Mock()
+    test_files = write_test_files(cleanup_test_files, 'test1.csv.gpg', 'test1.manifest', 'test2.csv.gpg',
+                                  'test2.manifest')
 
     # When
-    with patch('generate_print_files.storage') as patched_storage:
-        patched_storage.Client.return_value = mock_storage_client
+    copy_files_to_gcs(test_files)
+
+    # Then
+    uploaded_file_names = [blob.name for blob in mock_storage_bucket.uploaded_blobs]
+    assert sorted(uploaded_file_names[:2]) == ['test1.csv.gpg', 'test2.csv.gpg']
+    assert sorted(uploaded_file_names[2:]) == ['test1.manifest', 'test2.manifest']
+    mock_storage_bucket.blob.assert_called_with(ANY, chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+
+
+def test_copy_files_to_gcs_skips_files_already_uploaded(cleanup_test_files, mock_storage_bucket):
+    # Given
+    test_files = write_test_files(cleanup_test_files, 'test1.csv.gpg', 'test2.csv.gpg', 'test3.csv.gpg')
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), uuid.uuid4())
+    checkpoint.record_uploaded(test_files[0], 'gcs')
+
+    # When
+    copy_files_to_gcs(test_files, checkpoint)
+
+    # Then
+    assert sorted(blob.name for blob in mock_storage_bucket.uploaded_blobs) == ['test2.csv.gpg', 'test3.csv.gpg']
+    assert all(checkpoint.is_uploaded(file_path, 'gcs') for file_path in test_files)
+
+
+def test_copy_files_to_gcs_raises_correct_exception_on_md5_mismatch(cleanup_test_files, mock_storage_bucket):
+    # Given
+    test_files = write_test_files(cleanup_test_files, 'test1.csv.gpg')
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), uuid.uuid4())
+    mock_storage_bucket.uploaded_md5_hash = base64.b64encode(hashlib.md5(b'corrupted').digest()).decode()
+
+    # When
+    with pytest.raises(UploadChecksumMismatchException):
+        copy_files_to_gcs(test_files, checkpoint)
+
+    # Then
+    assert not checkpoint.is_uploaded(test_files[0], 'gcs')
+
+
+def test_copy_files_to_gcs_sends_print_file_md5_from_manifest_without_reading_the_print_file(cleanup_test_files,
+                                                                                             mock_storage_bucket):
+    # Given
+    test_files = write_test_files(cleanup_test_files, 'test1.csv.gpg', 'test1.manifest')
+    print_file_md5_hash = base64.b64encode(hashlib.md5(test_files[0].read_bytes()).digest()).decode()
+
+    # When
+    with patch('generate_print_files.open', wraps=open) as patch_open:
         copy_files_to_gcs(test_files)
 
-    mock_upload_from_filename = mock_storage_client.get_bucket.return_value.blob.return_value.upload_from_filename
+    # Then
+    assert [blob.requested_md5_hash for blob in mock_storage_bucket.uploaded_blobs][0] == print_file_md5_hash
+    assert [call_args[0][0] for call_args in patch_open.call_args_list] == [test_files[1]]
+
+
+def test_storage_client_is_created_once_and_can_use_a_local_emulator():
+    # Given
+    get_storage_client.cache_clear()
+
+    # When
+    with patch.dict(os.environ, {'STORAGE_EMULATOR_HOST': 'http://localhost:4443', 'GOOGLE_CLOUD_PROJECT': 'local'}):
+        client = get_storage_client()
+        second_client = get_storage_client()
+    get_storage_client.cache_clear()
+
+    # Then
+    assert second_client is client
+    assert client.project == 'local'
+    assert client._connection.API_BASE_URL == 'http://localhost:4443'
+
+
+def test_upload_pipeline_uploads_every_group_of_files_to_each_destination(cleanup_test_files):
+    # Given
+    checkpoint = PrintFileCheckpoint(cleanup_test_files, uuid.uuid4())
+    file_path_groups = [[Path('test1.csv.gpg'), Path('test1.manifest')],
+                        [Path('test2.csv.gpg'), Path('test2.manifest')]]
+
+    # When
+    with patch('generate_print_files.copy_files_to_gcs') as patch_copy_files_to_gcs, \
+            patch('generate_print_files.copy_files_to_sftp') as patch_copy_files_to_sftp:
+        with UploadPipeline('QM', checkpoint=checkpoint) as upload_pipeline:
+            for file_paths in file_path_groups:
+                upload_pipeline(file_paths)
+
+    # Then
+    assert patch_copy_files_to_gcs.call_args_list == [call(file_paths, checkpoint=checkpoint)
+                                                      for file_paths in file_path_groups]
+    assert patch_copy_files_to_sftp.call_args_list == [call(file_paths, supplier='QM', checkpoint=checkpoint)
+                                                       for file_paths in file_path_groups]
+
+
+def test_upload_pipeline_raises_upload_failure_once_queued_uploads_finish():
+    # Given
+    upload_error = paramiko.SSHException('test connection failure')
+
+    # When
+    with patch('generate_print_files.copy_files_to_gcs') as patch_copy_files_to_gcs, \
+            patch('generate_print_files.copy_files_to_sftp', side_effect=upload_error):
+        with pytest.raises(paramiko.SSHException):
+            with UploadPipeline('QM') as upload_pipeline:
+                upload_pipeline([Path('test1.csv.gpg'), Path('test1.manifest')])
+                upload_pipeline([Path('test2.csv.gpg'), Path('test2.manifest')])
 
     # Then
-    mock_upload_from_filename.assert_has_calls([call(filename=str(file_path)) for file_path in test_files])
+    assert patch_copy_files_to_gcs.call_count == 2
+
+
+def test_upload_pipeline_reports_upload_failures_when_generation_also_fails(capsys):
+    # When
+    with patch('generate_print_files.copy_files_to_gcs'), \
+            patch('generate_print_files.copy_files_to_sftp', side_effect=paramiko.SSHException('test upload failure')):
+        with pytest.raises(QidQuantityMismatchException):
+            with UploadPipeline('QM') as upload_pipeline:
+                upload_pipeline([Path('test1.csv.gpg'), Path('test1.manifest')])
+                raise QidQuantityMismatchException('test generation failure')
+
+    # Then
+    assert "Upload failed: SSHException('test upload failure')" in capsys.readouterr().out
+
+
+def test_worker_processes_are_not_forked_while_upload_threads_run(cleanup_test_files, setup_environment):
+    # Given
+    print_file_jobs = [({'Questionnaire type': '01'},)]
+    other_thread_running = threading.Event()
+    stop_other_thread = threading.Event()
+    other_thread = threading.Thread(target=lambda: (other_thread_running.set(), stop_other_thread.wait()))
+    other_thread.start()
+    other_thread_running.wait()
+
+    # When
+    try:
+        with patch('generate_print_files.multiprocessing.get_context') as patch_get_context:
+            patch_get_context.return_value.Pool.return_value.__enter__.return_value.imap.return_value = ['result']
+            results = list(_generate_print_files_in_workers(print_file_jobs, 'QM', 2))
+    finally:
+        stop_other_thread.set()
+        other_thread.join()
+
+    # Then
+    patch_get_context.assert_called_once_with('forkserver')
+    assert results == ['result']
+
+
+def test_pipelined_generation_uploads_each_row_while_the_next_is_generated(cleanup_test_files, mock_db_engine,
+                                                                           setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    first_row_uploaded = threading.Event()
+    uploaded_file_names = []
+
+    def mock_execute(_query, **query_kwargs):
+        if query_kwargs['qid_prefix'] == '01%':
+            return [{'qid': 'test_qid_1', 'uac': 'test_uac_1'}, {'qid': 'test_qid_2', 'uac': 'test_uac_2'}]
+        assert first_row_uploaded.wait(5), 'Expected the first row to be uploaded before the second is generated'
+        return [{'qid': 'test_qid_3', 'uac': 'test_uac_3'}]
+
+    mock_db_engine.execute.side_effect = mock_execute
+
+    def mock_copy_files_to_gcs(file_paths, checkpoint):
+        uploaded_file_names.extend(file_path.name for file_path in file_paths)
+        first_row_uploaded.set()
+
+    # When
+    with patch('generate_print_files.copy_files_to_gcs', mock_copy_files_to_gcs):
+        with UploadPipeline('QM', sftp=False) as upload_pipeline:
+            file_paths = generate_print_files_from_config_file_path(config_file_path, cleanup_test_files,
+                                                                    uuid.uuid4(), 'QM',
+                                                                    on_files_generated=upload_pipeline)
+
+    # Then
+    assert uploaded_file_names == [file_path.name for file_path in file_paths]
+    check_manifest_file_contents(cleanup_test_files, 'D_FD_H2', 'Household Questionnaire for Wales (English)',
+                                 row_count=1)
 
 
 def test_copy_files_to_sftp():
@@ -202,6 +675,346 @@ def test_create_manifest_formats_manifest_created_correctly_on_0_milliseconds(cl
     assert manifest['files'][0]['rows'] == 10
 
 
+def test_create_manifest_uses_given_size_and_md5_without_reading_the_file():
+    # Given
+    print_file_path = Path('not_a_real_file.csv.gpg')
+
+    # When
+    manifest = create_manifest(print_file_path, 'D_FD_H1', row_count=10, size_bytes=1234, md5sum='test_md5sum')
+
+    # Then
+    assert manifest['files'][0]['sizeBytes'] == '1234'
+    assert manifest['files'][0]['md5sum'] == 'test_md5sum'
+
+
+def test_wait_for_batch_polls_with_backoff_until_every_quantity_is_present(mock_db_engine, setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    mock_db_engine.execute.side_effect = (
+        ({'questionnaire_type': '01', 'link_count': 1},),
+        ({'questionnaire_type': '01', 'link_count': 2},),
+        ({'questionnaire_type': '01', 'link_count': 2}, {'questionnaire_type': '02', 'link_count': 1}),
+    )
+
+    # When
+    with patch('generate_print_files.RabbitContext') as patch_rabbit:
+        mock_rabbit = patch_rabbit.return_value.__enter__.return_value
+        mock_rabbit.get_queue_depth.return_value = 1
+        wait_for_batch_from_config_file_path(config_file_path, uuid.uuid4(), initial_poll_interval=5,
+                                             max_poll_interval=8)
+
+    # Then
+    patch_rabbit.assert_called_once()
+    mock_rabbit.sleep.assert_has_calls([call(5), call(8)])
+    assert mock_db_engine.execute.call_count == 3
+
+
+def test_wait_for_batch_times_out_with_the_quantities_still_missing(mock_db_engine, setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    mock_db_engine.execute.return_value = ({'questionnaire_type': '01', 'link_count': 1},)
+
+    # When
+    with patch('generate_print_files.RabbitContext') as patch_rabbit, \
+            patch('generate_print_files.time.monotonic', side_effect=(0, 0, 0, 4, 4, 10)):
+        with pytest.raises(BatchWaitTimeoutException) as timeout:
+            wait_for_batch_from_config_file_path(config_file_path, uuid.uuid4(), initial_poll_interval=5,
+                                                 max_poll_interval=300, timeout=10)
+
+    # Then
+    mock_rabbit = patch_rabbit.return_value.__enter__.return_value
+    mock_rabbit.sleep.assert_has_calls([call(5), call(6)])
+    assert 'questionnaire type 01: 1 of 2; questionnaire type 02: 0 of 1' in str(timeout.value)
+
+
+def test_wait_for_batch_polls_the_replica_that_generation_reads_from(setup_environment):
+    # Given
+    create_db_engine.cache_clear()
+
+    # When
+    with patch.dict(os.environ, {'DB_REPLICA_HOST': 'replica_host'}), \
+            patch('generate_print_files.create_engine') as patched_create_engine, \
+            patch('generate_print_files.RabbitContext'):
+        patched_create_engine.return_value.execute.return_value = ({'questionnaire_type': '01', 'link_count': 2},
+                                                                   {'questionnaire_type': '02', 'link_count': 1})
+        wait_for_batch_from_config_file_path(setup_environment.joinpath('test_batch.csv'), uuid.uuid4())
+    create_db_engine.cache_clear()
+
+    # Then
+    patched_create_engine.assert_called_once()
+    assert '@replica_host:' in patched_create_engine.call_args[0][0]
+
+
+def test_main_fails_on_invalid_key_before_waiting_for_batch(cleanup_test_files, setup_environment):
+    # Given
+    arguments = ['generate_print_files.py', str(setup_environment.joinpath('test_batch.csv')), str(cleanup_test_files),
+                 'QM', str(uuid.uuid4()), '--wait-for-batch', '--checkpoint-dir', str(cleanup_test_files)]
+
+    # When
+    with patch('sys.argv', arguments), \
+            patch.dict(os.environ, {'OUR_PUBLIC_KEY_FINGERPRINT': 'not the right fingerprint'}), \
+            patch('generate_print_files._get_uac_qid_link_counts') as patched_get_link_counts, \
+            patch('generate_print_files.RabbitContext') as patched_rabbit_context:
+        with pytest.raises(EncryptionKeyInvalidException):
+            main()
+
+    # Then
+    patched_get_link_counts.assert_not_called()
+    patched_rabbit_context.assert_not_called()
+
+
+def test_main_fails_on_existing_checkpoint_before_waiting_for_batch(cleanup_test_files, setup_environment):
+    # Given
+    batch_id = uuid.uuid4()
+    PrintFileCheckpoint(cleanup_test_files, batch_id).record_completed(
+        {'Questionnaire type': '01', 'Quantity': '3', 'Pack code': 'D_FD_H1'},
+        [('D_FD_H1_test', PrintFileStats(3, 100, 'test_md5'))])
+    arguments = ['generate_print_files.py', str(setup_environment.joinpath('test_batch.csv')), str(cleanup_test_files),
+                 'QM', str(batch_id), '--wait-for-batch', '--checkpoint-dir', str(cleanup_test_files)]
+
+    # When
+    with patch('sys.argv', arguments), \
+            patch('generate_print_files._get_uac_qid_link_counts') as patched_get_link_counts, \
+            patch('generate_print_files.RabbitContext'):
+        with pytest.raises(PrintFileCheckpointExistsException):
+            main()
+
+    # Then
+    patched_get_link_counts.assert_not_called()
+
+
+def test_uac_qid_links_are_streamed_with_server_side_cursor(cleanup_test_files, mock_db_engine, setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    batch_id = uuid.uuid4()
+    mock_test_batch_results(mock_db_engine, batch_id)
+
+    # When
+    generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM')
+
+    # Then
+    mock_db_engine.execution_options.assert_called_with(stream_results=True, max_row_buffer=DB_FETCH_SIZE)
+    uac_qid_links_query = str(mock_db_engine.execute.call_args[0][0])
+    assert uac_qid_links_query.startswith('SELECT qid, uac FROM casev2.uac_qid_link')
+
+
+def test_generate_print_files_in_single_scan_routes_rows_to_print_files(cleanup_test_files,
+                                                                        mock_db_engine,
+                                                                        setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    batch_id = uuid.uuid4()
+    mock_db_engine.execute.side_effect = ((
+        {'qid': '0100000001', 'uac': 'test_uac_1'},
+        {'qid': '0200000002', 'uac': 'test_uac_2'},
+        {'qid': '2100000003', 'uac': 'test_uac_3'},
+        {'qid': '0100000004', 'uac': 'test_uac_4'},
+    ),)
+
+    # When
+    generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM', single_scan=True)
+
+    # Then
+    assert mock_db_engine.execute.call_count == 1
+    assert decrypt_print_file(cleanup_test_files, 'D_FD_H1') == ('test_uac_1|0100000001||||||||||||D_FD_H1||\r\n'
+                                                                 'test_uac_4|0100000004||||||||||||D_FD_H1||\r\n')
+    assert decrypt_print_file(cleanup_test_files, 'D_FD_H2') == 'test_uac_2|0200000002||||||||||||D_FD_H2||\r\n'
+    check_manifest_file_contents(cleanup_test_files, 'D_FD_H1', 'Household Questionnaire for England', row_count=2)
+
+
+def test_generate_print_files_per_config_row_uses_sargable_qid_prefix(cleanup_test_files,
+                                                                      mock_db_engine,
+                                                                      setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    batch_id = uuid.uuid4()
+    mock_test_batch_results(mock_db_engine, batch_id)
+
+    # When
+    generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM')
+
+    # Then
+    assert [query_kwargs['qid_prefix'] for _, query_kwargs in mock_db_engine.execute.call_args_list] == ['01%', '02%']
+    assert 'SUBSTRING' not in str(mock_db_engine.execute.call_args[0][0])
+
+
+def test_generate_print_files_with_copy_export_engine_matches_row_output(cleanup_test_files,
+                                                                         mock_db_engine,
+                                                                         setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('test_batch.csv')
+    batch_id = uuid.uuid4()
+    copy_output = iter((
+        (b'test_uac_1|test_qid_1||||||||||||D_FD_H1||\n', b'test_uac_2|test_qid_2||||||||||||D_FD_H1||\n'),
+        (b'test_uac_3|test_qid_3||||||||||||D_FD_H2||\n',),
+    ))
+    mock_cursor = mock_copy_cursor(mock_db_engine)
+    mock_cursor.copy_expert.side_effect = lambda _sql, output_stream: [output_stream.write(data)
+                                                                       for data in next(copy_output)]
+
+    # When
+    generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, batch_id, 'QM',
+                                               export_engine='copy')
+
+    # Then
+    assert decrypt_print_file(cleanup_test_files, 'D_FD_H1') == ('test_uac_1|test_qid_1||||||||||||D_FD_H1||\r\n'
+                                                                 'test_uac_2|test_qid_2||||||||||||D_FD_H1||\r\n')
+    assert decrypt_print_file(cleanup_test_files, 'D_FD_H2') == 'test_uac_3|test_qid_3||||||||||||D_FD_H2||\r\n'
+    check_manifest_file_contents(cleanup_test_files, 'D_FD_H1', 'Household Questionnaire for England', row_count=2)
+    copy_sql = mock_cursor.copy_expert.call_args[0][0]
+    assert copy_sql.startswith('COPY (SELECT uac, qid, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL,'
+                               ' NULL, %(pack_code)s, NULL, NULL FROM casev2.uac_qid_link')
+    assert copy_sql.endswith("TO STDOUT WITH (FORMAT csv, DELIMITER '|')")
+    mock_db_engine.execute.assert_not_called()
+
+
+def test_generate_print_files_with_copy_export_engine_leaves_out_ccs_uac(cleanup_test_files,
+                                                                         mock_db_engine,
+                                                                         setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('ccs_test_batch.csv')
+    mock_cursor = mock_copy_cursor(mock_db_engine)
+    mock_cursor.copy_expert.side_effect = lambda _sql, output_stream: output_stream.write(
+        b'|test_qid_1||||||||||||D_CCS_CHP2W||\n')
+
+    # When
+    generate_print_files_from_config_file_path(config_file_path, cleanup_test_files, uuid.uuid4(), 'QM',
+                                               export_engine='copy')
+
+    # Then
+    assert mock_cursor.copy_expert.call_args[0][0].startswith('COPY (SELECT NULL, qid,')
+    assert decrypt_print_file(cleanup_test_files, 'D_CCS_CHP2W') == '|test_qid_1||||||||||||D_CCS_CHP2W||\r\n'
+
+
+def test_generate_print_files_with_partitions_reads_qid_ranges_in_order(cleanup_test_files,
+                                                                        mock_db_engine,
+                                                                        setup_environment):
+    # Given
+    config_file_path = setup_environment.joinpath('ccs_test_batch.csv')
+    uac_qid_links_by_range = {
+        (None, '5300000003'): [{'qid': '5300000001', 'uac': None}, {'qid': '5300000002', 'uac': None}],
+        ('5300000003', '5300000005'): [{'qid': '5300000003', 'uac': None}, {'qid': '5300000004', 'uac': None}],
+        ('5300000005', None): [{'qid': '5300000005', 'uac': None}],
+    }
+
+    def mock_execute(query, **query_kwargs):
+        if 'percentile_disc' in str(query):
+            assert query_kwargs['fractions'] == [1 / 3, 2 / 3]
+            return Mock(scalar=Mock(return_value=['5300000003', '5300000005']))
+        return uac_qid_links_by_range[query_kwargs['lower_qid'], query_kwargs['upper_qid']]
+
+    mock_db_engine.execute.side_effect = mock_execute
+
+    # When
+    with open(config_file_path) as config_file:
+        config_file_contents = config_file.read().replace('"1"', '"5"')
+    generate_print_files_from_config_file(io.StringIO(config_file_contents), cleanup_test_files, uuid.uuid4(), 'QM',
+                                          partitions=3)
+
+    # Then
+    assert decrypt_print_file(cleanup_test_files, 'D_CCS_CHP2W') == ''.join(
+        f'|530000000{qid_suffix}||||||||||||D_CCS_CHP2W||\r\n' for qid_suffix in range(1, 6))
+
+
+def test_generate_print_files_with_partitions_reads_at_most_pool_size_ranges(cleanup_test_files, mock_db_engine,
+                                                                             setup_environment):
+    # Given
+    config_file = io.StringIO('Questionnaire type,Quantity,Pack code\n01,12,D_FD_H1\n')
+    boundaries = [f'01{qid:014}' for qid in range(3, 12, 3)]
+    ranges_in_flight = []
+    max_ranges_in_flight = []
+    in_flight_lock = threading.Lock()
+
+    def stream_range(lower_qid, upper_qid):
+        with in_flight_lock:
+            ranges_in_flight.append(lower_qid)
+            max_ranges_in_flight.append(len(ranges_in_flight))
+        first_qid = int(lower_qid[2:]) if lower_qid else 0
+        for qid in range(first_qid, first_qid + 3):
+            yield {'qid': f'01{qid:014}', 'uac': f'uac_{qid}'}
+        with in_flight_lock:
+            ranges_in_flight.remove(lower_qid)
+
+    def mock_execute(query, **query_kwargs):
+        if 'percentile_disc' in str(query):
+            return Mock(scalar=Mock(return_value=boundaries))
+        return stream_range(query_kwargs['lower_qid'], query_kwargs['upper_qid'])
+
+    mock_db_engine.execute.side_effect = mock_execute
+
+    # When
+    with patch.dict(os.environ, {'DB_POOL_SIZE': '2'}), patch('generate_print_files.DB_FETCH_SIZE', 1), \
+            patch('generate_print_files.PARTITION_BUFFER_FETCHES', 1):
+        generate_print_files_from_config_file(config_file, cleanup_test_files, uuid.uuid4(), 'QM', partitions=4)
+
+    # Then
+    assert max(max_ranges_in_flight) == 2
+    mock_db_engine.execution_options.assert_called_with(stream_results=True, max_row_buffer=1)
+    assert decrypt_print_file(cleanup_test_files, 'D_FD_H1').splitlines() == [
+        f'uac_{qid}|01{qid:014}||||||||||||D_FD_H1||' for qid in range(12)]
+
+
+def test_generate_print_files_with_partitions_raises_a_failed_range_read(cleanup_test_files, mock_db_engine,
+                                                                         setup_environment):
+    # Given
+    config_file = io.StringIO('Questionnaire type,Quantity,Pack code\n01,4,D_FD_H1\n')
+
+    def mock_execute(query, **query_kwargs):
+        if 'percentile_disc' in str(query):
+            return Mock(scalar=Mock(return_value=['0100000000000002']))
+        if query_kwargs['lower_qid']:
+            raise ConnectionError('server closed the connection unexpectedly')
+        return [{'qid': '0100000000000000', 'uac': 'uac_0'}, {'qid': '0100000000000001', 'uac': 'uac_1'}]
+
+    mock_db_engine.execute.side_effect = mock_execute
+
+    # When
+    with pytest.raises(ConnectionError):
+        generate_print_files_from_config_file(config_file, cleanup_test_files, uuid.uuid4(), 'QM', partitions=2)
+
+    # Then
+    assert not list(cleanup_test_files.glob('*.csv.gpg'))
+
+
+def test_create_db_engine_uses_replica_host_for_replica_reads(setup_environment):
+    # Given
+    create_db_engine.cache_clear()
+
+    # When
+    with patch.dict(os.environ, {'DB_REPLICA_HOST': 'replica_host', 'DB_POOL_SIZE': '8'}), \
+            patch('generate_print_files.create_engine') as patched_create_engine:
+        create_db_engine(replica=True)
+        create_db_engine(replica=True)
+        create_db_engine()
+    create_db_engine.cache_clear()
+
+    # Then
+    assert patched_create_engine.call_count == 2, 'Expected one engine each for the replica and the primary'
+    replica_uri = patched_create_engine.call_args_list[0][0][0]
+    primary_uri = patched_create_engine.call_args_list[1][0][0]
+    assert '@replica_host:' in replica_uri
+    assert '@test_value:' in primary_uri
+    assert patched_create_engine.call_args_list[0][1] == {'pool_size': 8, 'max_overflow': 10}
+
+
+def mock_copy_cursor(mock_engine):
+    mock_engine.raw_connection.return_value = MagicMock()
+    mock_cursor = mock_engine.raw_connection.return_value.cursor.return_value.__enter__.return_value
+    mock_cursor.mogrify.side_effect = lambda query, _params: query.encode()
+    return mock_cursor
+
+
+def decrypt_print_file(print_file_directory, pack_code):
+    return decrypt_file(next(print_file_directory.glob(f'{pack_code}_*.csv.gpg')))
+
+
+def decrypt_file(print_file_path):
+    our_key, _ = pgpy.PGPKey.from_file(Path(__file__).parents[1].joinpath('dummy_keys', 'our_dummy_private.asc'))
+    encrypted_message = pgpy.PGPMessage.from_file(print_file_path)
+    with our_key.unlock(passphrase='test'):
+        return our_key.decrypt(encrypted_message).message
+
+
 def mock_test_batch_results(mock_engine, batch_id: uuid.UUID):
     mock_engine.execute.side_effect = (
         ({'qid': 'test_qid_1', 'uac': 'test_uac_1', 'batch_id': str(batch_id)},
@@ -225,12 +1038,53 @@ def setup_environment():
     os.environ['PPO_PUBLIC_KEY_PATH'] = str(
         Path(__file__).parents[1].joinpath('dummy_keys', 'supplier_PPO_dummy_public_key.asc'))
     os.environ['OUR_PUBLIC_KEY_PATH'] = str(Path(__file__).parents[1].joinpath('dummy_keys', 'our_dummy_public.asc'))
+    load_recipient_key.cache_clear()
     return resource_file_path
 
 
+def write_test_files(directory: Path, *file_names) -> List[Path]:
+    test_files = [directory.joinpath(file_name) for file_name in file_names]
+    for test_file in test_files:
+        if test_file.suffix == '.manifest':
+            print_file_contents = test_file.with_suffix('.csv.gpg').read_bytes()
+            test_file.write_text(json.dumps({'files': [{'md5sum': hashlib.md5(print_file_contents).hexdigest()}]}))
+        else:
+            test_file.write_text(f'{test_file.name} contents')
+    return test_files
+
+
+@pytest.fixture
+def mock_storage_bucket():
+    get_storage_client.cache_clear()
+    with patch('generate_print_files.storage') as patched_storage:
+        mock_bucket = patched_storage.Client.return_value.get_bucket.return_value
+        mock_bucket.uploaded_blobs = []
+        mock_bucket.uploaded_md5_hash = None
+
+        def mock_blob(name, chunk_size):
+            blob = Mock()
+            blob.name = name
+
+            def upload_from_filename(filename):
+                blob.requested_md5_hash = blob.md5_hash
+                blob.md5_hash = mock_bucket.uploaded_md5_hash or base64.b64encode(
+                    hashlib.md5(Path(filename).read_bytes()).digest()).decode()
+                mock_bucket.uploaded_blobs.append(blob)
+
+            blob.upload_from_filename.side_effect = upload_from_filename
+            return blob
+
+        mock_bucket.blob.side_effect = mock_blob
+        yield mock_bucket
+    get_storage_client.cache_clear()
+
+
 @pytest.fixture
 def mock_db_engine():
     mock_engine = Mock()
+    mock_engine.execution_options.return_value = mock_engine
+    create_db_engine.cache_clear()
     with patch('generate_print_files.create_engine') as patched_create_engine:
         patched_create_engine.return_value = mock_engine
         yield mock_engine
+    create_db_engine.cache_clear()
@@ -1,9 +1,16 @@
+import argparse
 import json
 import uuid
+from collections import Counter
 from pathlib import Path
 from unittest.mock import patch
 
-from generate_qid_batch import generate_messages_from_config_file_path
+import pytest
+
+from exceptions import QidRequestQuantityMismatchException, PublishJournalExistsException
+from generate_qid_batch import generate_messages_from_config_file_path, split_quantity, split_into_chunks, \
+    positive_int
+from publish_journal import PublishJournal
 
 
 def test_generate_messages_from_config_file_path_publishes_correct_quantities():
@@ -31,8 +38,182 @@ def test_generate_messages_from_config_file_path_sets_batch_id():
     assert all(json.loads(message[0][0])['batchId'] == str(batch_id) for message in publish_message_call_list)
 
 
-def generate_messages_with_mocked_rabbit(config_file_name, batch_id):
+def test_generate_messages_from_config_file_path_with_workers_publishes_exact_quantities_in_shards():
+    # Given
+    batch_id = uuid.uuid4()
+    config_file_path = Path(__file__).parent.resolve().joinpath('resources').joinpath('test_batch.csv')
+
+    shard_messages = []
+
+    def mock_publish_messages(messages, _content_type, on_window_confirmed):
+        shard_messages.append([json.loads(message)['questionnaireType'] for message in messages])
+        return len(shard_messages[-1])
+
+    # When
+    with patch('generate_qid_batch.RabbitContext') as patch_rabbit, \
+            patch('generate_qid_batch.multiprocessing.Pool') as patch_pool:
+        patch_pool.return_value.__enter__.return_value.imap_unordered.side_effect = map
+        patch_rabbit.return_value.__enter__.return_value.publish_messages.side_effect = mock_publish_messages
+        generate_messages_from_config_file_path(config_file_path, batch_id, workers=2)
+
+    # Then
+    patch_pool.assert_called_once_with(2)
+    assert patch_rabbit.call_count == 3, 'Expected one rabbit connection per non-empty shard'
+    assert shard_messages == [['01'], ['01'], ['02']]
+
+
+def test_generate_messages_with_workers_errors_on_published_quantity_mismatch():
+    # Given
+    config_file_path = Path(__file__).parent.resolve().joinpath('resources').joinpath('test_batch.csv')
+
+    # When
+    with patch('generate_qid_batch.RabbitContext') as patch_rabbit, \
+            patch('generate_qid_batch.multiprocessing.Pool') as patch_pool:
+        patch_pool.return_value.__enter__.return_value.imap_unordered.side_effect = map
+        patch_rabbit.return_value.__enter__.return_value.publish_messages.return_value = 0
+
+        # Then
+        with pytest.raises(QidRequestQuantityMismatchException, match='expected = 2, published = 0'):
+            generate_messages_from_config_file_path(config_file_path, uuid.uuid4(), workers=2)
+
+
+def test_split_quantity():
+    assert split_quantity(10, 3) == [4, 3, 3]
+    assert split_quantity(2, 4) == [1, 1]
+    assert split_quantity(0, 2) == []
+
+
+def test_generate_messages_with_journal_resumes_from_published_count(cleanup_test_files):
+    # Given
+    batch_id = uuid.uuid4()
+    PublishJournal(cleanup_test_files, batch_id).new_recorder(0, '01')(1)
+
+    # When
+    publish_message_call_list = generate_messages_with_mocked_rabbit('test_batch.csv', batch_id,
+                                                                     journal_directory=cleanup_test_files, resume=True)
+
+    # Then
+    assert [json.loads(message[0][0])['questionnaireType'] for message in publish_message_call_list] == ['01', '02']
+
+
+def test_generate_messages_with_existing_journal_errors_without_resume(cleanup_test_files):
+    # Given
+    batch_id = uuid.uuid4()
+    PublishJournal(cleanup_test_files, batch_id).new_recorder(0, '01')(1)
+
+    # Then
+    with pytest.raises(PublishJournalExistsException):
+        generate_messages_with_mocked_rabbit('test_batch.csv', batch_id, journal_directory=cleanup_test_files)
+
+
+def test_generate_messages_with_journal_records_confirmed_windows(cleanup_test_files):
+    # Given
+    batch_id = uuid.uuid4()
+    config_file_path = Path(__file__).parent.resolve().joinpath('resources').joinpath('test_batch.csv')
+
+    def mock_publish_messages(messages, _content_type, on_window_confirmed):
+        published_count = len(list(messages))
+        on_window_confirmed(published_count)
+        return published_count
+
+    # When
+    with patch('generate_qid_batch.RabbitContext') as patch_rabbit:
+        patch_rabbit.return_value.__enter__.return_value.publish_messages.side_effect = mock_publish_messages
+        generate_messages_from_config_file_path(config_file_path, batch_id, journal_directory=cleanup_test_files)
+
+    # Then
+    journal = PublishJournal(cleanup_test_files, batch_id)
+    assert journal.published_count(0, '01') == 2
+    assert journal.published_count(1, '02') == 1
+
+
+def test_generate_messages_with_max_chunk_size_requests_exact_quantities_in_chunks():
+    # Given
+    batch_id = uuid.uuid4()
+
+    # When
+    publish_message_call_list = generate_messages_with_mocked_rabbit('unaddressed_batch_chunked.csv', batch_id,
+                                                                     max_chunk_size=1000)
+
+    # Then
+    assert len(publish_message_call_list) == 4
+    assert stand_in_case_processor(message[0][0] for message in publish_message_call_list) == {
+        (str(batch_id), '01'): 2500,
+        (str(batch_id), '02'): 1000,
+    }
+
+
+def test_generate_messages_with_max_chunk_size_journals_pairs(cleanup_test_files):
+    # Given
+    batch_id = uuid.uuid4()
+    config_file_path = Path(__file__).parent.resolve().joinpath('resources').joinpath('unaddressed_batch_chunked.csv')
+
+    def mock_publish_messages(messages, _content_type, on_window_confirmed):
+        published_count = 0
+        for published_count, _ in enumerate(messages, start=1):
+            on_window_confirmed(1)
+        return published_count
+
+    # When
+    with patch('generate_qid_batch.RabbitContext') as patch_rabbit:
+        patch_rabbit.return_value.__enter__.return_value.publish_messages.side_effect = mock_publish_messages
+        generate_messages_from_config_file_path(config_file_path, batch_id, journal_directory=cleanup_test_files,
+                                                max_chunk_size=1000)
+
+    # Then
+    journal = PublishJournal(cleanup_test_files, batch_id)
+    assert journal.published_count(0, '01') == 2500
+    assert journal.published_count(1, '02') == 1000
+
+
+@pytest.mark.parametrize('max_chunk_size', (0, -1000))
+def test_generate_messages_rejects_max_chunk_size_below_one_before_publishing(max_chunk_size):
+    # Given
+    config_file_path = Path(__file__).parent.resolve().joinpath('resources').joinpath('unaddressed_batch_chunked.csv')
+
+    # When
+    with patch('generate_qid_batch.RabbitContext') as patch_rabbit:
+        with pytest.raises(ValueError, match='Max chunk size must be at least 1'):
+            generate_messages_from_config_file_path(config_file_path, uuid.uuid4(), max_chunk_size=max_chunk_size)
+
+    # Then
+    patch_rabbit.return_value.__enter__.return_value.publish_messages.assert_not_called()
+
+
+@pytest.mark.parametrize('value', ('0', '-1000', 'ten'))
+def test_positive_int_rejects_values_below_one(value):
+    with pytest.raises((argparse.ArgumentTypeError, ValueError)):
+        positive_int(value)
+
+
+def test_split_into_chunks():
+    assert list(split_into_chunks(2500, 1000)) == [1000, 1000, 500]
+    assert list(split_into_chunks(1000, 1000)) == [1000]
+    assert list(split_into_chunks(0, 1000)) == []
+
+
+def stand_in_case_processor(messages):
+    """
+    Expands request messages the way case-processor does, counting the pairs it would create per batch and
+    questionnaire type
+    """
+    pair_counts = Counter()
+    for message in messages:
+        request = json.loads(message)
+        pair_counts[(request['batchId'], request['questionnaireType'])] += request.get('quantity', 1)
+    return pair_counts
+
+
+def generate_messages_with_mocked_rabbit(config_file_name, batch_id, **kwargs):
     config_file_path = Path(__file__).parent.resolve().joinpath('resources').joinpath(config_file_name)
+    publish_message_call_list = []
+
+    def mock_publish_messages(messages, content_type, on_window_confirmed=None):
+        messages = list(messages)
+        publish_message_call_list.extend(((message, content_type),) for message in messages)
+        return len(messages)
+
     with patch('generate_qid_batch.RabbitContext') as patch_rabbit:
-        generate_messages_from_config_file_path(config_file_path, batch_id)
-    return patch_rabbit.return_value.__enter__.return_value.publish_message.call_args_list
+        patch_rabbit.return_value.__enter__.return_value.publish_messages.side_effect = mock_publish_messages
+        generate_messages_from_config_file_path(config_file_path, batch_id, **kwargs)
+    return publish_message_call_list
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import uuid
+from pathlib import Path
+
+from print_file_writer import PrintFileStats
+from print_file_checkpoint import PrintFileCheckpoint
+
+CONFIG_ROW = {'Questionnaire type': '01', 'Quantity': '2', 'Pack code': 'D_FD_H1'}
+ENCRYPTION_SETTINGS = {'keyFingerprints': ['our fingerprint', 'supplier fingerprint'], 'backend': 'pgpy',
+                       'printFileFormat': {'armored': True, 'compression': 'ZIP', 'compressionLevel': 6}}
+
+
+def test_completed_file_paths_returns_recorded_files(cleanup_test_files):
+    # Given
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), uuid.uuid4())
+    print_file_parts = write_print_file_parts(cleanup_test_files, 'D_FD_H1_part1', 'D_FD_H1_part2')
+
+    # When
+    checkpoint.record_completed(CONFIG_ROW, print_file_parts)
+
+    # Then
+    assert checkpoint.exists()
+    assert checkpoint.completed_file_paths(CONFIG_ROW, cleanup_test_files) == [
+        cleanup_test_files.joinpath('D_FD_H1_part1.csv.gpg'), cleanup_test_files.joinpath('D_FD_H1_part1.manifest'),
+        cleanup_test_files.joinpath('D_FD_H1_part2.csv.gpg'), cleanup_test_files.joinpath('D_FD_H1_part2.manifest')]
+    assert not list(cleanup_test_files.rglob('*.partial'))
+
+
+def test_record_completed_writes_checkpoint_entry(cleanup_test_files):
+    # Given
+    batch_id = uuid.uuid4()
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), batch_id)
+
+    # When
+    checkpoint.record_completed(CONFIG_ROW, [('D_FD_H1_test', PrintFileStats(2, 100, 'test_md5'))],
+                                ENCRYPTION_SETTINGS)
+
+    # Then
+    assert json.loads(checkpoint.batch_directory.joinpath('D_FD_H1.json').read_text()) == {
+        'batchId': str(batch_id), 'packCode': 'D_FD_H1', 'questionnaireType': '01', 'quantity': 2,
+        'encryption': ENCRYPTION_SETTINGS,
+        'files': [{'name': 'D_FD_H1_test.csv.gpg', 'manifest': 'D_FD_H1_test.manifest', 'rows': 2,
+                   'sizeBytes': 100, 'md5sum': 'test_md5'}]}
+
+
+def test_changed_print_file_is_not_completed(cleanup_test_files):
+    # Given
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), uuid.uuid4())
+    checkpoint.record_completed(CONFIG_ROW, write_print_file_parts(cleanup_test_files, 'D_FD_H1_test'))
+
+    # When
+    cleanup_test_files.joinpath('D_FD_H1_test.csv.gpg').write_bytes(b'changed contents')
+
+    # Then
+    assert checkpoint.completed_file_paths(CONFIG_ROW, cleanup_test_files) is None
+
+
+def test_missing_manifest_is_not_completed(cleanup_test_files):
+    # Given
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), uuid.uuid4())
+    checkpoint.record_completed(CONFIG_ROW, write_print_file_parts(cleanup_test_files, 'D_FD_H1_test'))
+
+    # When
+    cleanup_test_files.joinpath('D_FD_H1_test.manifest').unlink()
+
+    # Then
+    assert checkpoint.completed_file_paths(CONFIG_ROW, cleanup_test_files) is None
+
+
+def test_changed_config_row_is_not_completed(cleanup_test_files):
+    # Given
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), uuid.uuid4())
+    checkpoint.record_completed(CONFIG_ROW, write_print_file_parts(cleanup_test_files, 'D_FD_H1_test'))
+
+    # Then
+    assert checkpoint.completed_file_paths({**CONFIG_ROW, 'Quantity': '3'}, cleanup_test_files) is None
+
+
+def test_print_file_encrypted_with_other_settings_is_not_completed(cleanup_test_files):
+    # Given
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), uuid.uuid4())
+    checkpoint.record_completed(CONFIG_ROW, write_print_file_parts(cleanup_test_files, 'D_FD_H1_test'),
+                                ENCRYPTION_SETTINGS)
+    rotated_key_settings = {**ENCRYPTION_SETTINGS, 'keyFingerprints': ['our fingerprint', 'rotated fingerprint']}
+
+    # Then
+    assert checkpoint.completed_file_paths(CONFIG_ROW, cleanup_test_files, ENCRYPTION_SETTINGS)
+    assert checkpoint.completed_file_paths(CONFIG_ROW, cleanup_test_files, rotated_key_settings) is None
+    assert checkpoint.completed_file_paths(CONFIG_ROW, cleanup_test_files, {**ENCRYPTION_SETTINGS,
+                                                                            'backend': 'gpg'}) is None
+
+
+def test_cleared_checkpoint_does_not_exist(cleanup_test_files):
+    # Given
+    checkpoint = PrintFileCheckpoint(cleanup_test_files.joinpath('checkpoints'), uuid.uuid4())
+    checkpoint.record_completed(CONFIG_ROW, write_print_file_parts(cleanup_test_files, 'D_FD_H1_test'))
+    checkpoint.record_uploaded(Path('D_FD_H1_test.csv.gpg'), 'gcs')
+
+    # When
+    checkpoint.clear()
+
+    # Then
+    assert not checkpoint.exists()
+    assert not checkpoint.is_uploaded(Path('D_FD_H1_test.csv.gpg'), 'gcs')
+    assert checkpoint.completed_file_paths(CONFIG_ROW, cleanup_test_files) is None
+
+
+def test_uploads_are_recorded_per_destination(cleanup_test_files):
+    # Given
+    checkpoint = PrintFileCheckpoint(cleanup_test_files, uuid.uuid4())
+
+    # When
+    checkpoint.record_uploaded(Path('D_FD_H1_test.csv.gpg'), 'gcs')
+
+    # Then
+    assert checkpoint.is_uploaded(Path('D_FD_H1_test.csv.gpg'), 'gcs')
+    assert not checkpoint.is_uploaded(Path('D_FD_H1_test.csv.gpg'), 'sftp')
+    assert not checkpoint.is_uploaded(Path('D_FD_H1_test.manifest'), 'gcs')
+
+
+def test_checkpoint_for_new_batch_does_not_exist(cleanup_test_files):
+    assert not PrintFileCheckpoint(cleanup_test_files, uuid.uuid4()).exists()
+    assert PrintFileCheckpoint(cleanup_test_files, uuid.uuid4()).completed_file_paths(CONFIG_ROW,
+                                                                                      cleanup_test_files) is None
+
+
+def write_print_file_parts(output_file_path: Path, *filenames):
+    print_file_parts = []
+    for filename in filenames:
+        print_file_contents = f'{filename} encrypted contents'.encode()
+        output_file_path.joinpath(f'{filename}.csv.gpg').write_bytes(print_file_contents)
+        output_file_path.joinpath(f'{filename}.manifest').write_text('{}')
+        print_file_parts.append((filename, PrintFileStats(1, len(print_file_contents),
+                                                          hashlib.md5(print_file_contents).hexdigest())))
+    return print_file_parts
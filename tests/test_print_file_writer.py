@@ -0,0 +1,86 @@
+import os
+from pathlib import Path
+from unittest.mock import patch
+
+import pgpy
+import pytest
+
+from encryption import load_recipient_key
+from exceptions import QidQuantityMismatchException
+from print_file_writer import PrintFilePartsWriter
+
+DUMMY_KEYS_PATH = Path(__file__).parents[1].joinpath('dummy_keys')
+
+
+@pytest.fixture
+def setup_keys():
+    load_recipient_key.cache_clear()
+    with patch.dict(os.environ, {'OUR_PUBLIC_KEY_PATH': str(DUMMY_KEYS_PATH.joinpath('our_dummy_public.asc'))}):
+        yield
+    load_recipient_key.cache_clear()
+
+
+def test_print_file_parts_writer_splits_formatted_rows_between_parts(cleanup_test_files, setup_keys):
+    # Given
+    config = {'Questionnaire type': '01', 'Quantity': '5', 'Pack code': 'D_FD_H1'}
+    print_file_writer = PrintFilePartsWriter(cleanup_test_files, 'test_file', config, 'QM', max_rows_per_file=2)
+
+    # When
+    print_file_writer.write_formatted_rows('row_1\r\nrow_2\r\nrow_3\r\nro', 3)
+    print_file_writer.write_formatted_rows('w_4\r\nrow_5\r\n', 2)
+    print_file_parts = print_file_writer.close()
+
+    # Then
+    assert [(filename, print_file_stats.row_count) for filename, print_file_stats in print_file_parts] == [
+        ('test_file_part1', 2), ('test_file_part2', 2), ('test_file_part3', 1)]
+    assert decrypt_file(cleanup_test_files.joinpath('test_file_part2.csv.gpg')) == 'row_3\r\nrow_4\r\n'
+    assert decrypt_file(cleanup_test_files.joinpath('test_file_part3.csv.gpg')) == 'row_5\r\n'
+
+
+def test_print_file_parts_writer_checks_total_quantity_and_removes_parts(cleanup_test_files, setup_keys):
+    # Given
+    config = {'Questionnaire type': '01', 'Quantity': '4', 'Pack code': 'D_FD_H1'}
+    print_file_writer = PrintFilePartsWriter(cleanup_test_files, 'test_file', config, 'QM', max_rows_per_file=2)
+    print_file_writer.write_formatted_rows('row_1\r\nrow_2\r\nrow_3\r\n', 3)
+
+    # When
+    with pytest.raises(QidQuantityMismatchException, match='expected = 4, found = 3'):
+        print_file_writer.close()
+
+    # Then
+    assert not list(cleanup_test_files.glob('test_file*'))
+
+
+def test_print_file_parts_writer_aborts_encryption_when_writing_fails(cleanup_test_files, setup_keys):
+    # Given
+    config = {'Questionnaire type': '01', 'Quantity': '2', 'Pack code': 'D_FD_H1'}
+
+    # When
+    with patch('print_file_writer.create_encrypting_writer') as patch_create_encrypting_writer:
+        patch_create_encrypting_writer.return_value.write.side_effect = OSError('No space left on device')
+        with pytest.raises(OSError):
+            with PrintFilePartsWriter(cleanup_test_files, 'test_file', config, 'QM') as print_file_writer:
+                print_file_writer.write_formatted_rows('row_1\r\nrow_2\r\n', 2)
+                print_file_writer.close()
+
+    # Then
+    patch_create_encrypting_writer.return_value.abort.assert_called_once()
+    assert not list(cleanup_test_files.glob('test_file*'))
+
+
+@pytest.mark.parametrize('max_rows_per_file', (0, -1))
+def test_print_file_parts_writer_rejects_max_rows_per_file_below_one(cleanup_test_files, setup_keys,
+                                                                     max_rows_per_file):
+    # Given
+    config = {'Questionnaire type': '01', 'Quantity': '3', 'Pack code': 'D_FD_H1'}
+
+    # Then
+    with pytest.raises(ValueError, match='Max rows per file must be at least 1'):
+        PrintFilePartsWriter(cleanup_test_files, 'test_file', config, 'QM', max_rows_per_file=max_rows_per_file)
+    assert not list(cleanup_test_files.glob('test_file*'))
+
+
+def decrypt_file(print_file_path):
+    our_key, _ = pgpy.PGPKey.from_file(DUMMY_KEYS_PATH.joinpath('our_dummy_private.asc'))
+    with our_key.unlock(passphrase='test'):
+        return our_key.decrypt(pgpy.PGPMessage.from_file(print_file_path)).message
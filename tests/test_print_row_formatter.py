@@ -0,0 +1,28 @@
+import csv
+import io
+
+import pytest
+
+from mappings import SUPPLIER_TO_PRINT_TEMPLATE
+from print_row_formatter import PrintRowFormatter, build_print_row, build_ccs_print_row
+
+
+@pytest.mark.parametrize('supplier', ('QM', 'PPO'))
+@pytest.mark.parametrize('pack_code', ('D_FD_H1', 'D_CCS_CH1', 'D_FD|"H{0}'))
+def test_print_row_formatter_output_is_identical_to_dict_writer(supplier, pack_code):
+    # Given
+    result_rows = [{'uac': 'test_uac_1', 'qid': '0100000000000001'},
+                   {'uac': 'uac|with"special\r\ncharacters', 'qid': 'qid {}'},
+                   {'uac': None, 'qid': ' 0200000000000002 '}]
+    config = {'Pack code': pack_code}
+    row_builder = build_ccs_print_row if pack_code.startswith('D_CCS') else build_print_row
+    dict_writer_output = io.StringIO()
+    dict_writer = csv.DictWriter(dict_writer_output, fieldnames=SUPPLIER_TO_PRINT_TEMPLATE[supplier], delimiter='|')
+    for result_row in result_rows:
+        dict_writer.writerow(row_builder(result_row, config))
+
+    # When
+    formatted_rows = PrintRowFormatter(supplier, pack_code).format_rows(result_rows)
+
+    # Then
+    assert formatted_rows == dict_writer_output.getvalue()
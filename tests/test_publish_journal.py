@@ -0,0 +1,43 @@
+import json
+import uuid
+
+from publish_journal import PublishJournal
+
+
+def test_published_count_sums_recorders_for_row(cleanup_test_files):
+    # Given
+    journal = PublishJournal(cleanup_test_files, uuid.uuid4())
+    first_recorder = journal.new_recorder(0, '01')
+    second_recorder = journal.new_recorder(0, '01')
+    other_row_recorder = journal.new_recorder(1, '02')
+
+    # When
+    first_recorder(1000)
+    first_recorder(500)
+    second_recorder(250)
+    other_row_recorder(7)
+
+    # Then
+    assert journal.exists()
+    assert journal.published_count(0, '01') == 1750
+    assert journal.published_count(1, '02') == 7
+    assert journal.published_count(2, '03') == 0
+
+
+def test_recorder_writes_journal_entry(cleanup_test_files):
+    # Given
+    batch_id = uuid.uuid4()
+    recorder = PublishJournal(cleanup_test_files, batch_id).new_recorder(3, '21')
+
+    # When
+    recorder(10)
+
+    # Then
+    assert json.loads(recorder.journal_file_path.read_text()) == {'batchId': str(batch_id), 'rowIndex': 3,
+                                                                  'questionnaireType': '21', 'published': 10}
+    assert not list(cleanup_test_files.rglob('*.partial'))
+
+
+def test_journal_for_new_batch_does_not_exist(cleanup_test_files):
+    assert not PublishJournal(cleanup_test_files, uuid.uuid4()).exists()
+    assert PublishJournal(cleanup_test_files, uuid.uuid4()).published_count(0, '01') == 0
@@ -0,0 +1,87 @@
+from unittest.mock import Mock, call, patch
+
+from pika.exceptions import StreamLostError
+
+from queue_depth_throttle import QueueDepthThrottle
+from rabbit_context import RabbitContext
+
+
+def test_throttle_only_checks_queue_depth_every_check_interval():
+    # Given
+    mock_rabbit = Mock()
+    mock_rabbit.get_queue_depth.return_value = 0
+    throttle = QueueDepthThrottle(mock_rabbit, high_water_mark=100, check_interval=1000)
+
+    # When
+    for _ in range(5):
+        throttle(500)
+
+    # Then
+    assert mock_rabbit.get_queue_depth.call_count == 2
+
+
+def test_throttle_does_not_delay_below_low_water_mark():
+    # Given
+    mock_rabbit = Mock()
+    mock_rabbit.get_queue_depth.return_value = 50
+    throttle = QueueDepthThrottle(mock_rabbit, high_water_mark=100, check_interval=1)
+
+    # When
+    throttle(1)
+
+    # Then
+    mock_rabbit.sleep.assert_not_called()
+
+
+def test_throttle_delays_in_proportion_between_water_marks():
+    # Given
+    mock_rabbit = Mock()
+    mock_rabbit.get_queue_depth.return_value = 75
+    throttle = QueueDepthThrottle(mock_rabbit, high_water_mark=100, low_water_mark=50, check_interval=1,
+                                  max_delay_seconds=2)
+
+    # When
+    throttle(1)
+
+    # Then
+    mock_rabbit.sleep.assert_called_once_with(1)
+
+
+def test_throttle_pauses_above_high_water_mark_until_drained_to_low_water_mark():
+    # Given
+    mock_rabbit = Mock()
+    mock_rabbit.get_queue_depth.side_effect = (150, 120, 60, 40)
+    throttle = QueueDepthThrottle(mock_rabbit, high_water_mark=100, low_water_mark=50, check_interval=1,
+                                  pause_seconds=5)
+
+    # When
+    throttle(1)
+
+    # Then
+    mock_rabbit.sleep.assert_has_calls([call(5), call(5), call(5)])
+    assert mock_rabbit.get_queue_depth.call_count == 4
+
+
+def test_throttle_pause_survives_connection_loss():
+    # Given
+    queue_depths = []
+    for message_count in (150, 40):
+        queue_declare_ok = Mock()
+        queue_declare_ok.method.message_count = message_count
+        queue_depths.append(queue_declare_ok)
+
+    # When
+    with patch('rabbit_context.pika') as patched_pika, patch('rabbit_context.time') as patched_time:
+        patched_time.monotonic.return_value = 0
+        patched_channel = patched_pika.BlockingConnection.return_value.channel.return_value
+        patched_channel.queue_declare.side_effect = (queue_depths[0], StreamLostError('Connection lost'),
+                                                     queue_depths[1])
+        with RabbitContext(retry_backoff=1) as rabbit:
+            throttle = QueueDepthThrottle(rabbit, high_water_mark=100, low_water_mark=50, check_interval=1,
+                                          pause_seconds=5)
+            throttle(1)
+
+    # Then
+    assert patched_channel.queue_declare.call_count == 3
+    assert patched_pika.BlockingConnection.call_count == 2
+    patched_pika.BlockingConnection.return_value.sleep.assert_called_once_with(5)
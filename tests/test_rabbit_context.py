@@ -1,32 +1,34 @@
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 
+from pika.exceptions import StreamLostError
 from pika.spec import PERSISTENT_DELIVERY_MODE
 
 from rabbit_context import RabbitContext, RabbitConnectionClosedError
 
 
+@patch('rabbit_context.time')
 @patch('rabbit_context.pika')
 class TestRabbitContext(TestCase):
 
-    def test_context_manager_opens_connection_and_channel(self, patch_pika):
+    def test_context_manager_opens_connection_and_channel(self, patch_pika, _patch_time):
         with RabbitContext():
             patch_pika.BlockingConnection.assert_called_once()
             patch_pika.BlockingConnection.return_value.channel.assert_called_once()
 
-    def test_context_manager_closes_connection(self, patch_pika):
+    def test_context_manager_closes_connection(self, patch_pika, _patch_time):
         with RabbitContext():
             pass
         patch_pika.BlockingConnection.return_value.close.assert_called_once()
 
-    def test_attempt_to_publish_message_with_closed_connection_raises_correct_exception(self, patch_pika):
+    def test_attempt_to_publish_message_with_closed_connection_raises_correct_exception(self, patch_pika, _patch_time):
         with RabbitContext() as rabbit:
             pass
 
         with self.assertRaises(RabbitConnectionClosedError):
             rabbit.publish_message('This should raise an exception', 'text')
 
-    def test_publish_message(self, patch_pika):
+    def test_publish_message(self, patch_pika, _patch_time):
         with RabbitContext() as rabbit:
             rabbit.publish_message('Test message body', 'text')
 
@@ -36,3 +38,121 @@ class TestRabbitContext(TestCase):
                                                       routing_key=rabbit.queue_name,
                                                       body='Test message body',
                                                       properties=patch_pika.BasicProperties.return_value)
+
+    def test_publish_messages_commits_each_window(self, patch_pika, _patch_time):
+        with RabbitContext(publish_window=2) as rabbit:
+            published_count = rabbit.publish_messages(('one', 'two', 'three'), 'text')
+
+        batch_channel = patch_pika.BlockingConnection.return_value.channel.return_value
+        batch_channel.tx_select.assert_called_once()
+        self.assertEqual(batch_channel.basic_publish.call_count, 3)
+        self.assertEqual(batch_channel.tx_commit.call_count, 2)
+        self.assertEqual(published_count, 3)
+
+    def test_publish_messages_reports_each_confirmed_window(self, patch_pika, _patch_time):
+        confirmed_windows = []
+        with RabbitContext(publish_window=2) as rabbit:
+            rabbit.publish_messages(('one', 'two', 'three'), 'text', on_window_confirmed=confirmed_windows.append)
+
+        self.assertEqual(confirmed_windows, [2, 1])
+
+    def test_publish_messages_reuses_message_properties(self, patch_pika, _patch_time):
+        with RabbitContext() as rabbit:
+            rabbit.publish_messages(('one', 'two'), 'text')
+
+        patch_pika.BasicProperties.assert_called_once_with(content_type='text', delivery_mode=PERSISTENT_DELIVERY_MODE)
+
+    def test_attempt_to_publish_messages_with_closed_connection_raises_correct_exception(self, patch_pika, _patch_time):
+        with RabbitContext() as rabbit:
+            pass
+
+        with self.assertRaises(RabbitConnectionClosedError):
+            rabbit.publish_messages(('This should raise an exception',), 'text')
+
+    def test_get_queue_depth(self, patch_pika, _patch_time):
+        patched_channel = patch_pika.BlockingConnection.return_value.channel.return_value
+        patched_channel.queue_declare.return_value.method.message_count = 42
+
+        with RabbitContext(queue_name='test_queue') as rabbit:
+            queue_depth = rabbit.get_queue_depth()
+
+        patched_channel.queue_declare.assert_called_once_with(queue='test_queue', passive=True)
+        self.assertEqual(queue_depth, 42)
+
+    def test_connection_parameters_include_configured_heartbeat(self, patch_pika, _patch_time):
+        with RabbitContext(heartbeat=30, blocked_connection_timeout=300):
+            pass
+
+        _, connection_parameters_kwargs = patch_pika.ConnectionParameters.call_args
+        self.assertEqual(connection_parameters_kwargs, {'heartbeat': 30, 'blocked_connection_timeout': 300.0})
+
+    def test_publish_messages_reconnects_and_replays_uncommitted_window(self, patch_pika, patch_time):
+        patched_channel = patch_pika.BlockingConnection.return_value.channel.return_value
+        patched_channel.tx_commit.side_effect = (None, StreamLostError('Connection lost'), None)
+        confirmed_windows = []
+
+        with RabbitContext(publish_window=2, retry_backoff=1) as rabbit:
+            published_count = rabbit.publish_messages(('one', 'two', 'three', 'four'), 'text',
+                                                      on_window_confirmed=confirmed_windows.append)
+
+        published_bodies = [kwargs['body'] for _, kwargs in patched_channel.basic_publish.call_args_list]
+        self.assertEqual(published_bodies, ['one', 'two', 'three', 'four', 'three', 'four'])
+        self.assertEqual(patch_pika.BlockingConnection.call_count, 2)
+        patch_time.sleep.assert_called_once_with(1)
+        self.assertEqual(confirmed_windows, [2, 2])
+        self.assertEqual(published_count, 4)
+
+    def test_publish_message_gives_up_after_max_retries(self, patch_pika, patch_time):
+        patched_channel = patch_pika.BlockingConnection.return_value.channel.return_value
+        patched_channel.basic_publish.side_effect = StreamLostError('Connection lost')
+
+        with RabbitContext(max_retries=2, retry_backoff=1) as rabbit:
+            with self.assertRaises(StreamLostError):
+                rabbit.publish_message('This should raise an exception', 'text')
+
+        self.assertEqual(patched_channel.basic_publish.call_count, 3)
+        self.assertEqual([args for args, _ in patch_time.sleep.call_args_list], [(1,), (2,)])
+
+    def test_sleep_processes_connection_events(self, patch_pika, patch_time):
+        patch_time.monotonic.return_value = 0
+
+        with RabbitContext() as rabbit:
+            rabbit.sleep(5)
+
+        patch_pika.BlockingConnection.return_value.sleep.assert_called_once_with(5)
+
+    def test_sleep_resumes_on_a_new_connection_after_connection_loss(self, patch_pika, patch_time):
+        patch_time.monotonic.side_effect = (0, 0, 2)
+        patched_connection = patch_pika.BlockingConnection.return_value
+        patched_connection.sleep.side_effect = (StreamLostError('Connection lost'), None)
+
+        with RabbitContext(retry_backoff=1) as rabbit:
+            rabbit.sleep(5)
+
+        self.assertEqual([args for args, _ in patched_connection.sleep.call_args_list], [(5,), (3,)])
+        self.assertEqual(patch_pika.BlockingConnection.call_count, 2)
+
+    def test_get_queue_depth_reconnects_after_connection_loss(self, patch_pika, patch_time):
+        patched_channel = patch_pika.BlockingConnection.return_value.channel.return_value
+        queue_declare_ok = Mock()
+        queue_declare_ok.method.message_count = 42
+        patched_channel.queue_declare.side_effect = (StreamLostError('Connection lost'), queue_declare_ok)
+
+        with RabbitContext(retry_backoff=1) as rabbit:
+            queue_depth = rabbit.get_queue_depth()
+
+        self.assertEqual(queue_depth, 42)
+        self.assertEqual(patch_pika.BlockingConnection.call_count, 2)
+        patch_time.sleep.assert_called_once_with(1)
+
+    def test_get_queue_depth_reopens_a_connection_the_broker_closed(self, patch_pika, _patch_time):
+        dropped_connection, new_connection = Mock(), Mock()
+        patch_pika.BlockingConnection.side_effect = (dropped_connection, new_connection)
+        new_connection.channel.return_value.queue_declare.return_value.method.message_count = 42
+
+        with RabbitContext() as rabbit:
+            dropped_connection.is_open = False
+            queue_depth = rabbit.get_queue_depth()
+
+        self.assertEqual(queue_depth, 42)
+        dropped_connection.channel.return_value.queue_declare.assert_not_called()